@@ -0,0 +1,166 @@
+import time
+import threading
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can not get under the token quota within its allowed wait"""
+
+
+def estimate_tokens(text, completion_tokens=1000):
+    """Rough token cost of a request: about 4 characters per prompt token plus a completion reserve"""
+    return len(text) // 4 + completion_tokens
+
+
+class TokenBucket:
+    """Tokens-per-minute bucket, full at one minute's worth of tokens
+
+    Args:
+      (float) tokens_per_minute: quota of the connector or deployment
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.capacity = float(tokens_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, tokens, now):
+        """Seconds until the bucket holds the tokens, 0 if it does now"""
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # a request larger than the bucket only has to wait for a full bucket
+        tokens = min(tokens, self.capacity)
+        return 0.0 if self.tokens >= tokens else (tokens - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Admits LLM requests against a token bucket per connector or Azure deployment, so requests
+    queue before they hit the tokens-per-minute quota instead of failing with 429s.
+
+    Buckets start from the configured quotas and follow the x-ratelimit-* headers of the
+    responses when the caller sees them. A key without a known quota is admitted right away
+    until a 429 or a rate-limit header reveals one.
+
+    Args:
+      (dict) quotas: tokens per minute by connector id or deployment name
+      (float) default_tokens_per_minute: quota of keys not in quotas, None for unknown
+      (float) max_wait: longest a request queues before it is rejected
+    """
+
+    def __init__(self, quotas=None, default_tokens_per_minute=None, max_wait=30):
+        self.quotas = dict(quotas or {})
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self.max_wait = max_wait
+        self.admitted = 0
+        self.rejected = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        if key not in self._buckets:
+            quota = self.quotas.get(key, self.default_tokens_per_minute)
+            self._buckets[key] = TokenBucket(quota) if quota else None
+        return self._buckets[key]
+
+    def admit(self, key, tokens, deadline=None):
+        """Waits until the key's bucket holds the estimated tokens and takes them
+
+        Args:
+          (str) key: connector id or deployment name
+          (int) tokens: estimated tokens of the request
+          (Deadline) deadline: overall deadline of the user request, caps the wait
+
+        Raises:
+          AdmissionRejected if the tokens are not available within max_wait or the deadline
+        """
+        max_wait = self.max_wait if deadline is None else min(self.max_wait, deadline.remaining())
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                bucket = self._bucket(key)
+                now = time.monotonic()
+                wait = 0.0 if bucket is None else bucket.wait_for(tokens, now)
+                if wait == 0.0:
+                    if bucket is not None:
+                        bucket.tokens -= min(tokens, bucket.capacity)
+                    self.admitted += 1
+                    return
+                if now - started + wait > max_wait:
+                    self.rejected += 1
+                    raise AdmissionRejected(
+                        f"{key} is over its token quota, the request would have to wait {wait:.0f}s"
+                    )
+            time.sleep(min(wait, 1.0))
+
+    def update_from_headers(self, key, headers):
+        """Follows the Azure OpenAI rate-limit headers of a response
+
+        Args:
+          (str) key: connector id or deployment name
+          (Mapping) headers: response headers
+        """
+        limit = headers.get("x-ratelimit-limit-tokens")
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        with self._lock:
+            bucket = self._bucket(key)
+            if limit is not None:
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(float(limit))
+                elif float(limit) != bucket.capacity:
+                    bucket.capacity = float(limit)
+                    bucket.rate = bucket.capacity / 60.0
+            if bucket is not None and remaining is not None:
+                bucket.refill(time.monotonic())
+                # the server's count wins, it also sees the other clients of the deployment
+                bucket.tokens = min(bucket.tokens, float(remaining))
+
+    def throttled(self, key, retry_after=None, headers=None):
+        """Records a 429 for the key: empties its bucket and blocks it for retry_after seconds
+
+        Args:
+          (str) key: connector id or deployment name
+          (float) retry_after: seconds to back off, read from the headers if not given
+          (Mapping) headers: response headers of the 429, optional
+        """
+        if retry_after is None and headers is not None:
+            if headers.get("retry-after-ms") is not None:
+                retry_after = float(headers["retry-after-ms"]) / 1000.0
+            elif headers.get("retry-after") is not None:
+                retry_after = float(headers["retry-after"])
+        retry_after = 10.0 if retry_after is None else retry_after
+        with self._lock:
+            bucket = self._bucket(key)
+            if bucket is None:
+                # the quota is unknown, assume what was sent in the last minute was about the limit
+                bucket = self._buckets[key] = TokenBucket(self.default_tokens_per_minute or 60000)
+            now = time.monotonic()
+            bucket.refill(now)
+            bucket.tokens = 0.0
+            bucket.blocked_until = max(bucket.blocked_until, now + retry_after)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "buckets": {
+                    key: round(bucket.tokens) for key, bucket in self._buckets.items() if bucket is not None
+                },
+            }
+
+
+def azure_rate_limit_hook(controller, key):
+    """httpx response hook that feeds the rate-limit headers of Azure OpenAI responses to the controller,
+    for AzureChatOpenAI(http_client=httpx.Client(event_hooks={"response": [hook]}))"""
+    def hook(response):
+        if response.status_code == 429:
+            controller.throttled(key, headers=response.headers)
+        else:
+            controller.update_from_headers(key, response.headers)
+    return hook
@@ -1,5 +1,9 @@
+"""Interactive conversation with the Observability AI Assistant, run from the repository root:
+
+    python -m ai_assistant.ai_assistant_api_conversation
+"""
 import os
-from utils import ask_assistant
+from ai_assistant.utils import ask_assistant
 
 # Replace with your Kibana URL and credentials
 KIBANA_URL = os.getenv("KIBANA_URL", "http://localhost:5601/")
@@ -10,6 +14,7 @@ MODEL = ".gen-ai"  # can be changed to '.bedrock'
 PERSIST_CONVERSATION = True  # Save conversation in AI Assistan's UI
 STREAMING = True  # to stream the responses, allows to show intermediate responses like function calls, or False to wait for the entire response and only show final message
 PRINT_STREAMING_RESPONSE = True  # to print the message response of the assistant in streaming, or False to wait for the entire message response to print it
+HEDGE = False  # with STREAMING, duplicate requests slower than the connector's p95 to an alternate connector (not persisted) and use the first answer
 
 new_conversation = True
 user_message = ""
@@ -27,6 +32,7 @@ while True:
             persist_conversation=PERSIST_CONVERSATION,
             streaming=STREAMING,
             print_streaming_response=PRINT_STREAMING_RESPONSE,
+            hedge=HEDGE,
         )
         new_conversation = False
     else:
@@ -41,9 +47,11 @@ while True:
                 user_question=user_message,
                 conversation={
                     "conversationId": response["conversationId"],
+                    "connectorId": response.get("connectorId"),
                     "messages": response["messages"],
                 },
                 persist_conversation=PERSIST_CONVERSATION,
                 streaming=STREAMING,
                 print_streaming_response=PRINT_STREAMING_RESPONSE,
+                hedge=HEDGE,
             )
\ No newline at end of file
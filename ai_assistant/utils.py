@@ -1,19 +1,71 @@
+import time
+import threading
 import requests
 import json
 from datetime import datetime, timedelta
 
+from connector_router import ConnectorRouter
+from hedging import HedgePolicy, HedgedStream
+from kibana_client import kibana_client, Deadline
+from message_log import MessageLog
+
+_connector_routers = {}
+_hedge_policies = {}
+
+# Functions whose results only change with the index mappings. Their calls are harvested from
+# finished conversations and seeded into new ones, so the assistant skips rediscovering them.
+discovery_functions = ("get_dataset_info",)
+discovery_ttl = 3600
+discovery_max_chars = 20000
+_discovery_cache = {}
+# conversations finish on the fan-out and scheduler threads at the same time
+_discovery_lock = threading.Lock()
+
+
+def _get_connector_router(kibana_url, auth, model):
+    """Returns the connector router for a Kibana instance and model, discovering its connectors on first use
+
+    Args:
+      (str) kibana_url: URL to Kibana instance
+      ((str, str)) auth: tuple (username, password) to access Kibana
+      (str) model: LLM model to use, options: .gen-ai (OpenAI or Azure OpenAI) or .bedrock
+
+    Returns:
+      (ConnectorRouter) router shared by every conversation against that Kibana
+    """
+    key = (kibana_url, model)
+    if key not in _connector_routers:
+        router = ConnectorRouter(kibana_url, auth, connector_types=(model,))
+        try:
+            router.discover()
+        except requests.exceptions.RequestException as e:
+            print("Connection Error with Kibana - Make sure it's running")
+            raise e
+        _connector_routers[key] = router
+    return _connector_routers[key]
+
+
+def _get_hedge_policy(router):
+    """Returns the hedge policy of a connector router, so the hedge budget is shared by its conversations"""
+    if id(router) not in _hedge_policies:
+        _hedge_policies[id(router)] = HedgePolicy(router)
+    return _hedge_policies[id(router)]
+
 
 def _get_genai_connector_id(
     kibana_url,
     auth,
     model,
+    conversation=None,
 ):
-    """Obtains the GenAI connector id from the Kibana API. Prints error if no available connector id is found.
+    """Obtains the GenAI connector id to use for a conversation. Ongoing conversations stay on their connector,
+    new ones go to the connector with the best recent time-to-first-event and error rate.
 
     Args:
       (str) kibana_url: URL to Kibana instance
       ((str, str)) auth: tuple (username, password) to access Kibana
       (str) model: LLM model to use, options: .gen-ai (OpenAI or Azure OpenAI) or .bedrock
+      (dict) conversation: previous conversation returned by ask_assistant, None or {} for a new one
 
     Returns:
       (str) GenAI connector id
@@ -23,74 +75,97 @@ def _get_genai_connector_id(
        Wrong Kibana url or credentials
        No GenAI connector
     """
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url_connector = f"{kibana_url}/api/actions/connectors"
-    try:
-        connectors = requests.get(
-            url=url_connector, headers=headers, auth=auth, verify=True
-        )
-    except Exception as e:
-        print("Connection Error with Kibana - Make sure it's running")
-        raise e
-
-    if connectors.status_code == 404:
-        raise Exception("ERROR - Wrong Kibana url or credentials")
-    elif connectors.status_code == 401:
-        raise Exception("ERROR - Unauthorized -  unable to authenticate user")
-
-    connectors_ai = [
-        conn for conn in connectors.json() if conn["connector_type_id"] == model
-    ]
-    # print('connectors_ai:', connectors_ai)
-    # print()
-    if len(connectors_ai) == 0:
-        raise Exception(
-            f"ERROR - No GenAI connectors found for {model}, please add your GenAI connector to Kibana"
-        )
-    # return connectors_ai[0]["id"]
-    return 'ce4b2de5-d9f0-4793-bee6-169749c0d51b' # azure-pmm-westus
+    conversation = conversation or {}
+    if conversation.get("connectorId"):
+        return conversation["connectorId"]
+    router = _get_connector_router(kibana_url, auth, model)
+    return router.route(conversation.get("conversationId"))
+
+
+def _harvest_discovery(kibana_url, messages):
+    """Caches the successful discovery function calls of a conversation together with their results
 
+    Args:
+      (str) kibana_url: URL to Kibana instance the conversation ran against
+      (list) messages: messages of the conversation, as sent to chat/complete
+    """
+    for call, result in zip(messages, messages[1:]):
+        if not call or not result:
+            continue
+        function_call = call["message"].get("function_call") or {}
+        if (
+            function_call.get("name") not in discovery_functions
+            or result["message"].get("name") != function_call["name"]
+            or len(result["message"].get("content") or "") > discovery_max_chars
+        ):
+            continue
+        try:
+            content = json.loads(result["message"].get("content") or "null")
+        except ValueError:
+            continue
+        if not content or (isinstance(content, dict) and content.get("error")):
+            continue
+        key = (kibana_url, function_call["name"], function_call.get("arguments"))
+        with _discovery_lock:
+            _discovery_cache[key] = (time.time(), call["message"], result["message"])
+
+
+def _get_discovery_messages(kibana_url):
+    """Returns the cached discovery calls and results of a Kibana instance younger than discovery_ttl,
+    as messages to seed a new conversation with
 
-def _get_kibana_version(kibana_url, auth):
+    Args:
+      (str) kibana_url: URL to Kibana instance
+
+    Returns:
+      (list) function call and function result messages, in pairs
+    """
+    timestamp = (datetime.now() - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%S.%f")
+    messages = []
+    with _discovery_lock:
+        for key, (harvested, call, result) in list(_discovery_cache.items()):
+            if key[0] != kibana_url:
+                continue
+            if time.time() - harvested > discovery_ttl:
+                # expired, the next conversation calls the function again and harvests a fresh result
+                del _discovery_cache[key]
+                continue
+            messages.append({"@timestamp": timestamp, "message": call})
+            messages.append({"@timestamp": timestamp, "message": result})
+    return messages
+
+
+def _get_kibana_version(kibana_url, auth, deadline=None):
     """Obtains the Kibana Version from the Kibana API
 
     Args:
       (str) kibana_url: URL to Kibana instance
       ((str, str)) auth: tuple (username, password) to access Kibana
+      (Deadline) deadline: overall deadline of the user request, optional
 
     Returns:
       (str) Kibana Version as a string (e.g. 8.14.0)
     """
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url_connector = f"{kibana_url}/api/status"
-    status = requests.get(url=url_connector, headers=headers, auth=auth, verify=True)
+    status = kibana_client(kibana_url, auth).get("/api/status", deadline=deadline)
     version = status.json()["version"]["number"]
     return version
 
 
-def _get_assistants_system_prompt(kibana_url, auth):
+def _get_assistants_system_prompt(kibana_url, auth, deadline=None):
     """Obtains the Assistant's system prompt fron the Assistants API
 
     Args:
       (str) kibana_url: URL to Kibana instance
       ((str, str)) auth: tuple (username, password) to access Kibana
+      (Deadline) deadline: overall deadline of the user request, optional
 
     Returns:
       (str) System prompt
     """
 
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url = f"{kibana_url}/internal/observability_ai_assistant/functions"
-    functions = requests.get(url=url, headers=headers, auth=auth, verify=True)
+    functions = kibana_client(kibana_url, auth).get(
+        "/internal/observability_ai_assistant/functions", deadline=deadline
+    )
     system_prompt = [
         f for f in functions.json()["contextDefinitions"] if f["name"] == "core"
     ][0]["description"]
@@ -98,44 +173,79 @@ def _get_assistants_system_prompt(kibana_url, auth):
 
 
 def _get_assistants_response(
-    headers,
     data,
     streaming,
     print_streaming_response,
     kibana_url,
     auth,
+    connector_id=None,
+    router=None,
+    hedge_policy=None,
+    deadline=None,
+    on_event=None,
+    on_hedge_won=None,
 ):
     """Handles response from the Assistant in streaming or non-streaming mode
 
     Args:
       (str) kibana_url: URL to Kibana instance
       ((str, str)) auth: tuple (username, password) to access Kibana
-      (dict) headers
       (dict) data
       (boolean) streaming to stream the responses, or False to wait for the entire response, allows to show intermediate responses like function calls
       (boolean) print_streaming_response to print the message response of the assistant in streaming, or false to print the message response at the end
+      (str) connector_id: GenAI connector the request goes to
+      (ConnectorRouter) router: records time-to-first-event and errors for the connector, optional
+      (HedgePolicy) hedge_policy: hedges slow streaming requests to an alternate connector, optional
+      (Deadline) deadline: overall deadline of the user request, optional
+      (callable) on_event: called with every json response as it arrives in streaming mode, optional
+      (callable) on_hedge_won: called with the alternate connector id when the hedged duplicate answered first, optional
     Returns:
       (list) List of the json responses from the API
     """
 
-    url = f"{kibana_url}/internal/observability_ai_assistant/chat/complete"
+    client = kibana_client(kibana_url, auth)
+    path = "/internal/observability_ai_assistant/chat/complete"
     if streaming == False:
-        response = requests.post(
-            url=url, headers=headers, auth=auth, verify=True, data=data
+        # chat/complete answers in NDJSON too, so the idle timeout bounds the gap between two events
+        response = client.post(
+            path, data, read_timeout=client.stream_idle_timeout, deadline=deadline
         )
         response_array = [json.loads(i) for i in response.text.split("\n") if i != ""]
+        # the whole answer arrives at once, there is no time-to-first-event to sample, only the outcome
+        if router is not None:
+            if response.status_code == 200:
+                router.record_success(connector_id)
+            else:
+                router.record_error(connector_id)
     else:
         response_array = []
         initchatCompletionChunk = True
-        with requests.post(
-            url=url, headers=headers, auth=auth, verify=True, data=data, stream=True
-        ) as response:
+        started = time.monotonic()
+        if hedge_policy is not None:
+            # the hedged stream records connector latency and errors itself
+            stream = HedgedStream(client, path, data, connector_id, hedge_policy, deadline)
+            router = None
+        else:
+            stream = client.post(path, data, stream=True, deadline=deadline)
+        with stream as response:
             try:
                 if response.status_code == 200:
-                    for line in response.iter_lines():
+                    if hedge_policy is not None:
+                        if response.hedged and on_hedge_won is not None:
+                            on_hedge_won(response.connector_id)
+                        lines = response.iter_lines()
+                    else:
+                        lines = client.iter_lines(response, deadline)
+                    for line in lines:
                         if line and line != "":  # Ignore keep-alive new lines
+                            if not response_array and router is not None:
+                                router.record_first_event(
+                                    connector_id, time.monotonic() - started
+                                )
                             response_json = json.loads(line.decode("utf-8"))
                             response_array.append(response_json)
+                            if on_event is not None:
+                                on_event(response_json)
                             if response_json != None:
                                 if (
                                     response_json.get("type") == "chatCompletionChunk"
@@ -185,9 +295,15 @@ def _get_assistants_response(
                                                 + "\x1b[0m"
                                                 + f" {functions}"
                                             )
+                    if router is not None:
+                        router.record_success(connector_id)
                 else:
+                    if router is not None:
+                        router.record_error(connector_id)
                     print(f"ERROR: Response status code {response.status_code}")
             except Exception as e:
+                if router is not None:
+                    router.record_error(connector_id)
                 print(f"ERROR: {str(e)}")
     return response_array
 
@@ -201,6 +317,10 @@ def ask_assistant(
     persist_conversation=False,
     streaming=False,
     print_streaming_response=False,
+    hedge=False,
+    deadline_seconds=600,
+    on_event=None,
+    seed_discovery=True,
 ):
     """Returns AI Assistant response based on a user question.
     If the API call to the AI Assistant fails, returns error message with response status
@@ -210,30 +330,37 @@ def ask_assistant(
       ((str, str)) auth: tuple (username, password) to access Kibana
       (str) connector_id: GenAI connector id from the Kibana API
       (str) user_question: user prompt
+      (boolean) hedge: in streaming mode, duplicate requests slower than the connector's p95 time-to-first-event
+       to an alternate connector without persisting them, and use whichever answers first
+      (int) deadline_seconds: overall time budget for the question across all Kibana calls
+      (callable) on_event: in streaming mode, called with every chat/complete event as it arrives
+      (boolean) seed_discovery: start new conversations with the cached results of discovery functions
+       like get_dataset_info from earlier conversations, instead of letting the assistant call them again
 
     Returns:
       (str) AI Assistant response
 
     """
-    connector_id = _get_genai_connector_id(kibana_url, auth, model)
+    deadline = Deadline(deadline_seconds)
+    connector_id = _get_genai_connector_id(kibana_url, auth, model, conversation)
+    router = _get_connector_router(kibana_url, auth, model)
 
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
     data = {
-        "messages": [],
         "connectorId": connector_id,
         "persist": persist_conversation,
     }
 
-    if persist_conversation and conversation != {}:
+    # a turn answered by a hedge was not persisted, the conversation then has no id yet
+    continued = persist_conversation and conversation != {} and conversation["conversationId"] is not None
+    if continued:
         data["conversationId"] = conversation["conversationId"]
 
-    version = _get_kibana_version(kibana_url, auth)
+    version = _get_kibana_version(kibana_url, auth, deadline=deadline)
     if int(version.split(".")[0]) >= 8 and int(version.split(".")[1]) >= 13:
         data["screenContexts"] = []
-        assistant_sytem_message = _get_assistants_system_prompt(kibana_url, auth)
+        assistant_sytem_message = _get_assistants_system_prompt(
+            kibana_url, auth, deadline=deadline
+        )
     else:
         assistant_sytem_message = 'You are a helpful assistant for Elastic Observability. Your goal is to help the Elastic Observability users to quickly assess what is happening in their observed systems. You can help them visualise and analyze data, investigate their systems, perform root cause analysis or identify optimisation opportunities.\\n\\nIt\'s very important to not assume what the user is meaning. Ask them for clarification if needed.\\n\\nIf you are unsure about which function should be used and with what arguments, ask the user for clarification or confirmation.\\n\\nIn KQL, escaping happens with double quotes, not single quotes. Some characters that need escaping are: \':()\\\\        /\\". Always put a field value in double quotes. Best: service.name:\\"opbeans-go\\". Wrong: service.name:opbeans-go. This is very important\u0021\\n\\nYou can use Github-flavored Markdown in your responses. If a function returns an array, consider using a Markdown table to format the response.\\n\\nIf multiple functions are suitable, use the most specific and easy one. E.g., when the user asks to visualise APM data, use the APM functions (if available) rather than Lens.\\n\\nIf a function call fails, DO NOT UNDER ANY CIRCUMSTANCES execute it again. Ask the user for guidance and offer them options.\\n\\nNote that ES|QL (the Elasticsearch query language, which is NOT Elasticsearch SQL, but a new piped language) is the preferred query language.\\n\\nUse the \\"get_dataset_info\\" function if it is not clear what fields or indices the user means, or if you want to get more information about the mappings.\\n\\nIf the user asks about a query, or ES|QL, always call the \\"esql\\" function. DO NOT UNDER ANY CIRCUMSTANCES generate ES|QL queries or explain anything about the ES|QL query language yourself.\\nEven if the \\"recall\\" function was used before that, follow it up with the \\"esql\\" function. If a query fails, do not attempt to correct it yourself. Again you should call the \\"esql\\" function,\\neven if it has been called before.\\n\\nIf the \\"get_dataset_info\\" function returns no data, and the user asks for a query, generate a query anyway with the \\"esql\\" function, but be explicit about it potentially being incorrect.You can use the \\"summarize\\" functions to store new information you have learned in a knowledge database. Once you have established that you did not know the answer to a question, and the user gave you this information, it\'s important that you create a summarisation of what you have learned and store it in the knowledge database. Don\'t create a new summarization if you see a similar summarization in the conversation, instead, update the existing one by re-using its ID.\\n\\nAdditionally, you can use the \\"recall\\" function to retrieve relevant information from the knowledge database."}}'
 
@@ -247,10 +374,14 @@ def ask_assistant(
                 "content": assistant_sytem_message,
             },
         }
-        data["messages"].append(system_message)
+        seed_messages = _get_discovery_messages(kibana_url) if seed_discovery else []
+        log = MessageLog([system_message] + seed_messages)
     else:
         system_message = None
-        data["messages"] = data["messages"] + conversation["messages"]
+        log = conversation["messages"]
+        if not isinstance(log, MessageLog):
+            # a conversation kept as a plain list of messages
+            log = MessageLog(log)
 
     user_message = {
         "@timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f"),
@@ -259,30 +390,50 @@ def ask_assistant(
             "content": user_question,
         },
     }
-    data["messages"].append(user_message)
-
-    data = json.dumps(data)
+    # the history was serialized when it was logged, only this turn's question is encoded here
+    data = log.request_body(data, [user_message])
 
+    hedge_won = []
     response_array = _get_assistants_response(
-        headers, data, streaming, print_streaming_response, kibana_url, auth
+        data,
+        streaming,
+        print_streaming_response,
+        kibana_url,
+        auth,
+        connector_id=connector_id,
+        router=router,
+        hedge_policy=_get_hedge_policy(router) if hedge else None,
+        deadline=deadline,
+        on_event=on_event,
+        on_hedge_won=hedge_won.append,
     )
+    if hedge_won:
+        # the answer came from the alternate connector, the conversation continues there
+        connector_id = hedge_won[0]
 
     messages = [r["message"] for r in response_array if r["type"] == "messageAdd"]
-    if persist_conversation and conversation == {}:
-        conversationId = [
-            r for r in response_array if r["type"] == "conversationCreate"
-        ][0]["conversation"]["id"]
+    _harvest_discovery(kibana_url, messages)
+    # a hedged duplicate that won the race was not persisted, so it carries no conversationCreate/Update
+    persisted = persist_conversation and any(
+        r["type"] in ("conversationCreate", "conversationUpdate") for r in response_array
+    )
+    if persist_conversation and not continued:
+        conversationId = next(
+            (
+                r["conversation"]["id"]
+                for r in response_array
+                if r["type"] == "conversationCreate"
+            ),
+            None,
+        )
     elif persist_conversation == False:
         conversationId = None
     else:
         conversationId = conversation["conversationId"]
+    if conversationId is not None:
+        router.pin(conversationId, connector_id)
 
-    if conversation == {}:
-        messages = [system_message, user_message] + messages
-    else:
-        messages = conversation["messages"] + [user_message] + messages
-
-    if persist_conversation == False:
+    if persisted == False:
         message_index = -1
     else:
         message_index = -2
@@ -291,18 +442,23 @@ def ask_assistant(
         assistant_response = response_array[message_index]["message"]["message"][
             "content"
         ]
-        if not print_streaming_response or not streaming:
-            print("\x1b[6;30;46m" + "Assistant:" + "\x1b[0m" + f" {assistant_response}")
-        return {
-            "conversationId": conversationId,
-            "response": assistant_response,
-            "messages": messages,
-        }
     except:
         print(f"Response was not successful: {response_array}")
         print(f"ERROR - API Response was not successful -----")
         return {
             "conversationId": "ERROR",
-            "response": "ERROR" + str(response_array[0]),
+            "response": "ERROR" + (str(response_array[0]) if response_array else " - empty response"),
             "messages": [],
-        }
\ No newline at end of file
+        }
+
+    # the log may be the caller's conversation, the turn is only logged once it has an answer
+    log.append(user_message)
+    log.extend(messages)
+    if not print_streaming_response or not streaming:
+        print("\x1b[6;30;46m" + "Assistant:" + "\x1b[0m" + f" {assistant_response}")
+    return {
+        "conversationId": conversationId,
+        "connectorId": connector_id,
+        "response": assistant_response,
+        "messages": log,
+    }
\ No newline at end of file
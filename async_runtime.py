@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+_done = object()
+
+
+async def iterate_in_executor(executor, generator_function, *args, max_pending=64, **kwargs):
+    """Iterates a blocking generator on an executor thread and yields its items on the event loop,
+    so an async handler can await the assistant's NDJSON stream while the Kibana client keeps
+    its retries, circuit breaker and stream resumption.
+
+    The executor has a fixed size, it bounds the number of concurrent Kibana streams
+    however many Slack events are being handled. At most max_pending items wait for the
+    consumer, a slow consumer holds the stream back instead of buffering all of it, and a
+    consumer that stops early (an error, a cancelled task) stops and closes the stream.
+
+    Args:
+      (concurrent.futures.Executor) executor: pool running the blocking generator
+      (callable) generator_function: function returning the blocking generator
+      (int) max_pending: items read ahead of the consumer
+      args, kwargs: arguments of generator_function
+
+    Raises:
+      whatever the generator raised, re-raised on the event loop
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue(maxsize=max_pending)
+    stopped = threading.Event()
+
+    def put(item):
+        # waits for room in the queue, the consumer drains it when it stops
+        asyncio.run_coroutine_threadsafe(items.put(item), loop).result()
+
+    def produce():
+        generator = generator_function(*args, **kwargs)
+        try:
+            for item in generator:
+                put(item)
+                if stopped.is_set():
+                    break
+        except BaseException as e:
+            if not stopped.is_set():
+                put(_Failure(e))
+        finally:
+            # closing the generator closes the Kibana stream it reads from
+            close = getattr(generator, "close", None)
+            if close is not None:
+                close()
+            if not stopped.is_set():
+                put(_done)
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await items.get()
+            if item is _done:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        # frees a producer waiting for room, it then sees the stop
+        while not items.empty():
+            items.get_nowait()
+    await producer
@@ -0,0 +1,249 @@
+"""Batch evaluation of persona <-> ObsBurger investigations without Slack.
+
+Runs every shiftstart scenario of a file through the persona's ConversationChain and an
+ObsBurger backend, concurrently across a process pool, and writes one JSON line per scenario
+with turns to resolution, latency per turn and prompt size.
+
+    python batch_eval.py scenarios.txt --prompt prompts/opsexpert.txt --persona-backend stub \
+        --obsburger-backend recorded --recording recording.jsonl --workers 8 --output results.jsonl
+
+Scenarios are one shiftstart prompt per line, or JSON lines with a "prompt" key.
+Recordings are JSON lines with "prompt", "persona" and "obsburger" keys holding the replies of each side in order.
+"""
+import sys
+import json
+import time
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bot_channel import investigation_loop
+
+
+def load_scenarios(path):
+    scenarios = []
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            prompt = json.loads(line)["prompt"] if line.startswith("{") else line
+            scenarios.append(prompt.replace('shiftstart', '', 1).strip())
+    return scenarios
+
+
+def load_recordings(path):
+    if path is None:
+        return {}
+    with open(path, 'r') as file:
+        return {record["prompt"]: record for record in map(json.loads, file) if record}
+
+
+def build_persona(config, recording):
+    """Builds the persona's ConversationChain the same way the persona bots do, with the LLM swapped per backend"""
+    from langchain.chains import ConversationChain
+    from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
+    from langchain.prompts.prompt import PromptTemplate
+    from langchain_core.language_models import FakeListLLM
+
+    with open(config["prompt"], 'r') as file:
+        system_message = file.read()
+    ai_prefix = config["ai_prefix"]
+    template = f"""{system_message}
+
+Current conversation:
+{{history}}
+ObsBurger: {{input}}
+{ai_prefix}:"""
+    prompt = PromptTemplate(input_variables=["history", "input"], template=template)
+
+    if config["persona_backend"] == "azure":
+        from langchain_openai import AzureChatOpenAI
+        from llm_cache import persona_llm_cache
+
+        creds = config["creds"]
+        llm = AzureChatOpenAI(
+            model_name=creds['AZURE_OPENAI_DEPLOYMENT'],
+            azure_endpoint=creds['AZURE_ENDPOINT'],
+            azure_deployment=creds['AZURE_OPENAI_DEPLOYMENT'],
+            api_key=creds['AZURE_OPENAI_KEY'],
+            api_version=creds['OPEN_AI_VERSION'],
+            cache=persona_llm_cache(creds, 'batch-eval'),
+        )
+        summary_llm = llm
+    elif config["persona_backend"] == "recorded":
+        llm = FakeListLLM(responses=recording["persona"] + [config["done_phrase"]])
+        summary_llm = FakeListLLM(responses=["Recorded investigation so far."])
+    else:
+        stub_turns = config["stub_turns"]
+        llm = FakeListLLM(
+            responses=[f"Stub question {turn + 1}, what else do you see?" for turn in range(stub_turns)]
+            + [f"{config['done_phrase']}. Stub report."]
+        )
+        summary_llm = FakeListLLM(responses=["Stub investigation so far."])
+
+    if config["memory"] == "summary":
+        memory = ConversationSummaryMemory(ai_prefix=ai_prefix, llm=summary_llm)
+    else:
+        memory = ConversationBufferMemory(ai_prefix=ai_prefix)
+    return ConversationChain(prompt=prompt, llm=llm, memory=memory), prompt, memory
+
+
+def build_obsburger(config, recording):
+    """Returns a function (question) -> answer for the configured ObsBurger backend"""
+    if config["obsburger_backend"] == "kibana":
+        from ai_assistant.utils import ask_assistant
+        from kibana_client import kibana_auth
+
+        creds = config["creds"]
+        state = {"conversation": {}}
+
+        def ask(question):
+            response = ask_assistant(
+                kibana_url=creds['kibana_url'],
+                auth=kibana_auth(creds),
+                model=config["model"],
+                user_question=question,
+                conversation=state["conversation"],
+            )
+            state["conversation"] = response
+            return response["response"]
+
+        return ask
+
+    if config["obsburger_backend"] == "recorded":
+        answers = iter(recording["obsburger"])
+        return lambda question: next(answers, "I have nothing more on this.")
+
+    turns = iter(range(1, 1000))
+    return lambda question: f"Stub answer {next(turns)} to: {question[:200]}"
+
+
+class _Transcript:
+    """Stands in for the Slack mirror and keeps the transcript instead"""
+
+    def __init__(self):
+        self.messages = []
+
+    def post(self, channel_id, text):
+        self.messages.append(text)
+
+
+def run_scenario(scenario, config):
+    """Runs one investigation and measures it
+
+    Returns:
+      (dict) result line for the JSONL output
+    """
+    recording = config["recordings"].get(scenario, {"persona": [], "obsburger": []})
+    chain, prompt, memory = build_persona(config, recording)
+    ask_obsburger = build_obsburger(config, recording)
+    turns = []
+    resolved = {"value": False}
+
+    def ask(question):
+        started = time.monotonic()
+        answer = ask_obsburger(question)
+        turns.append({
+            "turn": len(turns) + 1,
+            "question_chars": len(question),
+            "obsburger_seconds": round(time.monotonic() - started, 3),
+        })
+        return answer
+
+    def respond(answer):
+        # prompt size as the persona LLM sees it, history included
+        prompt_chars = len(prompt.format(history=memory.buffer, input=answer))
+        started = time.monotonic()
+        reply = chain.predict(input=answer)
+        turns[-1]["persona_seconds"] = round(time.monotonic() - started, 3)
+        turns[-1]["prompt_chars"] = prompt_chars
+        turns[-1]["prompt_tokens_estimate"] = prompt_chars // 4
+        resolved["value"] = config["done_phrase"].lower() in reply.lower()
+        return reply, resolved["value"]
+
+    first_command = scenario
+    memory.save_context({"input": config["ai_prefix"]}, {"output": first_command})
+    transcript = _Transcript()
+    started = time.monotonic()
+    error = None
+    try:
+        investigation_loop(None, first_command, ask, respond, transcript, config["ai_prefix"], config["max_turns"])
+    except Exception as e:
+        error = str(e)
+
+    return {
+        "scenario": scenario,
+        "variant": config["variant"],
+        "resolved": resolved["value"],
+        "turns_to_resolution": len(turns) if resolved["value"] else None,
+        "turns": len(turns),
+        "wall_seconds": round(time.monotonic() - started, 3),
+        "prompt_chars_total": sum(turn.get("prompt_chars", 0) for turn in turns),
+        "per_turn": turns,
+        "transcript": transcript.messages,
+        "error": error,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch evaluation of persona <-> ObsBurger investigations")
+    parser.add_argument("scenarios", help="file with one shiftstart prompt per line")
+    parser.add_argument("--prompt", required=True, help="file with the persona's system message")
+    parser.add_argument("--variant", help="label of the prompt/memory variant in the results, defaults to the prompt file")
+    parser.add_argument("--ai-prefix", default="OpsHuman", help="persona name used in the conversation memory")
+    parser.add_argument("--memory", choices=["buffer", "summary"], default="buffer")
+    parser.add_argument("--persona-backend", choices=["stub", "recorded", "azure"], default="stub")
+    parser.add_argument("--obsburger-backend", choices=["stub", "recorded", "kibana"], default="stub")
+    parser.add_argument("--recording", help="JSONL recording for the recorded backends")
+    parser.add_argument("--creds", help="creds file for the azure and kibana backends")
+    parser.add_argument("--model", default=".gen-ai", help="connector type for the kibana backend")
+    parser.add_argument("--done-phrase", default="I am done investigating")
+    parser.add_argument("--max-turns", type=int, default=10)
+    parser.add_argument("--stub-turns", type=int, default=3, help="turns before the stub persona is done")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--output", default="batch_eval_results.jsonl")
+    args = parser.parse_args(argv)
+
+    creds = {}
+    if args.creds:
+        with open(args.creds, 'r') as file:
+            creds = json.load(file)
+    config = {
+        "prompt": args.prompt,
+        "variant": args.variant or args.prompt,
+        "ai_prefix": args.ai_prefix,
+        "memory": args.memory,
+        "persona_backend": args.persona_backend,
+        "obsburger_backend": args.obsburger_backend,
+        "recordings": load_recordings(args.recording),
+        "creds": creds,
+        "model": args.model,
+        "done_phrase": args.done_phrase,
+        "max_turns": args.max_turns,
+        "stub_turns": args.stub_turns,
+    }
+    scenarios = load_scenarios(args.scenarios)
+
+    started = time.monotonic()
+    resolved = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool, open(args.output, 'w') as output:
+        futures = {pool.submit(run_scenario, scenario, config): scenario for scenario in scenarios}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"scenario": futures[future], "variant": config["variant"], "error": str(e)}
+            resolved += bool(result.get("resolved"))
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            print(f"{result['scenario'][:60]!r}: turns={result.get('turns')} resolved={result.get('resolved')} "
+                  f"wall={result.get('wall_seconds')}s")
+
+    elapsed = time.monotonic() - started
+    print(f"{len(scenarios)} scenarios, {resolved} resolved in {elapsed:.1f}s "
+          f"({len(scenarios) / max(elapsed, 1e-9):.2f} scenarios/s) -> {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import re
+import json
+import queue
+import socket
+import threading
+import socketserver
+
+from concurrent.futures import ThreadPoolExecutor
+
+bot_mention_pattern = r"<@[\w]+>"
+
+
+class SlackMirror:
+    """Posts transcript messages to Slack from a background thread, in order,
+    so the bot-to-bot loop never waits on the Slack Web API
+
+    Args:
+      (slack_sdk.WebClient) client: Slack client of the bot posting the transcript
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._messages = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def post(self, channel_id, text):
+        # strip mentions so the mirrored transcript does not trigger the other bot's app_mention handler
+        text = re.sub(bot_mention_pattern + r"\s*", '', text).strip().replace('**', '*')
+        self._messages.put((channel_id, text))
+
+    def _run(self):
+        while True:
+            channel_id, text = self._messages.get()
+            try:
+                self.client.chat_postMessage(
+                    channel=channel_id,
+                    blocks=[{"type": "section", "text": {"type": "mrkdwn", "text": text}}],
+                    text=text,
+                )
+            except Exception as e:
+                print(f"Could not mirror message to Slack: {e}")
+
+
+class BotChannelServer:
+    """Local socket server ObsBurger uses to answer the personas directly instead of through Slack.
+
+    Requests and replies are newline delimited JSON, one request per line:
+      {"channel": "C123", "user": "U456", "text": "question"} -> {"text": "answer"}
+    A request with a "fork" id is answered in its own non-persisted conversation, not the channel's.
+
+    Args:
+      (callable) answer: function (channel_id, user_id, text, fork=None) -> answer text
+      (int) port: local port to listen on
+      (str) host: interface to listen on, local only by default since requests are not authenticated
+    """
+
+    def __init__(self, answer, port, host="127.0.0.1"):
+        self.answer = answer
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line.decode("utf-8"))
+                    except ValueError as e:
+                        # a malformed line fails on its own, the connection keeps serving the next ones
+                        print(f"Bot channel request is not JSON: {e}")
+                        text = f"ERROR: request is not JSON: {e}"
+                        self.wfile.write((json.dumps({"text": text}) + "\n").encode("utf-8"))
+                        self.wfile.flush()
+                        continue
+                    try:
+                        text = server.answer(request["channel"], request["user"], request["text"],
+                                             fork=request.get("fork"))
+                    except Exception as e:
+                        print(f"Bot channel request failed: {e}")
+                        text = f"ERROR: {e}"
+                    self.wfile.write((json.dumps({"text": text}) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"Bot channel listening on {self._server.server_address}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class BotChannelClient:
+    """Client side of the bot channel, used by OpsHuman and OpsExpert to ask ObsBurger directly
+
+    Args:
+      (int) port: port ObsBurger's bot channel listens on
+      (str) host: host ObsBurger runs on
+      (float) timeout: seconds to wait for an answer, ObsBurger may run several functions
+    """
+
+    def __init__(self, port, host="127.0.0.1", timeout=900):
+        self.port = port
+        self.host = host
+        self.timeout = timeout
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = sock.makefile("rwb")
+
+    def ask(self, channel_id, user_id, text, fork=None):
+        """Sends a question to ObsBurger and waits for its answer
+
+        Args:
+          (str) fork: id of a forked, non-persisted conversation to ask in, None for the channel's conversation
+
+        Returns:
+          (str) ObsBurger's answer
+        """
+        request = {"channel": channel_id, "user": user_id, "text": text}
+        if fork is not None:
+            request["fork"] = fork
+        request = (json.dumps(request) + "\n").encode("utf-8")
+        with self._lock:
+            # reconnect once if ObsBurger restarted since the last question
+            for attempt in range(2):
+                try:
+                    if self._file is None:
+                        self._connect()
+                    self._file.write(request)
+                    self._file.flush()
+                    line = self._file.readline()
+                    if not line:
+                        raise ConnectionError("bot channel closed by ObsBurger")
+                    return json.loads(line.decode("utf-8"))["text"]
+                except (OSError, ConnectionError):
+                    self._file = None
+                    if attempt == 1:
+                        raise
+
+    def ask_fork(self, channel_id, user_id, text, fork):
+        """Asks in a forked conversation over a connection of its own, so forks run in parallel"""
+        client = BotChannelClient(self.port, self.host, self.timeout)
+        try:
+            return client.ask(channel_id, user_id, text, fork=fork)
+        finally:
+            client.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def investigation_loop(channel_id, question, ask, respond, mirror, persona, max_turns=12):
+    """Runs a persona <-> ObsBurger investigation over the bot channel.
+    The persona's questions are mirrored to Slack, ObsBurger mirrors its own answers.
+
+    Args:
+      (str) channel_id: Slack channel the investigation was started in
+      (str) question: first question for ObsBurger
+      (callable) ask: function (question) -> ObsBurger's answer
+      (callable) respond: function (answer) -> (persona's next message, True when the persona is done)
+      (SlackMirror) mirror: posts the persona's messages to Slack
+      (str) persona: persona name shown in the mirrored transcript
+      (int) max_turns: upper bound of questions, in case the persona never finishes
+    """
+    for turn in range(max_turns):
+        mirror.post(channel_id, f"*{persona}:* {question}")
+        try:
+            answer = ask(question)
+        except OSError as e:
+            mirror.post(channel_id, f"Lost the bot channel to ObsBurger: {e}")
+            return
+        reply, finished = respond(answer)
+        if finished or turn == max_turns - 1:
+            mirror.post(channel_id, f"*{persona}:* {reply}")
+            return
+        question = reply
+
+
+def explore_hypotheses(channel_id, hypotheses, ask, mirror, persona, max_parallel=4):
+    """Explores independent hypotheses at once, each in a forked ObsBurger conversation.
+    The investigation waits for the slowest hypothesis instead of their sum.
+
+    Args:
+      (str) channel_id: Slack channel the investigation runs in
+      (list) hypotheses: dicts with the "hypothesis" and the "question" that tests it
+      (callable) ask: function (question, fork id) -> ObsBurger's answer
+      (SlackMirror) mirror: posts the persona's questions to Slack
+      (str) persona: persona name shown in the mirrored transcript
+      (int) max_parallel: forks asked at the same time
+
+    Returns:
+      (list) the hypotheses, each with ObsBurger's "finding" added
+    """
+    def explore(index, hypothesis):
+        mirror.post(channel_id, f"*{persona}* (hypothesis {index + 1}: {hypothesis['hypothesis']}): {hypothesis['question']}")
+        try:
+            finding = ask(hypothesis["question"], f"hypothesis-{index + 1}")
+        except OSError as e:
+            finding = f"ERROR: {e}"
+        return dict(hypothesis, finding=finding)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(hypotheses)))) as pool:
+        return list(pool.map(explore, range(len(hypotheses)), hypotheses))
+
+
+def merge_findings(answer, findings):
+    """ObsBurger's answer followed by the findings of the explored hypotheses, as the persona's next input"""
+    sections = [answer]
+    for index, finding in enumerate(findings):
+        sections.append(f"Hypothesis {index + 1}: {finding['hypothesis']}\n"
+                        f"Question: {finding['question']}\n"
+                        f"Finding: {finding['finding']}")
+    return "\n\n".join(sections)
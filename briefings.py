@@ -0,0 +1,118 @@
+import re
+import time
+
+from datetime import datetime, timedelta
+
+from sessions import timer_wheel
+
+
+def briefing_key(question):
+    """Normalizes a briefing question, so a persona's shiftstart question finds its briefing
+    whatever its case, spacing or trailing punctuation"""
+    question = re.sub(r"<@[\w]+>", '', question).lower()
+    return re.sub(r"\s+", ' ', question).strip(' ?.!')
+
+
+def next_shift_start(shift_starts, now=None):
+    """Returns the next shift start after now
+
+    Args:
+      (list) shift_starts: local "HH:MM" times shifts start at, e.g. ["07:00", "15:00", "23:00"]
+      (datetime) now: current local time, datetime.now() by default
+
+    Returns:
+      (datetime) start of the next shift
+    """
+    now = now or datetime.now()
+    starts = []
+    for shift_start in shift_starts:
+        hour, minute = (int(part) for part in shift_start.split(':'))
+        start = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        starts.append(start if start > now else start + timedelta(days=1))
+    return min(starts)
+
+
+class ShiftBriefings:
+    """Materializes the configured briefing questions ahead of every shift start, so a shiftstart
+    question at the shift boundary is answered from the stored briefing instead of from a fresh
+    chat/complete investigation while everyone asks at once.
+
+    Briefings are kept in the coordination backend with the time they were computed, and only one
+    replica computes them per shift.
+
+    Args:
+      (CoordinationBackend) backend: where the briefings are stored
+      (list) questions: briefing questions, e.g. "were there any anomalies related to APM services"
+      (list) shift_starts: local "HH:MM" times shifts start at
+      (callable) compute: function (question) -> conversation state holding the "response"
+      (callable) submit: function (func, *args) running the refresh off the timer thread, e.g. on the scheduler
+      (float) lead_minutes: minutes before a shift start the briefings are computed
+      (float) max_age_minutes: minutes a briefing is served after it was computed
+      (TimerWheel) wheel: timer wheel, the process-wide one by default
+    """
+
+    def __init__(self, backend, questions, shift_starts, compute, submit, lead_minutes=15, max_age_minutes=90,
+                 wheel=None):
+        self.backend = backend
+        self.questions = questions
+        self.shift_starts = shift_starts
+        self.compute = compute
+        self.submit = submit
+        self.lead_minutes = lead_minutes
+        self.max_age_minutes = max_age_minutes
+        self.wheel = wheel or timer_wheel()
+
+    def start(self, after=None):
+        """Schedules the refresh before the next shift start, and every one after it
+
+        Args:
+          (datetime) after: shift whose briefings were just scheduled, None for the next one from now
+        """
+        shift = next_shift_start(self.shift_starts, after)
+        refresh_at = shift - timedelta(minutes=self.lead_minutes)
+        if refresh_at <= datetime.now():
+            # inside the lead time already, refresh right away for this shift
+            refresh_at = datetime.now()
+        self.wheel.schedule((refresh_at - datetime.now()).total_seconds(), self._due, shift)
+        print(f"Shift briefings scheduled for {refresh_at:%Y-%m-%d %H:%M}")
+
+    def _due(self, shift):
+        # runs on the timer thread, the questions themselves go to the scheduler
+        self.submit(self.refresh, shift)
+        self.start(after=shift)
+
+    def refresh(self, shift=None):
+        """Computes every briefing question and stores the results
+
+        Args:
+          (datetime) shift: shift the briefings are for, one replica refreshes per shift
+        """
+        if shift is not None and not self.backend.add(f"briefings:{shift:%Y-%m-%dT%H:%M}",
+                                                      ttl=self.lead_minutes * 60 + self.max_age_minutes * 60):
+            print(f"Shift briefings for {shift:%H:%M} are computed by another replica")
+            return
+        for question in self.questions:
+            started = time.monotonic()
+            try:
+                conversation = self.compute(question)
+            except Exception as e:
+                print(f"Shift briefing failed for '{question}': {e}")
+                continue
+            if not conversation.get('response'):
+                print(f"Shift briefing got no answer for '{question}'")
+                continue
+            self.backend.set(f"briefing:{briefing_key(question)}",
+                             {"question": question, "conversation": conversation, "computed_at": time.time()},
+                             ttl=self.max_age_minutes * 60)
+            print(f"Shift briefing for '{question}' took {time.monotonic() - started:.0f}s")
+
+    def lookup(self, question):
+        """Returns the stored briefing of a question, None if there is no fresh one
+
+        Returns:
+          (dict) question, conversation and computed_at (epoch seconds) of the briefing
+        """
+        briefing = self.backend.get(f"briefing:{briefing_key(question)}")
+        if briefing is None or time.time() - briefing["computed_at"] > self.max_age_minutes * 60:
+            return None
+        return briefing
@@ -0,0 +1,219 @@
+import time
+import threading
+
+from collections import deque, OrderedDict
+
+from kibana_client import kibana_client
+
+
+class ConnectorStats:
+    """Rolling time-to-first-event and error samples for a single GenAI connector"""
+
+    def __init__(self, window):
+        self.first_event_seconds = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.last_used = 0.0
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def median_first_event(self):
+        if not self.first_event_seconds:
+            return None
+        samples = sorted(self.first_event_seconds)
+        return samples[len(samples) // 2]
+
+    def percentile_first_event(self, percentile):
+        if not self.first_event_seconds:
+            return None
+        samples = sorted(self.first_event_seconds)
+        return samples[min(len(samples) - 1, int(len(samples) * percentile))]
+
+
+class ConnectorRouter:
+    """Routes each assistant conversation to the healthiest, fastest GenAI connector in Kibana.
+
+    Connectors are discovered from /api/actions/connectors and scored on their rolling
+    median time-to-first-event, penalised by their recent error rate. Connectors that have
+    no recent samples score best so they get (re)probed, as do connectors that only served
+    non-streaming calls without errors, whose latency is unknown. A conversation stays on the
+    connector it started on for as long as that connector exists.
+
+    Args:
+      (str) kibana_url: URL to Kibana instance
+      ((str, str)) auth: tuple (username, password) to access Kibana
+      (tuple) connector_types: connector types to route across, .gen-ai (OpenAI or Azure OpenAI) and/or .bedrock
+      (int) window: number of recent requests kept per connector
+      (int) stale_after: seconds after which a connector's samples are dropped and it gets probed again
+      (int) refresh_interval: seconds between connector re-discovery
+    """
+
+    def __init__(
+        self,
+        kibana_url,
+        auth,
+        connector_types=(".gen-ai", ".bedrock"),
+        window=20,
+        stale_after=600,
+        refresh_interval=300,
+        max_conversations=1000,
+    ):
+        self.kibana_url = kibana_url
+        self.auth = auth
+        self.connector_types = connector_types
+        self.window = window
+        self.stale_after = stale_after
+        self.refresh_interval = refresh_interval
+        self.max_conversations = max_conversations
+        self.connectors = {}
+        self.stats = {}
+        self._sticky = OrderedDict()
+        self._discovered_at = 0.0
+        self._lock = threading.Lock()
+
+    def discover(self):
+        """Obtains the GenAI connectors from the Kibana API
+
+        Returns:
+          (dict) connector id -> connector name
+
+        Raises:
+          Exceptions:
+           Wrong Kibana url or credentials
+           No GenAI connector
+        """
+        connectors = kibana_client(self.kibana_url, self.auth).get("/api/actions/connectors")
+        if connectors.status_code == 404:
+            raise Exception("ERROR - Wrong Kibana url or credentials")
+        elif connectors.status_code == 401:
+            raise Exception("ERROR - Unauthorized -  unable to authenticate user")
+
+        connectors_ai = {
+            conn["id"]: conn["name"]
+            for conn in connectors.json()
+            if conn["connector_type_id"] in self.connector_types
+        }
+        if len(connectors_ai) == 0:
+            raise Exception(
+                f"ERROR - No GenAI connectors found for {', '.join(self.connector_types)}, please add your GenAI connector to Kibana"
+            )
+
+        with self._lock:
+            self.connectors = connectors_ai
+            for connector_id in connectors_ai:
+                self.stats.setdefault(connector_id, ConnectorStats(self.window))
+            self._discovered_at = time.monotonic()
+        return connectors_ai
+
+    def _score(self, connector_id, now):
+        stats = self.stats[connector_id]
+        if now - stats.last_used > self.stale_after:
+            stats.first_event_seconds.clear()
+            stats.outcomes.clear()
+        median = stats.median_first_event()
+        if median is None and stats.error_rate() == 0:
+            # unprobed, or only used for non-streaming calls that have no time-to-first-event
+            return 0.0
+        # a connector that only errors has no latency samples, rank it behind everything that answers
+        if median is None:
+            median = 60.0
+        return median * (1 + 4 * stats.error_rate())
+
+    def route(self, conversation_key=None, candidates=None):
+        """Returns the connector id to use for a conversation
+
+        Args:
+          (str) conversation_key: conversation id to keep on the same connector, or None for a new conversation
+          (list) candidates: connector ids to choose from, e.g. the connectors of a model tier, all when None
+
+        Returns:
+          (str) GenAI connector id
+        """
+        if not self.connectors or time.monotonic() - self._discovered_at > self.refresh_interval:
+            self.discover()
+
+        with self._lock:
+            connectors = [c for c in self.connectors if candidates is None or c in candidates] or list(self.connectors)
+            if conversation_key is not None and conversation_key in self._sticky:
+                connector_id = self._sticky[conversation_key]
+                if connector_id in connectors:
+                    self._sticky.move_to_end(conversation_key)
+                    return connector_id
+                if connector_id not in self.connectors:
+                    del self._sticky[conversation_key]
+
+            now = time.monotonic()
+            connector_id = min(connectors, key=lambda c: self._score(c, now))
+        if conversation_key is not None:
+            self.pin(conversation_key, connector_id)
+        return connector_id
+
+    def alternate(self, connector_id):
+        """Returns the best scoring connector other than the given one, or None if there is no other connector"""
+        with self._lock:
+            now = time.monotonic()
+            others = [c for c in self.connectors if c != connector_id]
+            if not others:
+                return None
+            return min(others, key=lambda c: self._score(c, now))
+
+    def first_event_percentile(self, connector_id, percentile):
+        """Returns the given percentile of the connector's recent time-to-first-event samples
+
+        Returns:
+          (tuple) (seconds or None, number of samples)
+        """
+        with self._lock:
+            stats = self.stats.get(connector_id)
+            if stats is None:
+                return None, 0
+            return stats.percentile_first_event(percentile), len(stats.first_event_seconds)
+
+    def pin(self, conversation_key, connector_id):
+        """Keeps a conversation on a connector, e.g. once Kibana has assigned the conversation id"""
+        with self._lock:
+            self._sticky[conversation_key] = connector_id
+            self._sticky.move_to_end(conversation_key)
+            while len(self._sticky) > self.max_conversations:
+                self._sticky.popitem(last=False)
+
+    def record_first_event(self, connector_id, seconds):
+        """Records how long a request took until the first NDJSON event"""
+        with self._lock:
+            stats = self.stats.setdefault(connector_id, ConnectorStats(self.window))
+            stats.first_event_seconds.append(seconds)
+            stats.last_used = time.monotonic()
+
+    def record_success(self, connector_id):
+        """Records a request that completed successfully"""
+        with self._lock:
+            stats = self.stats.setdefault(connector_id, ConnectorStats(self.window))
+            stats.outcomes.append(True)
+            stats.last_used = time.monotonic()
+
+    def record_error(self, connector_id):
+        """Records a failed request, error status code or broken stream"""
+        with self._lock:
+            stats = self.stats.setdefault(connector_id, ConnectorStats(self.window))
+            stats.outcomes.append(False)
+            stats.last_used = time.monotonic()
+
+    def report(self):
+        """Returns the current routing view of every connector
+
+        Returns:
+          (list) dicts with id, name, median time-to-first-event, error rate and sample count
+        """
+        with self._lock:
+            return [
+                {
+                    "id": connector_id,
+                    "name": name,
+                    "median_first_event": self.stats[connector_id].median_first_event(),
+                    "error_rate": self.stats[connector_id].error_rate(),
+                    "samples": len(self.stats[connector_id].outcomes),
+                }
+                for connector_id, name in self.connectors.items()
+            ]
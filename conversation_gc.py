@@ -0,0 +1,207 @@
+"""Garbage collection of the conversations the bots persist in the Observability AI Assistant.
+
+Every persisted bot interaction creates or extends a stored conversation, which slows down the AI
+Assistant UI and the conversation APIs as the store grows. This lists the conversations of the bot
+user, and deletes the ones not updated within the retention period, optionally archiving each one
+to a JSON file first. Deletes run with bounded concurrency.
+
+The conversations API only lists the newest conversations, so the expired ones are paged oldest
+first from the conversations index, through Kibana's console proxy with the same credentials.
+When the index can not be read the API listing is used, and the run fails if expired
+conversations may be hidden behind newer ones.
+
+    python conversation_gc.py --creds .creds-obsburger-eden --retention-days 14 --archive-dir archive/ --workers 4
+
+--dry-run only reports what would be deleted.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from kibana_client import kibana_client, kibana_auth
+
+list_path = "/internal/observability_ai_assistant/conversations"
+conversation_path = "/internal/observability_ai_assistant/conversation/{}"
+conversations_index = ".kibana-observability-ai-assistant-conversations"
+search_path = f"/api/console/proxy?path={conversations_index}/_search&method=POST"
+
+# the conversations API returns at most this many conversations, newest first
+listing_cap = 100
+
+
+def parse_timestamp(timestamp):
+    return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+
+def list_conversations(client):
+    """Returns the conversations visible to the client's user
+
+    Raises:
+      RuntimeError when Kibana does not list them
+    """
+    response = client.post(list_path, json.dumps({"query": ""}), idempotent=True)
+    if response.status_code != 200:
+        raise RuntimeError(f"Listing conversations failed with status {response.status_code}: {response.text[:500]}")
+    return response.json().get("conversations", [])
+
+
+def search_expired(client, user, cutoff, page_size=100, search_after=None):
+    """Returns a page of the user's conversations last updated before the cutoff, oldest first
+
+    Args:
+      (str) user: owner of the conversations
+      (datetime) cutoff: conversations updated before it are returned
+      (int) page_size: conversations per page
+      (list) search_after: sort values of the last conversation of the previous page
+
+    Returns:
+      (tuple) (conversations, search_after of the next page), None when the index can not be searched
+    """
+    query = {
+        "size": page_size,
+        "query": {"bool": {"filter": [
+            {"term": {"user.name": user}},
+            {"range": {"conversation.last_updated": {"lt": cutoff.isoformat()}}},
+        ]}},
+        "sort": [{"conversation.last_updated": "asc"}, {"conversation.id": "asc"}],
+    }
+    if search_after is not None:
+        query["search_after"] = search_after
+    response = client.post(search_path, json.dumps(query), idempotent=True)
+    if response.status_code != 200:
+        print(f"Searching {conversations_index} failed with status {response.status_code}: {response.text[:200]}")
+        return None
+    hits = response.json().get("hits", {}).get("hits", [])
+    return [hit["_source"] for hit in hits], (hits[-1]["sort"] if hits else search_after)
+
+
+def expired(conversations, user, cutoff):
+    """Returns the conversations of the user last updated before the cutoff"""
+    selected = []
+    for conversation in conversations:
+        if (conversation.get("user") or {}).get("name") != user:
+            continue
+        updated = conversation.get("conversation", {}).get("last_updated") or conversation.get("@timestamp")
+        if updated and parse_timestamp(updated) < cutoff:
+            selected.append(conversation)
+    return selected
+
+
+def collect(client, conversation, archive_dir=None):
+    """Archives a conversation if asked to, then deletes it
+
+    Returns:
+      (boolean) True if it was archived
+    """
+    conversation_id = conversation["conversation"]["id"]
+    archived = False
+    if archive_dir is not None:
+        # the listing may leave out messages, the archive holds the conversation as Kibana returns it
+        response = client.get(conversation_path.format(conversation_id))
+        if response.status_code != 200:
+            raise RuntimeError(f"Fetching {conversation_id} failed with status {response.status_code}")
+        with open(os.path.join(archive_dir, f"{conversation_id}.json"), 'w') as file:
+            json.dump(response.json(), file)
+        archived = True
+    response = client.request("DELETE", conversation_path.format(conversation_id), idempotent=True)
+    if response.status_code not in (200, 204, 404):
+        raise RuntimeError(f"Deleting {conversation_id} failed with status {response.status_code}")
+    return archived
+
+
+def gc(client, user, retention_days, archive_dir=None, workers=4, dry_run=False, page_size=100):
+    """Deletes the user's conversations not updated within the retention period
+
+    Returns:
+      (dict) counts of listed, expired, deleted, archived and failed conversations, the seconds taken,
+        and unreachable when expired conversations may have been left behind newer ones
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    stats = {"listed": 0, "expired": 0, "deleted": 0, "archived": 0, "failed": 0, "unreachable": False}
+    started = time.monotonic()
+    listed = set()
+    # deleted conversations may still be listed until the index refreshes, each one is handled once
+    seen = set()
+    search_after = None
+    use_index = True
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            page = search_expired(client, user, cutoff, page_size, search_after) if use_index else None
+            if page is not None:
+                conversations, search_after = page
+                candidates = conversations
+                more = len(conversations) == page_size
+            else:
+                if use_index:
+                    print("Falling back to the conversations API, it only lists the newest conversations")
+                    use_index = False
+                conversations = list_conversations(client)
+                candidates = expired(conversations, user, cutoff)
+                # a full listing without anything expired may still hide older conversations
+                more = False
+                if not any(c["conversation"]["id"] not in seen for c in candidates) and len(conversations) >= listing_cap:
+                    print(f"The conversations API lists only the newest {listing_cap} conversations, "
+                          f"older ones of {user} could not be reached")
+                    stats["unreachable"] = True
+            listed.update(c["conversation"]["id"] for c in conversations)
+            stats["listed"] = len(listed)
+            candidates = [c for c in candidates if c["conversation"]["id"] not in seen]
+            stats["expired"] += len(candidates)
+            seen.update(c["conversation"]["id"] for c in candidates)
+            if dry_run:
+                for conversation in candidates:
+                    print(f"Would delete {conversation['conversation']['id']} "
+                          f"{conversation['conversation'].get('title')!r} ({conversation['conversation'].get('last_updated')})")
+                if use_index and more:
+                    continue
+                break
+            if not candidates:
+                break
+            futures = {pool.submit(collect, client, conversation, archive_dir): conversation for conversation in candidates}
+            for future in as_completed(futures):
+                conversation_id = futures[future]["conversation"]["id"]
+                try:
+                    stats["archived"] += future.result()
+                    stats["deleted"] += 1
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"Could not collect {conversation_id}: {e}")
+            print(f"Deleted {stats['deleted']} conversations so far")
+            if use_index and not more:
+                break
+    stats["seconds"] = round(time.monotonic() - started, 1)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deletes or archives old conversations persisted by the bots")
+    parser.add_argument("--creds", required=True, help="creds file with kibana_url and username and password or kibana_api_key")
+    parser.add_argument("--user", help="owner of the conversations to collect, defaults to the creds user")
+    parser.add_argument("--retention-days", type=float, default=30)
+    parser.add_argument("--archive-dir", help="write every conversation to this directory before deleting it")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    with open(args.creds, 'r') as file:
+        creds = json.load(file)
+    client = kibana_client(creds['kibana_url'], kibana_auth(creds))
+    if args.archive_dir:
+        os.makedirs(args.archive_dir, exist_ok=True)
+
+    # with an API key the owner is whoever the key authenticates as
+    user = args.user or creds.get('username') or (client.validate() or {}).get('username')
+    stats = gc(client, user, args.retention_days, args.archive_dir, args.workers, args.dry_run)
+    print(f"{stats['expired']} conversations older than {args.retention_days} days, {stats['deleted']} deleted, "
+          f"{stats['archived']} archived, {stats['failed']} failed in {stats['seconds']}s "
+          f"({stats['deleted'] / max(stats['seconds'], 1e-9):.1f} conversations/s)")
+    return 1 if stats["failed"] or stats["unreachable"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
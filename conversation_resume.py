@@ -0,0 +1,100 @@
+import requests
+
+from kibana_client import kibana_client, KibanaUnavailable
+
+
+def get_persisted_conversation(kibana_url, auth, conversation_id, deadline=None):
+    """Obtains a persisted conversation from the Observability AI Assistant API
+
+    Args:
+      (str) kibana_url: URL to Kibana instance
+      ((str, str)) auth: tuple (username, password) to access Kibana
+      (str) conversation_id: id of the persisted conversation
+      (Deadline) deadline: overall deadline of the user request, optional
+
+    Returns:
+      (dict) the conversation, or None if it could not be fetched
+    """
+    try:
+        response = kibana_client(kibana_url, auth).get(
+            f"/internal/observability_ai_assistant/conversation/{conversation_id}",
+            deadline=deadline,
+        )
+    except (KibanaUnavailable, requests.exceptions.RequestException) as e:
+        print(f"Could not fetch conversation {conversation_id}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Could not fetch conversation {conversation_id}: status code {response.status_code}")
+        return None
+    return response.json()
+
+
+def messages_after(conversation, user_message):
+    """Returns the messages a persisted conversation holds after the given user message,
+    i.e. what the assistant already produced for that question
+
+    Args:
+      (dict) conversation: persisted conversation
+      (dict) user_message: the user message of the interrupted turn, with @timestamp and message
+
+    Returns:
+      (list) messages after the user message, empty if the user message is not in the conversation
+    """
+    messages = conversation.get("messages", [])
+    # Kibana may normalise the timestamp, so fall back to the last user message with the same content
+    for match_timestamp in (True, False):
+        for index in range(len(messages) - 1, -1, -1):
+            message = messages[index]
+            if (
+                message.get("message", {}).get("role") == "user"
+                and message.get("message", {}).get("content") == user_message["message"]["content"]
+                and (not match_timestamp or message.get("@timestamp") == user_message["@timestamp"])
+            ):
+                return messages[index + 1:]
+    return []
+
+
+def is_final_answer(message):
+    """Returns True if the message is an assistant answer rather than a function call,
+    meaning there is nothing left to resume"""
+    message = message.get("message", {})
+    return (
+        message.get("role") == "assistant"
+        and not (message.get("function_call") or {}).get("name")
+        and message.get("content") not in (None, "", "[]")
+    )
+
+
+def created_conversation_id(events):
+    """Returns the id of the conversation a chat/complete stream created, None if it created none
+
+    Args:
+      (list) events: chat/complete events received so far
+    """
+    for event in events:
+        if isinstance(event, dict) and event.get("type") == "conversationCreate":
+            return event["conversation"]["id"]
+    return None
+
+
+def resume_request(data, history, user_message, produced, events, conversation_id=None):
+    """Returns the chat/complete request body that resumes a broken turn after the produced messages.
+    A stream that created its persisted conversation before it broke is resumed in that
+    conversation, instead of making Kibana create a second one.
+
+    Args:
+      (dict) data: request body of the broken attempt
+      (list) history: messages of the conversation before the user message
+      (dict) user_message: the user message of the interrupted turn
+      (list) produced: messages the assistant already produced for the question
+      (list) events: chat/complete events received so far
+      (str) conversation_id: id of the conversation before the turn, None for a new one
+
+    Returns:
+      (dict) request body for the resend
+    """
+    data = dict(data, messages=history + [user_message] + produced)
+    conversation_id = created_conversation_id(events) or conversation_id
+    if data.get("persist") and conversation_id is not None:
+        data["conversationId"] = conversation_id
+    return data
@@ -0,0 +1,388 @@
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import threading
+
+from contextlib import contextmanager, asynccontextmanager
+
+
+class CoordinationBackend:
+    """Shared state of the bot replicas: conversation state, event dedupe, per-channel locks
+    and interaction counters. Values are anything JSON serialisable.
+
+    Implementations provide get, set, delete, add (set if absent) and incr, the locking
+    is built on top of add so it works the same for every backend.
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key, value=None):
+        """Deletes the key, only if it still holds value when one is given"""
+        raise NotImplementedError
+
+    def add(self, key, value=True, ttl=None):
+        """Sets the key only if it does not exist yet
+
+        Returns:
+          (boolean) True if the key was set
+        """
+        raise NotImplementedError
+
+    def incr(self, key, amount=1, ttl=None):
+        """Adds amount to the key, a missing key counts from 0 and gets the ttl
+
+        Returns:
+          (int) the new value
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, name, ttl=600, timeout=None, poll_interval=0.1):
+        """Holds a lock shared by every replica. The ttl frees the lock if its holder dies.
+
+        Raises:
+          TimeoutError if the lock could not be acquired within timeout seconds
+        """
+        token = uuid.uuid4().hex
+        key = f"lock:{name}"
+        started = time.monotonic()
+        while not self.add(key, token, ttl=ttl):
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"Could not acquire lock {name} within {timeout}s")
+            time.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            self.delete(key, token)
+
+    @asynccontextmanager
+    async def async_lock(self, name, ttl=600, timeout=None, poll_interval=0.1):
+        """Same lock as lock(), waiting on the event loop instead of blocking the thread.
+        The backend calls run on the loop's default executor, SQLite and Redis block on I/O."""
+        loop = asyncio.get_running_loop()
+        token = uuid.uuid4().hex
+        key = f"lock:{name}"
+        started = time.monotonic()
+        while not await loop.run_in_executor(None, lambda: self.add(key, token, ttl=ttl)):
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise TimeoutError(f"Could not acquire lock {name} within {timeout}s")
+            await asyncio.sleep(poll_interval)
+        try:
+            yield
+        finally:
+            await loop.run_in_executor(None, self.delete, key, token)
+
+
+class MemoryBackend(CoordinationBackend):
+    """In-process backend, the default for a single replica
+
+    Args:
+      (float) sweep_interval: seconds between two purges of the expired keys, e.g. deduped event ids
+    """
+
+    def __init__(self, sweep_interval=60):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+
+    def _sweep(self, now):
+        # keys that are never read again would otherwise only expire on read, i.e. never
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for key in [key for key, (_, expires_at) in self._data.items() if expires_at is not None and expires_at <= now]:
+            del self._data[key]
+
+    def _alive(self, key, now):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._alive(key, time.time())
+            return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            self._data[key] = (value, now + ttl if ttl else None)
+
+    def delete(self, key, value=None):
+        with self._lock:
+            entry = self._alive(key, time.time())
+            if entry is not None and (value is None or entry[0] == value):
+                del self._data[key]
+
+    def add(self, key, value=True, ttl=None):
+        with self._lock:
+            now = time.time()
+            self._sweep(now)
+            if self._alive(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            now = time.time()
+            entry = self._alive(key, now)
+            value = (entry[0] if entry else 0) + amount
+            self._data[key] = (value, entry[1] if entry else (now + ttl if ttl else None))
+            return value
+
+
+class SQLiteBackend(CoordinationBackend):
+    """Single-host backend shared by several processes through one SQLite file.
+    Write transactions take SQLite's file lock (BEGIN IMMEDIATE), which makes add and incr atomic across processes.
+
+    Args:
+      (str) path: SQLite file shared by the replicas
+      (float) sweep_interval: seconds between two purges of the expired keys by this process
+    """
+
+    def __init__(self, path, sweep_interval=60):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._next_sweep = time.time() + sweep_interval
+        self._local = threading.local()
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS coordination (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+        )
+        self._db().execute("CREATE INDEX IF NOT EXISTS coordination_expires_at ON coordination (expires_at)")
+
+    def _sweep(self, now):
+        # expired keys that are never written again, e.g. deduped event ids, are purged here
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        self._db().execute("DELETE FROM coordination WHERE expires_at <= ?", (now,))
+
+    def _db(self):
+        # sqlite connections can not be shared between the handler threads
+        if getattr(self._local, "db", None) is None:
+            self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db.execute("PRAGMA journal_mode=WAL")
+        return self._local.db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def get(self, key, default=None):
+        row = self._db().execute(
+            "SELECT value FROM coordination WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self._sweep(now)
+        self._db().execute(
+            "INSERT OR REPLACE INTO coordination (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), now + ttl if ttl else None),
+        )
+
+    def delete(self, key, value=None):
+        if value is None:
+            self._db().execute("DELETE FROM coordination WHERE key = ?", (key,))
+        else:
+            self._db().execute("DELETE FROM coordination WHERE key = ? AND value = ?", (key, json.dumps(value)))
+
+    def add(self, key, value=True, ttl=None):
+        now = time.time()
+        self._sweep(now)
+        with self._transaction() as db:
+            db.execute("DELETE FROM coordination WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO coordination (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), now + ttl if ttl else None),
+            )
+            return cursor.rowcount == 1
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT value, expires_at FROM coordination WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, now),
+            ).fetchone()
+            value = (json.loads(row[0]) if row else 0) + amount
+            db.execute(
+                "INSERT OR REPLACE INTO coordination (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), row[1] if row else (now + ttl if ttl else None)),
+            )
+            return value
+
+
+class RedisBackend(CoordinationBackend):
+    """Multi-host backend speaking the Redis protocol (RESP) directly over a socket,
+    so it works against Redis, Valkey or any local stand-in implementing GET/SET/DEL/INCRBY and
+    the compare and delete and increment with expiry scripts.
+
+    Args:
+      (str) host: Redis host
+      (int) port: Redis port
+      (int) db: database number
+      (str) password: password for AUTH, optional
+      (str) prefix: prefix of every key, so several bots can share a Redis
+    """
+
+    COMPARE_AND_DELETE = (
+        "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) else return 0 end"
+    )
+    INCR_WITH_EXPIRY = (
+        "local created = redis.call('EXISTS', KEYS[1]) == 0 "
+        "local value = redis.call('INCRBY', KEYS[1], ARGV[1]) "
+        "if created then redis.call('PEXPIRE', KEYS[1], ARGV[2]) end "
+        "return value"
+    )
+
+    def __init__(self, host="127.0.0.1", port=6379, db=0, password=None, prefix="obsburger:", timeout=10):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, "file", None) is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self._local.file = sock.makefile("rwb")
+            if self.password:
+                self._send("AUTH", self.password)
+            if self.db:
+                self._send("SELECT", self.db)
+        return self._local.file
+
+    def _read_reply(self, file):
+        line = file.readline()
+        if not line:
+            raise ConnectionError("Redis closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {rest.decode('utf-8')}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            data = file.read(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(rest)
+            return None if length == -1 else [self._read_reply(file) for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _send(self, *args):
+        file = self._local.file
+        payload = [f"*{len(args)}\r\n".encode("utf-8")]
+        for arg in args:
+            data = str(arg).encode("utf-8")
+            payload.append(f"${len(data)}\r\n".encode("utf-8") + data + b"\r\n")
+        file.write(b"".join(payload))
+        file.flush()
+        return self._read_reply(file)
+
+    def _command(self, *args):
+        # reconnect once, e.g. after a Redis restart
+        for attempt in range(2):
+            try:
+                self._connection()
+                return self._send(*args)
+            except (OSError, ConnectionError):
+                self._local.file = None
+                if attempt == 1:
+                    raise
+
+    def get(self, key, default=None):
+        value = self._command("GET", self.prefix + key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        args = ["SET", self.prefix + key, json.dumps(value)]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        self._command(*args)
+
+    def delete(self, key, value=None):
+        if value is None:
+            self._command("DEL", self.prefix + key)
+        else:
+            # atomic on the server, a lock that expired and was taken over by another replica is left alone
+            self._command("EVAL", self.COMPARE_AND_DELETE, 1, self.prefix + key, json.dumps(value))
+
+    def add(self, key, value=True, ttl=None):
+        args = ["SET", self.prefix + key, json.dumps(value), "NX"]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        return self._command(*args) == "OK"
+
+    def incr(self, key, amount=1, ttl=None):
+        if not ttl:
+            return self._command("INCRBY", self.prefix + key, amount)
+        # atomic on the server, the key created by this increment can not be left without its expiry
+        return self._command("EVAL", self.INCR_WITH_EXPIRY, 1, self.prefix + key, amount, int(ttl * 1000))
+
+
+def coordination_backend(creds):
+    """Builds the coordination backend configured in a creds file, e.g.
+      "coordination": {"backend": "sqlite", "path": ".obsburger-coordination.sqlite"}
+      "coordination": {"backend": "redis", "host": "127.0.0.1", "port": 6379}
+    Without configuration the state stays in process, as for a single replica.
+
+    Args:
+      (dict) creds: loaded creds file
+
+    Returns:
+      (CoordinationBackend) the backend
+    """
+    config = dict(creds.get('coordination') or {})
+    backend = config.pop('backend', 'memory')
+    if backend == 'sqlite':
+        return SQLiteBackend(config.get('path', '.obsburger-coordination.sqlite'))
+    if backend == 'redis':
+        return RedisBackend(**config)
+    return MemoryBackend()
+
+
+def channel_locked(backend, task, ttl=600):
+    """Wraps task(channel_id, ...) so it holds the channel's lock while it runs,
+    i.e. a channel is worked on by one thread of one replica at a time
+
+    Args:
+      (CoordinationBackend) backend: shared backend of the replicas
+      (callable) task: function taking the channel id as first argument
+      (float) ttl: seconds after which the lock of a crashed replica is released
+
+    Returns:
+      (callable) the wrapped task
+    """
+    def locked(channel_id, *args, **kwargs):
+        with backend.lock(f"channel:{channel_id}", ttl=ttl):
+            return task(channel_id, *args, **kwargs)
+    return locked
@@ -0,0 +1,56 @@
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import messages_from_dict, messages_to_dict
+
+
+class CoordinatedChatMessageHistory(BaseChatMessageHistory):
+    """LangChain message history kept in the coordination backend, so every replica of a
+    persona continues the same conversation memory instead of its own process-local one.
+
+    Use it as chat_memory of the persona's ConversationBufferMemory.
+
+    Args:
+      (CoordinationBackend) backend: shared backend of the replicas
+      (str) persona: persona name, the key prefix of its memory
+      (SnapshotStore) snapshots: keeps the memory across restarts, optional
+    """
+
+    def __init__(self, backend, persona, snapshots=None):
+        self.backend = backend
+        self.key = f"{persona}:memory"
+        self.snapshots = snapshots
+        self._restored = snapshots is None
+
+    def _restore(self):
+        # the first use after a restart brings the memory back from the snapshots, unless a replica still has it
+        if self._restored:
+            return
+        with self.backend.lock(self.key, ttl=30):
+            if self.backend.get(self.key) is None:
+                stored = self.snapshots.load(self.key)
+                if stored:
+                    self.backend.set(self.key, stored)
+                    self.snapshots.compact(self.key, *stored)
+            self._restored = True
+
+    @property
+    def messages(self):
+        self._restore()
+        return messages_from_dict(self.backend.get(self.key, []))
+
+    def add_messages(self, messages):
+        self._restore()
+        added = messages_to_dict(messages)
+        # read-modify-write, so hold the persona's memory lock while appending
+        with self.backend.lock(self.key, ttl=30):
+            stored = self.backend.get(self.key, [])
+            self.backend.set(self.key, stored + added)
+        if self.snapshots is not None:
+            self.snapshots.append(self.key, *added)
+
+    def add_message(self, message):
+        self.add_messages([message])
+
+    def clear(self):
+        self.backend.delete(self.key)
+        if self.snapshots is not None:
+            self.snapshots.clear(self.key)
@@ -0,0 +1,168 @@
+import json
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from ai_assistant.utils import ask_assistant
+from kibana_client import KibanaUnavailable, kibana_auth
+
+
+def load_clusters(entries, model=".gen-ai"):
+    """Reads the Kibana deployments a question fans out to
+
+    Args:
+      (list) entries: creds file paths like '.creds-obsburger-eden', or dicts with
+        "name", "kibana_url", "username" and "password" or "kibana_api_key",
+        and optionally "model"
+      (str) model: connector type used when an entry does not name one
+
+    Returns:
+      (list) dicts with name, kibana_url, auth and model per cluster
+    """
+    clusters = []
+    for entry in entries:
+        if isinstance(entry, str):
+            with open(entry, 'r') as file:
+                cluster = json.load(file)
+            cluster.setdefault("name", entry.lstrip('.').replace('creds-', '', 1))
+        else:
+            cluster = dict(entry)
+        clusters.append({
+            "name": cluster.get("name") or cluster["kibana_url"],
+            "kibana_url": cluster["kibana_url"],
+            "auth": kibana_auth(cluster),
+            "model": cluster.get("model", model),
+        })
+    return clusters
+
+
+class FanoutProgress:
+    """Per-cluster status of a fanned out question, rendered as one Slack message
+    that is edited in place as the clusters make progress.
+
+    Args:
+      (list) names: cluster names
+      (callable) update: called with the rendered text, e.g. a chat_update of the status message
+      (float) min_interval: least seconds between two updates, Slack rate limits chat.update
+    """
+
+    def __init__(self, names, update=None, min_interval=1.0):
+        self.status = {name: "waiting" for name in names}
+        self.update = update
+        self.min_interval = min_interval
+        self._last_update = 0.0
+        self._lock = threading.Lock()
+
+    def set(self, name, status, force=False):
+        with self._lock:
+            self.status[name] = status
+            now = time.monotonic()
+            if self.update is None or (not force and now - self._last_update < self.min_interval):
+                return
+            self._last_update = now
+            text = self.render()
+        try:
+            self.update(text)
+        except Exception as e:
+            # a failed status edit must not fail the question
+            print(f"Fan-out progress update failed: {e}")
+
+    def render(self):
+        return "\n".join(f"*{name}*: {status}" for name, status in self.status.items())
+
+
+def ask_cluster(cluster, question, deadline_seconds=600, progress=None):
+    """Asks one cluster's AI Assistant, streaming, reporting its function calls as progress
+
+    Returns:
+      (dict) name, answer, error and seconds of the cluster
+    """
+    name = cluster["name"]
+
+    def on_event(response_json):
+        if progress is None or response_json.get("type") != "messageAdd":
+            return
+        function_call = response_json["message"]["message"].get("function_call") or {}
+        if function_call.get("name"):
+            progress.set(name, f"calling `{function_call['name']}`")
+
+    if progress is not None:
+        progress.set(name, "asking")
+    started = time.monotonic()
+    answer, error = None, None
+    try:
+        response = ask_assistant(
+            kibana_url=cluster["kibana_url"],
+            auth=cluster["auth"],
+            model=cluster["model"],
+            user_question=question,
+            streaming=True,
+            deadline_seconds=deadline_seconds,
+            on_event=on_event,
+        )
+        if response["conversationId"] == "ERROR":
+            error = response["response"]
+        else:
+            answer = response["response"]
+    except (KibanaUnavailable, requests.exceptions.RequestException) as e:
+        error = str(e)
+    seconds = time.monotonic() - started
+    if progress is not None:
+        progress.set(name, f"failed after {seconds:.0f}s" if error else f"answered in {seconds:.0f}s", force=True)
+    return {"name": name, "answer": answer, "error": error, "seconds": seconds}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _fanout_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+        return _pool
+
+
+def fan_out(clusters, question, deadline_seconds=600, progress=None, workers=8):
+    """Sends one question to every cluster at once. Each cluster uses its own pooled
+    Kibana client and connector, so the whole fan-out takes as long as the slowest cluster.
+
+    Args:
+      (list) clusters: clusters from load_clusters
+      (str) question: the question
+      (int) deadline_seconds: time budget of every cluster's question
+      (FanoutProgress) progress: per-cluster status, optional
+      (int) workers: size of the thread pool shared by every fan-out
+
+    Returns:
+      (list) results of ask_cluster, in the order of the clusters
+    """
+    pool = _fanout_pool(workers)
+    futures = {
+        pool.submit(ask_cluster, cluster, question, deadline_seconds, progress): cluster["name"]
+        for cluster in clusters
+    }
+    results = {}
+    for future in as_completed(futures):
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            results[name] = {"name": name, "answer": None, "error": str(e), "seconds": None}
+    return [results[cluster["name"]] for cluster in clusters]
+
+
+def merge_answers(results):
+    """Merges the answers of a fan-out into one Slack reply, one section per cluster"""
+    sections = []
+    for result in results:
+        seconds = "" if result["seconds"] is None else f" ({result['seconds']:.0f}s)"
+        body = result["answer"] if result["error"] is None else f"_No answer: {result['error']}_"
+        sections.append(f"*{result['name']}*{seconds}\n{body}")
+    timed = [result["seconds"] for result in results if result["seconds"] is not None]
+    footer = f"\n\n_Asked {len(results)} clusters in {max(timed):.0f}s, the time of the slowest_" if timed else ""
+    return "\n\n".join(sections).replace('**', '*') + footer
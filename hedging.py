@@ -0,0 +1,254 @@
+import json
+import time
+import queue
+import threading
+
+from collections import deque
+
+
+class HedgePolicy:
+    """Decides when a chat/complete request gets hedged to an alternate connector.
+
+    The hedge delay is the given percentile of the connector's recent time-to-first-event,
+    so only the slow tail of requests is duplicated. On top of that the hedges of the window
+    are budgeted to one plus max_hedge_ratio of its requests, which keeps the extra load
+    bounded during a connector-wide slowdown and still lets a quiet bot hedge.
+
+    Args:
+      (ConnectorRouter) router: source of the time-to-first-event samples and alternate connectors
+      (float) percentile: time-to-first-event percentile after which a request is hedged
+      (int) min_samples: samples needed before the percentile is trusted, default_delay is used until then
+      (float) default_delay: hedge delay in seconds while there are not enough samples
+      (float) min_delay: lower bound of the hedge delay in seconds
+      (float) max_hedge_ratio: hedges earned per recent request, on top of one always available
+      (int) window: seconds of request history the hedge budget is computed over
+    """
+
+    def __init__(
+        self,
+        router,
+        percentile=0.95,
+        min_samples=10,
+        default_delay=20.0,
+        min_delay=2.0,
+        max_hedge_ratio=0.1,
+        window=300,
+    ):
+        self.router = router
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.window = window
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._requests = deque()
+        self._hedges = deque()
+        self._lock = threading.Lock()
+
+    def delay(self, connector_id):
+        seconds, samples = self.router.first_event_percentile(connector_id, self.percentile)
+        if seconds is None or samples < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, seconds)
+
+    def _expire(self, now):
+        for timestamps in (self._requests, self._hedges):
+            while timestamps and now - timestamps[0] > self.window:
+                timestamps.popleft()
+
+    def try_hedge(self):
+        """Returns True, and counts the hedge, if the hedge budget allows another duplicate request"""
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if len(self._hedges) >= 1 + self.max_hedge_ratio * len(self._requests):
+                return False
+            self._hedges.append(now)
+            self.hedges_sent += 1
+            return True
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._requests.append(now)
+
+    def record_hedge_won(self):
+        with self._lock:
+            self.hedges_won += 1
+
+
+class _StreamWorker(threading.Thread):
+    """Reads one chat/complete NDJSON stream and forwards its lines to the shared queue"""
+
+    def __init__(self, tag, events, client, path, data, connector_id, router, deadline):
+        super().__init__(daemon=True)
+        self.tag = tag
+        self.events = events
+        self.client = client
+        self.path = path
+        self.data = data
+        self.connector_id = connector_id
+        self.router = router
+        self.deadline = deadline
+        self.cancelled = threading.Event()
+        self.response = None
+
+    def run(self):
+        started = time.monotonic()
+        first = True
+        try:
+            with self.client.post(self.path, self.data, stream=True, deadline=self.deadline) as response:
+                self.response = response
+                if self.cancelled.is_set():
+                    return
+                if response.status_code != 200:
+                    self.router.record_error(self.connector_id)
+                    self.events.put((self.tag, "status", response.status_code))
+                    return
+                for line in self.client.iter_lines(response, self.deadline):
+                    if self.cancelled.is_set():
+                        return
+                    if line:  # Ignore keep-alive new lines
+                        if first:
+                            self.router.record_first_event(self.connector_id, time.monotonic() - started)
+                            first = False
+                        self.events.put((self.tag, "line", line))
+            self.router.record_success(self.connector_id)
+            self.events.put((self.tag, "end", None))
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.router.record_error(self.connector_id)
+                self.events.put((self.tag, "error", e))
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+
+
+class HedgedStream:
+    """Drop-in replacement for a streaming requests.post to chat/complete that hedges slow requests.
+
+    If the primary connector has not produced its first NDJSON event within the policy's
+    delay, a duplicate request with "persist": false goes to an alternate connector. The
+    first stream to produce an event wins and the other one is cancelled. When the hedge
+    wins the turn is not persisted in Kibana, check `hedged` to tell.
+
+    Usage mirrors requests:
+      with HedgedStream(client, path, data, connector_id, policy, deadline) as response:
+          if response.status_code == 200:
+              for line in response.iter_lines(): ...
+    """
+
+    def __init__(self, client, path, data, connector_id, policy, deadline=None):
+        self.client = client
+        self.path = path
+        self.data = data
+        self.deadline = deadline
+        self.router = policy.router
+        self.policy = policy
+        self.connector_id = connector_id
+        self.status_code = None
+        self.hedged = False
+        self.text = ""
+        self._events = queue.Queue()
+        self._workers = {}
+        self._winner = None
+        self._first_line = None
+        self._error = None
+
+    def _start(self, tag, data, connector_id):
+        worker = _StreamWorker(
+            tag, self._events, self.client, self.path, data, connector_id, self.router, self.deadline
+        )
+        self._workers[tag] = worker
+        worker.start()
+
+    def _hedge_payload(self, alternate):
+        payload = json.loads(self.data)
+        payload["connectorId"] = alternate
+        payload["persist"] = False
+        payload.pop("conversationId", None)
+        return json.dumps(payload)
+
+    def __enter__(self):
+        self.policy.record_request()
+        self._start("primary", self.data, self.connector_id)
+        hedge_at = time.monotonic() + self.policy.delay(self.connector_id)
+        finished = {}
+
+        while self._winner is None:
+            timeout = None
+            if "hedge" not in self._workers and hedge_at is not None:
+                timeout = max(0.0, hedge_at - time.monotonic())
+            try:
+                tag, kind, value = self._events.get(timeout=timeout)
+            except queue.Empty:
+                hedge_at = None
+                alternate = self.router.alternate(self.connector_id)
+                if alternate is not None and self.policy.try_hedge():
+                    print(f"Hedging chat/complete from connector {self.connector_id} to {alternate}")
+                    self._start("hedge", self._hedge_payload(alternate), alternate)
+                continue
+
+            if kind == "line":
+                self._winner = tag
+                self._first_line = value
+            else:
+                finished[tag] = (kind, value)
+                # a primary that fails before the hedge delay is not hedged, and once every stream
+                # has failed the primary's failure is surfaced like a plain request would
+                if all(t in finished for t in self._workers):
+                    self._winner = "primary"
+                    kind, value = finished["primary"]
+                    if kind == "status":
+                        self.status_code = value
+                    elif kind == "error":
+                        self._error = value
+                    else:
+                        self.status_code = 200
+                    return self
+
+        self.status_code = 200
+        self._cancel_others()
+        if self._winner == "hedge":
+            self.hedged = True
+            self.connector_id = self._workers["hedge"].connector_id
+            self.policy.record_hedge_won()
+        return self
+
+    def _cancel_others(self):
+        for tag, worker in self._workers.items():
+            if tag != self._winner:
+                worker.cancel()
+
+    def iter_lines(self):
+        if self._error is not None:
+            raise self._error
+        if self._first_line is None:
+            return
+        yield self._first_line
+        while True:
+            tag, kind, value = self._events.get()
+            if tag != self._winner:
+                continue
+            if kind == "line":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    def close(self):
+        for worker in self._workers.values():
+            worker.cancel()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
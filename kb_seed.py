@@ -0,0 +1,173 @@
+"""Bulk seeding of the Observability AI Assistant knowledge base, so "recall" finds runbooks and past
+issues without teaching them to the assistant one conversation at a time.
+
+Chunks every text file of a directory, and imports the chunks in batches with concurrent calls to
+the knowledge base import API. A checkpoint file records the chunks already imported, so an
+interrupted run picks up where it stopped and a rerun only sends new or changed chunks.
+
+    python kb_seed.py runbooks/ --creds .creds-obsburger-eden --batch-size 50 --workers 4
+
+Chunk ids are derived from the file path and the chunk's position, so reimporting a changed file
+overwrites its entries instead of adding duplicates.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from kibana_client import kibana_client, kibana_auth
+
+import_path = "/internal/observability_ai_assistant/kb/entries/import"
+
+text_extensions = (".md", ".txt", ".rst", ".adoc", ".json")
+
+
+def chunk_text(text, max_chars=2000):
+    """Splits a text into chunks of whole paragraphs of up to max_chars, longer paragraphs are cut
+
+    Returns:
+      (list) chunks
+    """
+    chunks = []
+    current = ""
+    for paragraph in (p.strip() for p in text.split("\n\n")):
+        if not paragraph:
+            continue
+        while len(paragraph) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + 2 + len(paragraph) > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def load_entries(directory, max_chars=2000):
+    """Reads and chunks the text files of a directory
+
+    Returns:
+      (list) knowledge base entries with "id" and "text"
+    """
+    entries = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith(text_extensions):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory)
+            with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                chunks = chunk_text(file.read(), max_chars)
+            for index, chunk in enumerate(chunks):
+                # the file name leads every chunk, it is the best hint recall has about the topic
+                entries.append({"id": f"{relative}#{index}", "text": f"{relative}\n\n{chunk}"})
+    return entries
+
+
+def entry_hash(entry):
+    return hashlib.sha256(entry["text"].encode("utf-8")).hexdigest()
+
+
+class Checkpoint:
+    """Chunk ids and content hashes already imported, saved to a JSON file after every batch
+
+    Args:
+      (str) path: checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.done = json.load(file)
+
+    def pending(self, entries):
+        return [entry for entry in entries if self.done.get(entry["id"]) != entry_hash(entry)]
+
+    def record(self, batch):
+        with self._lock:
+            for entry in batch:
+                self.done[entry["id"]] = entry_hash(entry)
+            # written to a temporary file first, so an interrupted run never leaves a truncated checkpoint
+            with open(self.path + ".tmp", 'w') as file:
+                json.dump(self.done, file)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def import_batch(client, batch):
+    """Imports one batch of entries, the import is keyed by id so it is safe to retry
+
+    Raises:
+      RuntimeError when Kibana rejects the batch
+    """
+    response = client.post(import_path, json.dumps({"entries": batch}), idempotent=True, read_timeout=120)
+    if response.status_code >= 300:
+        raise RuntimeError(f"Import failed with status {response.status_code}: {response.text[:500]}")
+
+
+def seed(client, entries, checkpoint, batch_size=50, workers=4):
+    """Imports the entries not in the checkpoint yet, in concurrent batches
+
+    Returns:
+      (tuple) (entries imported, batches failed)
+    """
+    pending = checkpoint.pending(entries)
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"{len(entries)} chunks, {len(entries) - len(pending)} already imported, "
+          f"{len(pending)} to import in {len(batches)} batches")
+    imported = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(import_batch, client, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Batch starting at {batch[0]['id']} failed: {e}")
+                continue
+            checkpoint.record(batch)
+            imported += len(batch)
+            print(f"Imported {imported}/{len(pending)} chunks")
+    return imported, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk seeding of the Observability AI Assistant knowledge base")
+    parser.add_argument("directory", help="directory of runbooks or past issue texts")
+    parser.add_argument("--creds", required=True, help="creds file with kibana_url and username and password or kibana_api_key")
+    parser.add_argument("--checkpoint", help="checkpoint file, defaults to .kb-seed-<directory>.json")
+    parser.add_argument("--max-chars", type=int, default=2000, help="largest chunk in characters")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    with open(args.creds, 'r') as file:
+        creds = json.load(file)
+    client = kibana_client(creds['kibana_url'], kibana_auth(creds))
+    name = os.path.basename(os.path.normpath(args.directory))
+    checkpoint = Checkpoint(args.checkpoint or f".kb-seed-{name}.json")
+
+    started = time.monotonic()
+    entries = load_entries(args.directory, args.max_chars)
+    imported, failed = seed(client, entries, checkpoint, args.batch_size, args.workers)
+    print(f"Imported {imported} chunks in {time.monotonic() - started:.1f}s, {failed} batches failed"
+          + (", run again to retry them" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,401 @@
+import json
+import time
+import random
+import threading
+import requests
+
+from urllib.parse import urlparse
+from requests.auth import AuthBase
+
+
+class KibanaUnavailable(Exception):
+    """Kibana could not be reached in time, the message is safe to show in Slack"""
+
+
+class CircuitOpenError(KibanaUnavailable):
+    """The circuit breaker for the Kibana host is open, the call was not attempted"""
+
+
+class DeadlineExceeded(KibanaUnavailable):
+    """The overall deadline of the user request ran out"""
+
+
+class KibanaAuthError(Exception):
+    """Kibana rejected the configured credentials"""
+
+
+class ApiKeyAuth(AuthBase):
+    """Elasticsearch API key authentication, sent as "Authorization: ApiKey <key>"
+
+    Args:
+      (str) api_key: base64 encoded API key, as returned in "encoded" by the create API key API
+    """
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def __call__(self, request):
+        request.headers["Authorization"] = f"ApiKey {self.api_key}"
+        return request
+
+    def __eq__(self, other):
+        return isinstance(other, ApiKeyAuth) and other.api_key == self.api_key
+
+    def __hash__(self):
+        return hash(("ApiKey", self.api_key))
+
+    def __repr__(self):
+        return "ApiKeyAuth(...)"
+
+
+def kibana_auth(creds):
+    """Returns the Kibana credentials of a creds file, the API key in "kibana_api_key" when
+    it is set, otherwise the tuple (username, password)"""
+    if creds.get('kibana_api_key'):
+        return ApiKeyAuth(creds['kibana_api_key'])
+    return (creds['username'], creds['password'])
+
+
+class Deadline:
+    """Overall time budget of one user request, shared by every Kibana call made for it
+
+    Args:
+      (float) seconds: time budget from now
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"ERROR - Request took longer than {self.seconds:.0f}s, giving up")
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker. After failure_threshold consecutive failures calls fail fast
+    for reset_timeout seconds, then a single probe call decides whether to close it again.
+
+    Args:
+      (str) host: Kibana host the breaker protects
+      (int) failure_threshold: consecutive failures that open the circuit
+      (float) reset_timeout: seconds the circuit stays open before a probe is let through
+    """
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._probing:
+                raise CircuitOpenError(
+                    f"ERROR - Kibana at {self.host} is not responding, failing fast for another {max(retry_in, 0):.0f}s"
+                )
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(kibana_url):
+    """Returns the circuit breaker shared by every client of a Kibana host"""
+    host = urlparse(kibana_url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+class KibanaClient:
+    """Kibana API client with timeouts, deadlines, retries and a circuit breaker.
+
+    Every call gets a connect and read timeout, so a hung Kibana node can not pin a thread.
+    Streaming calls use stream_idle_timeout as read timeout, which bounds the gap between two
+    NDJSON events. Idempotent calls (GET by default) are retried with full-jitter backoff on
+    connection errors, timeouts and 429/502/503/504. All calls go through the host's circuit breaker.
+
+    With a username and password the client logs in once and sends the Kibana session cookie
+    instead of basic auth, so Kibana does not authenticate the user against Elasticsearch on
+    every call. A 401 on the session (it expired or Kibana restarted) logs in again and the call
+    is sent once more. Deployments that refuse the login fall back to basic auth per call.
+    API keys are sent as they are, Elasticsearch caches their authentication.
+
+    Args:
+      (str) kibana_url: URL to Kibana instance
+      ((str, str) or ApiKeyAuth) auth: tuple (username, password) or API key to access Kibana
+      (float) connect_timeout: seconds to establish the connection
+      (float) read_timeout: seconds to wait for data on metadata calls
+      (float) stream_idle_timeout: seconds to wait between two chunks of a chat/complete response
+      (int) retries: retries for idempotent calls
+      (float) backoff: base backoff in seconds, doubled per retry
+      (float) max_backoff: upper bound of a single backoff
+      (boolean) session_cookie: log in once and reuse the session cookie, for username and password
+      (str) login_provider: Kibana basic auth provider to log in with, e.g. "cloud-basic" on Elastic Cloud,
+        looked up from Kibana's login page state by default
+    """
+
+    HEADERS = {
+        "kbn-xsrf": "true",
+        "Content-Type": "application/json",
+    }
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(
+        self,
+        kibana_url,
+        auth,
+        connect_timeout=5,
+        read_timeout=30,
+        stream_idle_timeout=120,
+        retries=3,
+        backoff=0.5,
+        max_backoff=8,
+        session_cookie=True,
+        login_provider=None,
+    ):
+        self.kibana_url = kibana_url.rstrip("/")
+        self.auth = auth
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stream_idle_timeout = stream_idle_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = circuit_breaker(kibana_url)
+        self.session = requests.Session()
+        self.session.headers.update(self.HEADERS)
+        self.session_cookie = session_cookie and isinstance(auth, tuple)
+        self.login_provider = login_provider
+        self._logged_in = False
+        # bumped by every login, so that concurrent 401s on the same session log in only once
+        self._login_generation = 0
+        self._login_lock = threading.Lock()
+
+    def _login(self, generation):
+        """Logs in with the username and password and keeps the session cookie, unless another
+        thread already did since the session of the given generation was used"""
+        with self._login_lock:
+            if self._login_generation != generation:
+                return
+            self.session.cookies.clear()
+            if self.login_provider is None:
+                self.login_provider = self._basic_provider()
+            username, password = self.auth
+            response = self.session.post(
+                f"{self.kibana_url}/internal/security/login",
+                data=json.dumps({
+                    "providerType": "basic",
+                    "providerName": self.login_provider,
+                    "currentURL": f"{self.kibana_url}/login",
+                    "params": {"username": username, "password": password},
+                }),
+                verify=True,
+                timeout=(self.connect_timeout, self.read_timeout),
+            )
+            self._logged_in = response.status_code in (200, 204) and len(self.session.cookies) > 0
+            if not self._logged_in:
+                print(f"Kibana login failed with status {response.status_code}, using basic auth per request")
+                if response.status_code >= 500:
+                    # Kibana is struggling, the next call tries to log in again
+                    return
+                # e.g. security disabled or no basic provider, every call sends basic auth from now on
+                self.session_cookie = False
+            self._login_generation += 1
+
+    def _basic_provider(self):
+        response = self.session.get(
+            f"{self.kibana_url}/internal/security/login_state",
+            verify=True,
+            timeout=(self.connect_timeout, self.read_timeout),
+        )
+        if response.status_code == 200:
+            for provider in response.json().get("selector", {}).get("providers", []):
+                if provider.get("type") == "basic":
+                    return provider["name"]
+        return "basic"
+
+    def _send(self, method, url, **kwargs):
+        if self.session_cookie and self._login_generation == 0:
+            self._login(0)
+        generation = self._login_generation
+        cookie = self.session_cookie and self._logged_in
+        response = self.session.request(method, url, auth=None if cookie else self.auth, **kwargs)
+        if response.status_code == 401 and cookie:
+            # the session expired, the request was not processed so it is safe to send again
+            response.close()
+            self._login(generation)
+            cookie = self.session_cookie and self._logged_in
+            response = self.session.request(method, url, auth=None if cookie else self.auth, **kwargs)
+        return response
+
+    def _timeout(self, read_timeout, deadline):
+        connect = self.connect_timeout
+        if deadline is not None:
+            deadline.check()
+            connect = min(connect, deadline.remaining())
+            read_timeout = min(read_timeout, deadline.remaining())
+        return (connect, read_timeout)
+
+    def _sleep_before_retry(self, attempt, deadline):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if deadline is not None and delay >= deadline.remaining():
+            return False
+        time.sleep(delay)
+        return True
+
+    def request(
+        self,
+        method,
+        path,
+        data=None,
+        stream=False,
+        idempotent=None,
+        read_timeout=None,
+        deadline=None,
+    ):
+        """Sends a request to Kibana
+
+        Args:
+          (str) method: HTTP method
+          (str) path: API path, e.g. /api/status
+          (str) data: request body
+          (boolean) stream: stream the response, the read timeout then becomes the stream idle timeout
+          (boolean) idempotent: allow retries, defaults to True for GET
+          (float) read_timeout: override of the read timeout
+          (Deadline) deadline: overall deadline of the user request
+
+        Returns:
+          (requests.Response) the response, whatever its status code
+
+        Raises:
+          Exceptions:
+           CircuitOpenError when the host's circuit is open
+           DeadlineExceeded when the deadline ran out
+           requests exceptions when the last attempt failed
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+        if read_timeout is None:
+            read_timeout = self.stream_idle_timeout if stream else self.read_timeout
+        attempts = self.retries + 1 if idempotent else 1
+        url = f"{self.kibana_url}{path}"
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            # the deadline is checked before the breaker, a call that never starts must not hold the probe
+            timeout = self._timeout(read_timeout, deadline)
+            self.breaker.before_call()
+            try:
+                response = self._send(
+                    method,
+                    url,
+                    data=data,
+                    stream=stream,
+                    verify=True,
+                    timeout=timeout,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.breaker.record_failure()
+                print(f"Kibana {method} {path} failed (attempt {attempt + 1}/{attempts}): {e}")
+                if last_attempt or not self._sleep_before_retry(attempt, deadline):
+                    raise
+                continue
+            except BaseException:
+                # any other way out of the call still ends a half-open probe
+                self.breaker.record_failure()
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if response.status_code in self.RETRY_STATUSES and not last_attempt:
+                print(f"Kibana {method} {path} returned {response.status_code} (attempt {attempt + 1}/{attempts})")
+                if self._sleep_before_retry(attempt, deadline):
+                    response.close()
+                    continue
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, data=None, **kwargs):
+        return self.request("POST", path, data=data, **kwargs)
+
+    def validate(self):
+        """Checks the credentials against Kibana, e.g. once at startup rather than on the first question
+
+        Returns:
+          (dict) the authenticated user as returned by Kibana, None when security is disabled
+
+        Raises:
+          KibanaAuthError when Kibana rejects the credentials
+        """
+        response = self.get("/internal/security/me")
+        if response.status_code in (401, 403):
+            raise KibanaAuthError(f"Kibana at {self.kibana_url} rejected the credentials with status {response.status_code}")
+        if response.status_code != 200:
+            return None
+        user = response.json()
+        print(f"Authenticated to Kibana at {self.kibana_url} as {user.get('username')}"
+              + (" with a session cookie" if self._logged_in else ""))
+        return user
+
+    def iter_lines(self, response, deadline=None):
+        """Iterates the lines of a streaming response, enforcing the deadline between lines
+        and counting a stream that breaks or stalls as a failure of the host"""
+        try:
+            for line in response.iter_lines():
+                if deadline is not None:
+                    deadline.check()
+                yield line
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def kibana_client(kibana_url, auth):
+    """Returns the client shared by every call to a Kibana instance with these credentials
+
+    Args:
+      (str) kibana_url: URL to Kibana instance
+      ((str, str) or ApiKeyAuth) auth: tuple (username, password) or API key to access Kibana
+
+    Returns:
+      (KibanaClient) pooled client
+    """
+    key = (kibana_url, auth)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = KibanaClient(kibana_url, auth)
+        return _clients[key]
@@ -0,0 +1,161 @@
+import copy
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+from langchain_core.messages import HumanMessage
+
+
+class PersonaLLMCache(BaseCache):
+    """On-disk LangChain cache for the AzureChatOpenAI personas (OpsHuman, OpsExpert).
+
+    Entries are keyed on the Azure deployment and a hash of the rendered prompt plus the
+    LLM parameters, so a changed system prompt or temperature never returns a
+    stale answer. The least recently used entries are evicted once the database grows
+    past max_bytes. A persona with a small model tier gives that chain its own view,
+    see for_deployment.
+
+    Args:
+      (str) path: SQLite file to store the cache in
+      (str) deployment: Azure OpenAI deployment the persona uses
+      (int) max_bytes: size limit for cached responses before eviction kicks in
+    """
+
+    def __init__(self, path, deployment, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.deployment = deployment
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # the slack handlers call predict() from worker threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " deployment TEXT,"
+            " response TEXT,"
+            " size INTEGER,"
+            " last_used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+        self._db.commit()
+        # counters and a running size, so an insert does not sum the whole table,
+        # shared with the views of the persona's other deployments
+        size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        self._totals = {"hits": 0, "misses": 0, "evictions": 0, "bytes": size}
+
+    def for_deployment(self, deployment):
+        """Returns the cache of another deployment of the persona, e.g. its small model tier.
+        The view shares this cache's file, size limit and counters, its entries are keyed on its own deployment.
+        """
+        view = copy.copy(self)
+        view.deployment = deployment
+        return view
+
+    def _key(self, prompt, llm_string):
+        prompt_hash = hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+        return f"{self.deployment}:{prompt_hash}"
+
+    def lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            row = self._db.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._totals["misses"] += 1
+                return None
+            self._totals["hits"] += 1
+            self._db.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return [loads(generation) for generation in json.loads(row[0])]
+
+    def contains(self, llm, prompt):
+        """Tells whether predicting a rendered prompt with a chat model would be answered from the cache,
+        i.e. without a call to Azure OpenAI. Neither the counters nor the recency are touched.
+
+        Args:
+          (BaseChatModel) llm: chat model that uses this cache
+          (str) prompt: prompt as rendered by the chain, history included
+        """
+        # the model may use the view of another deployment of this cache
+        cache = llm.cache if isinstance(llm.cache, PersonaLLMCache) else self
+        # a chain's string prompt reaches the chat model as a single human message
+        key = cache._key(dumps([HumanMessage(content=prompt)]), llm._get_llm_string(stop=None))
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM llm_cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def update(self, prompt, llm_string, return_val):
+        response = json.dumps([dumps(generation) for generation in return_val])
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        key = self._key(prompt, llm_string)
+        with self._lock:
+            replaced = self._db.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, deployment, response, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, self.deployment, response, size, time.time()),
+            )
+            self._totals["bytes"] += size - (replaced[0] if replaced else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self, batch=64):
+        # the least recently used entries come off the last_used index a batch at a time
+        while self._totals["bytes"] > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM llm_cache ORDER BY last_used LIMIT ?", (batch,)
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._totals["evictions"] += 1
+                self._totals["bytes"] -= size
+                if self._totals["bytes"] <= self.max_bytes:
+                    break
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._db.execute("DELETE FROM llm_cache")
+            self._db.commit()
+            self._totals["bytes"] = 0
+
+    def stats(self):
+        """Returns the hit/miss counters and current size of the cache
+
+        Returns:
+          (dict) hits, misses, evictions, entries and bytes
+        """
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            return {
+                "hits": self._totals["hits"],
+                "misses": self._totals["misses"],
+                "evictions": self._totals["evictions"],
+                "entries": entries,
+                "bytes": self._totals["bytes"],
+            }
+
+
+def persona_llm_cache(creds, persona):
+    """Builds the response cache for a persona from its creds file.
+    Caching is off unless the creds file sets "LLM_CACHE": true, so live traffic stays uncached.
+
+    Args:
+      (dict) creds: loaded creds file of the persona
+      (str) persona: persona name, used for the default cache file name
+
+    Returns:
+      (PersonaLLMCache) the cache, or None when caching is disabled for this persona
+    """
+    if not creds.get('LLM_CACHE', False):
+        return None
+    return PersonaLLMCache(
+        path=creds.get('LLM_CACHE_PATH', f'.llm-cache-{persona}.sqlite'),
+        deployment=creds['AZURE_OPENAI_DEPLOYMENT'],
+        max_bytes=int(creds.get('LLM_CACHE_MAX_MB', 50)) * 1024 * 1024,
+    )
@@ -0,0 +1,62 @@
+class OverloadGuard:
+    """Decides when ObsBurger is overloaded and what to shed, from the scheduler's queue depth
+    and the run time of recent requests.
+
+    In overload new mentions get an immediate reply, the channel's recent answer or their
+    queue position, bot loops and file uploads are shed, and past max_queue_depth new work
+    is turned away instead of waiting behind everything else.
+
+    Args:
+      (FairScheduler) scheduler: scheduler running the assistant requests
+      (CoordinationBackend) backend: where recent answers per channel are kept
+      (int) queue_depth: queued requests from which the bot counts as overloaded
+      (float) latency: median request seconds from which the bot counts as overloaded
+      (int) max_queue_depth: queued requests from which new requests are rejected
+      (float) answer_ttl: seconds a channel's answer is offered as its recent answer
+    """
+
+    def __init__(self, scheduler, backend, queue_depth=8, latency=120, max_queue_depth=24, answer_ttl=900):
+        self.scheduler = scheduler
+        self.backend = backend
+        self.queue_depth = queue_depth
+        self.latency = latency
+        self.max_queue_depth = max_queue_depth
+        self.answer_ttl = answer_ttl
+        self.shed = 0
+
+    def overloaded(self):
+        median = self.scheduler.median_duration()
+        return self.scheduler.depth() >= self.queue_depth or (
+            median is not None and median >= self.latency and self.scheduler.depth() > 0
+        )
+
+    def full(self):
+        return self.scheduler.depth() >= self.max_queue_depth
+
+    def shed_bot_request(self):
+        """Returns True if a request from a bot should be dropped"""
+        if self.overloaded():
+            self.shed += 1
+            return True
+        return False
+
+    def estimated_wait(self, position):
+        """Returns the estimated seconds until a request at the given queue position starts"""
+        median = self.scheduler.median_duration() or self.latency
+        workers = max(1, self.scheduler.workers)
+        return position * median / workers
+
+    def remember_answer(self, channel_id, answer):
+        self.backend.set(f"answer:{channel_id}", answer, ttl=self.answer_ttl)
+
+    def recent_answer(self, channel_id):
+        return self.backend.get(f"answer:{channel_id}")
+
+    def notice(self, channel_id, position):
+        """Short reply for a mention queued while overloaded"""
+        minutes = max(1, round(self.estimated_wait(position) / 60))
+        text = f"I'm handling a burst of requests. You're queued at position {position}, about {minutes} min."
+        recent = self.recent_answer(channel_id)
+        if recent:
+            text += f"\nMost recent answer in this channel:\n{recent}"
+        return text
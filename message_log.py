@@ -0,0 +1,73 @@
+import sys
+import json
+
+
+class LoggedMessage:
+    """A conversation message with its JSON serialization, encoded once when it is logged"""
+
+    __slots__ = ("role", "message", "fragment")
+
+    def __init__(self, message):
+        self.message = message
+        # a handful of roles repeat across every message of every conversation
+        self.role = sys.intern(message["message"]["role"])
+        self.fragment = json.dumps(message)
+
+
+class MessageLog:
+    """Append-only log of the messages of an assistant conversation, as sent to chat/complete.
+
+    Every message is serialized once, when it is appended, and the request body of a turn is
+    built from the cached fragments, so a turn costs its new messages rather than the whole
+    history. The log is extended in place by every turn of the conversation, callers that
+    branch a conversation copy it with MessageLog(log) first.
+
+    Args:
+      (iterable) messages: messages to start from, dicts with "@timestamp" and "message"
+    """
+
+    __slots__ = ("_records", "_joined", "_joined_count")
+
+    def __init__(self, messages=()):
+        self._records = []
+        self._joined = ""
+        self._joined_count = 0
+        self.extend(messages)
+
+    def append(self, message):
+        self._records.append(LoggedMessage(message))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return (record.message for record in self._records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [record.message for record in self._records[index]]
+        return self._records[index].message
+
+    def json(self, extra=()):
+        """Returns the JSON array of the logged messages followed by the extra ones, which are not logged"""
+        if self._joined_count != len(self._records):
+            new = ",".join(record.fragment for record in self._records[self._joined_count:])
+            self._joined = f"{self._joined},{new}" if self._joined else new
+            self._joined_count = len(self._records)
+        parts = [self._joined] if self._joined else []
+        parts.extend(json.dumps(message) for message in extra)
+        return "[" + ",".join(parts) + "]"
+
+    def request_body(self, fields, extra=()):
+        """Returns the chat/complete request body: the fields plus "messages" with the log and the extra messages
+
+        Args:
+          (dict) fields: the other fields of the body, e.g. connectorId and persist
+          (list) extra: messages of this turn that are only logged once the turn succeeded
+        """
+        body = json.dumps(fields)
+        return body[:-1] + (", " if fields else "") + '"messages": ' + self.json(extra) + "}"
@@ -0,0 +1,128 @@
+import re
+import math
+import threading
+
+from collections import deque
+
+# Words that point at an investigation the assistant will run functions for
+heavy_terms = (
+    "alert", "error", "exception", "log", "latency", "throughput", "esql", "es|ql", "query", "trace",
+    "apm", "service", "host", "pod", "container", "cpu", "memory", "disk", "anomal", "incident",
+    "outage", "spike", "slo", "root cause", "investigat", "correlat", "compare", "why", "degrad",
+    "failing", "failure", "timeout", "visuali", "dashboard",
+)
+
+# Conversational turns the small model answers just as well
+light_patterns = (
+    r"^(hi|hello|hey|thanks|thank you|ok|okay|cool|great|got it)( there| a lot)?[\s!.,]*$",
+    r"what (functions|tools) (do you|can you)",
+    r"what can you do",
+    r"who are you",
+    r"^help\b",
+)
+
+time_range_pattern = r"\b(last|past)\s+\d*\s*(minutes?|hours?|days?|weeks?)\b"
+
+
+def question_features(question, function_calls=0):
+    """Cheap features of a question and the conversation it is asked in
+
+    Args:
+      (str) question: the question
+      (int) function_calls: function calls the assistant made in the conversation so far
+
+    Returns:
+      (dict) feature name to value
+    """
+    text = question.lower()
+    return {
+        "log_chars": math.log1p(len(text)),
+        "heavy_terms": sum(1 for term in heavy_terms if term in text),
+        "light": any(re.search(pattern, text) for pattern in light_patterns),
+        "time_range": bool(re.search(time_range_pattern, text)),
+        "numbers": len(re.findall(r"\d+", text)),
+        # an investigation in progress stays on the large model for its follow-ups
+        "function_calls": min(function_calls, 3),
+    }
+
+
+# Linear weights over the features, a positive score goes to the large model
+tier_weights = {
+    "bias": -3.0,
+    "log_chars": 0.5,
+    "heavy_terms": 1.5,
+    "light": -4.0,
+    "time_range": 1.5,
+    "numbers": 0.25,
+    "function_calls": 1.0,
+}
+
+
+def question_tier(question, function_calls=0):
+    """Returns "small" for simple or conversational turns, "large" for function-heavy investigations"""
+    features = question_features(question, function_calls)
+    score = tier_weights["bias"] + sum(tier_weights[name] * float(value) for name, value in features.items())
+    return "large" if score >= 0 else "small"
+
+
+def persona_task(messages):
+    """Returns what a persona last asked ObsBurger, the task its next turn works on.
+    At the start of a shift that is the shiftstart command, saved to the memory as the persona's own message.
+
+    Args:
+      (list) messages: LangChain messages of the persona's conversation memory
+
+    Returns:
+      (str) the persona's last message without Slack mentions, None before its first one
+    """
+    for message in reversed(messages):
+        if message.type == "ai":
+            return re.sub(r"<@[\w]+>", "", message.content).strip()
+    return None
+
+
+class ModelTiers:
+    """Routes questions to a small or a large model and keeps latency and cost per tier.
+
+    Args:
+      (dict) targets: tier ("small", "large") to what the caller routes to, e.g. connector ids
+        or a LangChain chain. Without a "small" target everything goes to "large".
+      (dict) cost_per_1k_tokens: estimated cost per 1000 tokens by tier, for the report
+      (int) window: number of recent requests kept per tier
+    """
+
+    def __init__(self, targets, cost_per_1k_tokens=None, window=200):
+        self.targets = targets
+        self.cost_per_1k_tokens = cost_per_1k_tokens or {}
+        self._latencies = {tier: deque(maxlen=window) for tier in ("small", "large")}
+        self._requests = {"small": 0, "large": 0}
+        self._tokens = {"small": 0, "large": 0}
+        self._lock = threading.Lock()
+
+    def classify(self, question, function_calls=0):
+        if not self.targets.get("small"):
+            return "large"
+        return question_tier(question, function_calls)
+
+    def target(self, tier):
+        return self.targets.get(tier) or self.targets.get("large")
+
+    def record(self, tier, seconds, tokens):
+        with self._lock:
+            self._latencies[tier].append(seconds)
+            self._requests[tier] += 1
+            self._tokens[tier] += tokens
+
+    def report(self):
+        """Returns requests, median latency and estimated cost per tier"""
+        with self._lock:
+            report = {}
+            for tier, latencies in self._latencies.items():
+                ordered = sorted(latencies)
+                report[tier] = {
+                    "requests": self._requests[tier],
+                    "median_seconds": round(ordered[len(ordered) // 2], 2) if ordered else None,
+                    "tokens": self._tokens[tier],
+                    "estimated_cost": round(self._tokens[tier] / 1000 * self.cost_per_1k_tokens.get(tier, 0), 4),
+                }
+            return report
@@ -5,12 +5,32 @@ import io
 import json
 import logging
 import requests
+import asyncio
 import threading
+import time
 
 from datetime import datetime, timedelta
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 
+from connector_router import ConnectorRouter
+from hedging import HedgePolicy, HedgedStream
+from kibana_client import kibana_client, kibana_auth, Deadline, KibanaUnavailable
+from conversation_resume import (get_persisted_conversation, messages_after, is_final_answer,
+                                 created_conversation_id, resume_request)
+from bot_channel import BotChannelServer, SlackMirror
+from slack_dedupe import EventDeduplicator, ack_immediately, async_ack_immediately
+from async_runtime import iterate_in_executor
+from scheduler import FairScheduler, known_bot_user_ids
+from admission import AdmissionController, AdmissionRejected, estimate_tokens
+from load_shedding import OverloadGuard
+from model_tiering import ModelTiers
+from coordination import coordination_backend, channel_locked
+from snapshots import snapshot_store
+from fanout import load_clusters, fan_out, merge_answers, FanoutProgress
+from briefings import ShiftBriefings
+from shift_reports import ShiftReports
+
 import warnings
 from urllib3.exceptions import InsecureRequestWarning, NotOpenSSLWarning
 
@@ -18,26 +38,80 @@ from urllib3.exceptions import InsecureRequestWarning, NotOpenSSLWarning
 warnings.filterwarnings("ignore", category=NotOpenSSLWarning)
 
 
-conversation = {
+new_conversation = {
     'id': None,
     'response': None,
     'messages': []
 }
-lock = threading.Lock()
 
 
-def update_conversation(key, value):
-    global conversation
-    with lock:  # Acquire lock
-        # conversation = value
+conversation_restored = threading.Event()
+_restore_lock = threading.Lock()
+
+
+def restore_conversation():
+    """Brings the conversation back from the snapshots the first time it is used after a restart,
+    unless another replica still holds it in the coordination backend"""
+    with _restore_lock:
+        if conversation_restored.is_set():
+            return
+        if snapshots is not None and coordination.get('conversation') is None:
+            conversation = dict(new_conversation, messages=[])
+            for record in snapshots.load('conversation'):
+                conversation.update(record.get('set', {}))
+                conversation['messages'].extend(record.get('append', []))
+            if conversation['id'] is not None or conversation['messages']:
+                coordination.set('conversation', conversation)
+                snapshots.compact('conversation', {'set': conversation})
+        conversation_restored.set()
+
+
+def get_conversation():
+    if not conversation_restored.is_set():
+        restore_conversation()
+    # the conversation lives in the coordination backend, so every replica continues the same one
+    return coordination.get('conversation', dict(new_conversation))
 
-        conversation[key] = value
 
-        print(f'Updated conversation: {conversation}')
+def _update_conversation(key, value):
+    # callers hold the conversation lock
+    conversation = get_conversation()
+    previous = conversation.get(key)
+
+    conversation[key] = value
+    coordination.set('conversation', conversation)
+    if snapshots is not None:
+        if key == 'messages' and previous and value[:len(previous)] == previous:
+            # a turn only adds messages, so only those are written
+            snapshots.append('conversation', {'append': value[len(previous):]})
+        else:
+            snapshots.append('conversation', {'set': {key: value}})
+
+    print(f'Updated conversation: {conversation}')
+
+
+def update_conversation(key, value):
+    with coordination.lock('conversation', ttl=30):  # Acquire lock
+        _update_conversation(key, value)
     # Updated conversation: {'title': 'Recent Alerts in Elastic Observability for the Past 48 Hours',
     # 'id': 'f7e5200b-516e-4d31-b8cd-a22423b09ca1', 'last_updated': '2024-02-23T14:36:03.181Z'}
 
 
+def append_to_conversation(messages, system_message=None):
+    """Appends the messages of a turn to the shared conversation as it is now, not as it was when
+    the turn started, so turns running at the same time on other channels or replicas are kept
+
+    Args:
+      (list) messages: the user message of the turn and the messages the assistant added
+      (dict) system_message: starts the conversation if it is still empty, optional
+    """
+    with coordination.lock('conversation', ttl=30):
+        current = get_conversation()['messages']
+        if not current and system_message is not None:
+            current = [system_message]
+        _update_conversation('messages', current + messages)
+
+
 ##########################################################################################
 ### Kibana Stuff
 ##########################################################################################
@@ -53,9 +127,22 @@ creds = load_credentials('.creds-obsburger-eden')
 
 # Replace with your Kibana URL and credentials
 kibana_url = creds['kibana_url']
-username = creds['username']
-password = creds['password']
-auth = (username, password)
+auth = kibana_auth(creds)
+kibana = kibana_client(kibana_url, auth)
+# Bad credentials fail the startup instead of the first question
+kibana.validate()
+
+# Conversation state, event dedupe and per-channel locks shared by every replica of the bot
+coordination = coordination_backend(creds)
+
+# Keeps the conversation across restarts when "snapshots" is set in the creds file
+snapshots = snapshot_store(creds)
+
+# Overall time budget of a single Slack question, across every Kibana call it makes
+request_deadline_seconds = creds.get('request_deadline_seconds', 600)
+
+# How often a broken chat/complete stream is resumed from the already produced messages before giving up
+max_stream_resumes = creds.get('max_stream_resumes', 2)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -76,14 +163,7 @@ def getGenAIConnectorId(kibana_url, auth):
        Wrong Kibana url or credentials
        No GenAI connector
     """
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url_connector = f"{kibana_url}/api/actions/connectors"
-    connectors = requests.get(
-        url=url_connector, headers=headers, auth=auth, verify=True
-    )
+    connectors = kibana_client(kibana_url, auth).get("/api/actions/connectors")
     if connectors.status_code == 404:
         raise Exception("ERROR - Wrong Kibana url or credentials")
     connectors_ai = [
@@ -96,28 +176,51 @@ def getGenAIConnectorId(kibana_url, auth):
     return connectors_ai[0]["id"]
 
 
-# Get the GenAI connector id
-# connector_id = getGenAIConnectorId(kibana_url, auth)
-connector_id = 'ce4b2de5-d9f0-4793-bee6-169749c0d51b' # azure-pmm-westus
-# connector_id = '51727ae4-de1e-4f50-b84f-212cad347e98' # LLM Proxy Staging
-# connector_id = '8ecc04d9-a42b-4d9b-b2ef-e1445e4ea690' # azure-pmm-sweden
-
-def getKibanaVersion(kibana_url, auth):
+# Route conversations across every GenAI connector in Kibana based on their recent
+# time-to-first-event and error rate, instead of a hardcoded connector id
+connector_router = ConnectorRouter(kibana_url, auth, connector_types=(".gen-ai", ".bedrock"))
+connector_router.discover()
+
+# Assistant requests run on a fixed pool with weighted fair queuing per channel, so investigation
+# loops of the persona bots can not push the answers to engineers to the back of the queue
+scheduler = FairScheduler(workers=creds.get('scheduler_workers', 4),
+                          bot_user_ids=creds.get('bot_user_ids', known_bot_user_ids))
+
+# Under a burst of requests, reply at once with the queue position or the channel's recent answer,
+# shed bot loops and file uploads first and turn new work away once the queue is full
+overload_guard = OverloadGuard(scheduler,
+                               coordination,
+                               queue_depth=creds.get('overload_queue_depth', 8),
+                               latency=creds.get('overload_latency_seconds', 120),
+                               max_queue_depth=creds.get('max_queue_depth', 24))
+
+# Token buckets per connector, requests queue under the Azure OpenAI tokens-per-minute quota
+# behind each connector instead of failing with 429s
+admission = AdmissionController(quotas=creds.get('connector_tokens_per_minute', {}),
+                                default_tokens_per_minute=creds.get('default_tokens_per_minute'),
+                                max_wait=creds.get('admission_max_wait', 30))
+
+# Simple or conversational questions go to the connectors of the small model tier, function-heavy
+# investigations to the large one, e.g. "model_tiers": {"small": ["<id>"], "large": ["<id>"]}.
+# Without it every question can use every connector.
+model_tiers = ModelTiers(creds.get('model_tiers', {}), cost_per_1k_tokens=creds.get('model_tier_cost_per_1k_tokens'))
+
+# Optionally hedge chat/complete requests that are slower than the connector's p95
+# time-to-first-event with a non-persisted duplicate on an alternate connector
+hedge_policy = HedgePolicy(connector_router) if creds.get('hedge_requests', False) else None
+
+def getKibanaVersion(kibana_url, auth, deadline=None):
     """Obtains the Kibana Version from the Kibana API
 
     Args:
       (str) kibana_url: URL to Kibana instance
       ((str, str)) auth: tuple (username, password) to access Kibana
+      (Deadline) deadline: overall deadline of the user request, optional
 
     Returns:
       (str) Kibana Version as a string (e.g. 8.14.0)
     """
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url_connector = f"{kibana_url}/api/status"
-    status = requests.get(url=url_connector, headers=headers, auth=auth, verify=True)
+    status = kibana_client(kibana_url, auth).get("/api/status", deadline=deadline)
     version = status.json()["version"]["number"]
     return version
 
@@ -128,13 +231,18 @@ def getAssistantsResponse(kibana_url,
                           connector_id,
                           user_question,
                           persist_conversation=True,
-                          # conversation={}`,
+                          conversation=None,
                           streaming=True,  # Always True
+                          router=None,
+                          hedge_policy=None,
+                          deadline=None,
                           ):
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
+    """Streams the chat/complete events of a question in the shared conversation, or in a forked one
+
+    Args:
+      (dict) conversation: state of a forked conversation, shaped like new_conversation, updated in place.
+        None continues the conversation shared by every channel and replica
+    """
 
     assistant_system_message = (
         'You are a helpful assistant for Elastic Observability. Your goal is to help the '
@@ -184,16 +292,21 @@ def getAssistantsResponse(kibana_url,
         "persist": persist_conversation,
     }
 
+    shared = conversation is None
+    if shared:
+        conversation = get_conversation()
+
     # if persist_conversation and conversation != {}:
     if persist_conversation and not conversation['id'] is None:
         data["conversationId"] = conversation["id"]
 
-    version = getKibanaVersion(kibana_url, auth)
+    version = getKibanaVersion(kibana_url, auth, deadline=deadline)
 
-    url = f"{kibana_url}/internal/observability_ai_assistant/chat/complete"
+    client = kibana_client(kibana_url, auth)
+    path = "/internal/observability_ai_assistant/chat/complete"
 
-    # if conversation == {}:
-    if conversation['id'] is None:
+    # a fork has no id but starts from the messages of the conversation it branched from
+    if not conversation['messages']:
         system_message = {
             "@timestamp": (datetime.now() - timedelta(minutes=2)).strftime(
                 "%Y-%m-%dT%H:%M:%S.%f"
@@ -215,50 +328,113 @@ def getAssistantsResponse(kibana_url,
             "content": user_question,
         },
     }
-    data["messages"].append(user_message)
-
-    data = json.dumps(data)
+    history = data["messages"]
+    data["messages"] = history + [user_message]
 
     response_array = []
-    with requests.post(url=url, headers=headers, auth=auth, verify=True, data=data, stream=True) as response:
-        try:
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:  # Ignore keep-alive new lines
-                        response_json = json.loads(line.decode("utf-8"))
-                        response_array.append(response_json)
-                        yield response_json
-                        # yield line.decode('utf-8')
-            else:
-                yield f"ERROR: Response status code {response.status_code}"
-        except Exception as e:
-            yield f"ERROR: {str(e)}"
+    resumes = 0
+    while True:
+        broken = None
+        payload = json.dumps(data)
+        # raises AdmissionRejected if the connector stays over its quota for too long
+        admission.admit(connector_id, estimate_tokens(payload), deadline=deadline)
+        started = time.monotonic()
+        if hedge_policy is not None:
+            # the hedged stream records connector latency and errors itself
+            stream = HedgedStream(client, path, payload, connector_id, hedge_policy, deadline)
+            stream_router = None
+        else:
+            # the read timeout of a streaming call is the idle timeout between two NDJSON events
+            stream = client.post(path, payload, stream=True, deadline=deadline)
+            stream_router = router
+        first_event = True
+        with stream as response:
+            try:
+                if response.status_code == 200:
+                    if hedge_policy is not None:
+                        lines = response.iter_lines()
+                    else:
+                        lines = client.iter_lines(response, deadline)
+                    for line in lines:
+                        if line:  # Ignore keep-alive new lines
+                            if first_event and stream_router is not None:
+                                stream_router.record_first_event(connector_id, time.monotonic() - started)
+                            first_event = False
+                            response_json = json.loads(line.decode("utf-8"))
+                            if response_json.get("type") == "chatCompletionError" and \
+                                    "429" in json.dumps(response_json.get("error")):
+                                # the LLM behind the connector is over its quota
+                                admission.throttled(connector_id)
+                            response_array.append(response_json)
+                            yield response_json
+                            # yield line.decode('utf-8')
+                    if stream_router is not None:
+                        stream_router.record_success(connector_id)
+                else:
+                    if response.status_code == 429:
+                        admission.throttled(connector_id, headers=getattr(response, "headers", None))
+                    if stream_router is not None:
+                        stream_router.record_error(connector_id)
+                    yield f"ERROR: Response status code {response.status_code}"
+            except Exception as e:
+                if stream_router is not None:
+                    stream_router.record_error(connector_id)
+                broken = e
+
+        if broken is None:
+            break
+        if resumes >= max_stream_resumes or isinstance(broken, KibanaUnavailable):
+            yield f"ERROR: {str(broken)}"
+            break
+        resumes += 1
+
+        # Work out what the assistant already produced for this question, so function calls
+        # and ES|QL queries that already ran are not repeated
+        produced = [r["message"] for r in response_array if r["type"] == "messageAdd"]
+        # the conversation may have been created by this very stream, whether or not it was recorded yet
+        conversation_id = created_conversation_id(response_array) or conversation['id']
+        if persist_conversation and conversation_id is not None:
+            persisted = get_persisted_conversation(kibana_url, auth, conversation_id, deadline=deadline)
+            recovered = messages_after(persisted, user_message) if persisted else []
+            if len(recovered) > len(produced):
+                # Kibana got further than the stream we received, e.g. a proxy reset after the answer
+                for message in recovered[len(produced):]:
+                    response_json = {"type": "messageAdd", "message": message}
+                    response_array.append(response_json)
+                    yield response_json
+                produced = recovered
+        if produced and is_final_answer(produced[-1]):
+            break
+
+        print(f"chat/complete stream broke ({broken}), resuming after {len(produced)} produced messages")
+        data = resume_request(data, history, user_message, produced, response_array, conversation_id)
 
     # handle conversation persistence
     messages = [r["message"] for r in response_array if r["type"] == "messageAdd"]
 
-    if not conversation['messages']:
-        messages = [system_message, user_message] + messages
-        # update_conversation_id('messages', messages)
-    else:
-        messages = conversation["messages"] + [user_message] + messages
-        # update_conversation_id('messages', messages)
-    update_conversation('messages', messages)
-
-    if not persist_conversation:
-        message_index = -1
+    if shared:
+        # the read-modify-write happens under the conversation lock, the conversation read when
+        # this turn started may be stale by now
+        append_to_conversation([user_message] + messages, system_message)
+    elif not conversation['messages']:
+        conversation['messages'] = [system_message, user_message] + messages
     else:
-        message_index = -2
+        conversation['messages'] = conversation["messages"] + [user_message] + messages
+    # a forked conversation only lives in the caller's dict
+    update = update_conversation if shared else conversation.__setitem__
 
     try:
-        assistant_response = response_array[message_index]["message"]["message"][
+        # the answer is the last message added, a persisted conversation ends with a
+        # conversationUpdate while hedged or resumed turns may not
+        assistant_response = [r for r in response_array if r["type"] == "messageAdd"][-1]["message"]["message"][
             "content"
         ]
 
-        update_conversation('response', assistant_response)
-    except:
-        print(f"Response was not successful: {response.text}")
-        update_conversation('id', None)
+        update('response', assistant_response)
+    except (IndexError, KeyError, TypeError):
+        # the stream is consumed at this point, so log what was received instead of response.text
+        print(f"Response was not successful: {response_array}")
+        update('id', None)
 
 
 ##########################################################################################
@@ -269,6 +445,10 @@ def getAssistantsResponse(kibana_url,
 bot_oauth_token = creds['bot_oauth_token']
 app = App(token=bot_oauth_token)
 
+# Drop Slack redeliveries of the same event before they reach any handler
+event_dedupe = EventDeduplicator(backend=coordination)
+app.use(event_dedupe.middleware)
+
 # Initialize SocketModeHandler with your app and app-level token
 app_level_token = creds['app_level_token']
 handler = SocketModeHandler(app, app_level_token)
@@ -288,84 +468,344 @@ def markdown_blocks_simple(text):
 
 # def handle_message(event, say):
 
-def long_running_task(channel_id, user_id, msg, kb_url, ath, conn_id):
-    for response_line in getAssistantsResponse(kb_url,
-                                               ath,
-                                               conn_id,
-                                               msg
-                                               ):
+def slack_calls_for(response_json, channel_id, user_id, conn_id, router):
+    """Turns one chat/complete event into the Slack Web API calls that show it,
+    shared by the threaded and the async runtime
+
+    Returns:
+      (list) (method name, keyword arguments) of the Slack client calls to make
+    """
+    if isinstance(response_json, str):
+        # error status or broken stream reported by getAssistantsResponse
+        return [("chat_postMessage", {"channel": channel_id, "text": f'<@{user_id}>: {response_json}'})]
+
+    print(response_json)
+
+    # Check the type of the message
+    if response_json.get("type") == "chatCompletionChunk":
+        # Chunks can't be used for streaming in Slack
+        return []
+
+    if response_json.get('type') == 'conversationCreate':
+        # update_conversation(response_json.get('conversation'))
+        update_conversation('id', response_json.get('conversation').get('id'))
+        router.pin(response_json.get('conversation').get('id'), conn_id)
+        return []
+
+    # For large responses the assistant is going to process, sent as snippet
+    if response_json.get('message').get('message').get('role') == 'user' and response_json.get(
+            'message').get('message').get('content') != "[]":
+        if overload_guard.overloaded():
+            # uploads of function results are shed first under load, the answer still comes
+            return []
+        content_str = response_json.get('message').get('message').get('content')
+        # Try to load the string as JSON and pretty-print it
         try:
-            # Parse the line as JSON
-            response_json = response_line
-            print(response_json)
+            parsed_json = json.loads(content_str)
+            pretty_content = json.dumps(parsed_json, indent=4)
+        except json.JSONDecodeError:
+            # If content_str is not valid JSON, use the original string
+            pretty_content = content_str
+
+        # Encode the pretty printed JSON string to bytes
+        file_content = io.BytesIO(pretty_content.encode('utf-8'))
+
+        return [("files_upload", {
+            "channels": channel_id,
+            "file": file_content,
+            "title": "Elastic Observability AI Assistant",
+            "initial_comment": f"Function _{response_json.get('message').get('message').get('name')}_ Elastic Observability AI Assistant... Processing...",
+            "filetype": "json",
+        })]
+
+    # Should be the final response from the assistant, so @ the user
+    if response_json.get('message').get('message').get('content') not in ["[]", "", None]:
+        # Format the message for Slack
+        content = f"{response_json.get('message').get('message').get('content')}"
+        if response_json.get('message').get('message').get('role') == 'assistant':
+            overload_guard.remember_answer(channel_id, content)
+        formatted_message = f'<@{user_id}>: {content}'
+        converted_text = formatted_message.replace('**', '*')  # Slack markdown conversion
+
+    # Intermittent messages from the assistant showing status updates
+    elif response_json.get('message').get('message').get('role') == 'assistant' and response_json.get(
+            'message').get('message').get('function_call') is not None:
+        # Format the message for Slack
+        role = response_json.get('message').get('message').get('role')
+        function_name = response_json.get('message').get('message').get('function_call').get('name')
+        function_arguments = response_json.get('message').get('message').get('function_call').get(
+            'arguments')
+
+        formatted_message = f'{role} is calling function: `{function_name}: {function_arguments}`'
+        converted_text = formatted_message.replace('**', '*')
+    else:
+        return []
 
-            # Check the type of the message
-            if response_json.get("type") == "chatCompletionChunk":
-                # Chunks can't be used for streaming in Slack
-                continue
+    # Convert the message to Slack markdown
+    markdown = markdown_blocks_simple(converted_text)
+    # Send the message to Slack
+    return [("chat_postMessage", {"channel": channel_id, "blocks": markdown, "text": converted_text})]
 
-            # print()
 
+def question_tier(msg, conversation=None):
+    """Classifies a question into a model tier, the ongoing conversation's function calls count as context
+
+    Args:
+      (dict) conversation: forked conversation the question is asked in, None for the shared one
+
+    Returns:
+      (tuple) (tier, connector ids of the tier or None for any connector)
+    """
+    messages = (conversation or get_conversation())['messages']
+    function_calls = sum(
+        1 for message in messages if message and (message['message'].get('function_call') or {}).get('name')
+    )
+    tier = model_tiers.classify(msg, function_calls)
+    return tier, model_tiers.target(tier)
+
+
+def record_tier(tier, started, msg, conversation=None):
+    model_tiers.record(tier, time.monotonic() - started,
+                       estimate_tokens(json.dumps((conversation or get_conversation())['messages']) + msg))
+    print(f"Model tiers: {model_tiers.report()}")
+
+
+def long_running_task(channel_id, user_id, msg, kb_url, ath, router):
+    deadline = Deadline(request_deadline_seconds)
+    tier, candidates = question_tier(msg)
+    started = time.monotonic()
+    try:
+        # an ongoing conversation stays on its connector as long as its questions stay in the same tier
+        conn_id = router.route(get_conversation()['id'], candidates=candidates)
+        for response_line in getAssistantsResponse(kb_url,
+                                                   ath,
+                                                   conn_id,
+                                                   msg,
+                                                   router=router,
+                                                   hedge_policy=hedge_policy,
+                                                   deadline=deadline,
+                                                   ):
+            try:
+                for method, kwargs in slack_calls_for(response_line, channel_id, user_id, conn_id, router):
+                    getattr(app.client, method)(**kwargs)
+            except KeyError:
+                # Handle missing keys in the JSON
+                print(f"KeyError encountered while processing line: {response_line}")
+            except AttributeError:
+                print(f"AttributeError encountered while processing json: \n{response_line}")
+    except (KibanaUnavailable, AdmissionRejected, requests.exceptions.RequestException) as e:
+        # circuit open, deadline exceeded, Kibana not reachable or over the token quota, tell the user instead of going quiet
+        print(f"Kibana call failed: {e}")
+        app.client.chat_postMessage(channel=channel_id, text=f'<@{user_id}>: {e}')
+    finally:
+        record_tier(tier, started, msg)
+
+
+def answer_bot_question(channel_id, user_id, msg, fork=None):
+    """Answers a persona's question received over the local bot channel.
+    The transcript is mirrored to Slack in the background, the answer goes straight back to the persona.
+
+    Args:
+      (str) fork: id of the persona's forked conversation, answered in a non-persisted branch
+        of the shared conversation that leaves the shared one untouched, None for the shared conversation
+
+    Returns:
+      (str) final answer of the assistant
+    """
+    msg = re.sub(r"<@[\w]+>", '', msg).strip()
+    answer = None
+    deadline = Deadline(request_deadline_seconds)
+    # the fork branches from the investigation so far, service, time range and findings included
+    conversation = dict(new_conversation, messages=list(get_conversation()['messages'])) if fork else None
+    tier, candidates = question_tier(msg, conversation)
+    started = time.monotonic()
+    try:
+        conn_id = connector_router.route(None if fork else get_conversation()['id'], candidates=candidates)
+        for response_json in getAssistantsResponse(kibana_url,
+                                                   auth,
+                                                   conn_id,
+                                                   msg,
+                                                   persist_conversation=not fork,
+                                                   conversation=conversation,
+                                                   router=connector_router,
+                                                   hedge_policy=hedge_policy,
+                                                   deadline=deadline,
+                                                   ):
+            if isinstance(response_json, str):
+                answer = response_json
+                continue
             if response_json.get('type') == 'conversationCreate':
-                # update_conversation(response_json.get('conversation'))
                 update_conversation('id', response_json.get('conversation').get('id'))
+                connector_router.pin(response_json.get('conversation').get('id'), conn_id)
+            if response_json.get('type') != 'messageAdd':
+                continue
+            message = response_json.get('message').get('message')
+            if message.get('role') == 'assistant' and message.get('function_call') is not None \
+                    and message.get('function_call').get('name'):
+                function_call = message.get('function_call')
+                slack_mirror.post(channel_id,
+                                  f"assistant is calling function: `{function_call.get('name')}: {function_call.get('arguments')}`")
+            elif message.get('role') == 'assistant' and message.get('content') not in ["[]", "", None]:
+                answer = message.get('content')
+    except (KibanaUnavailable, AdmissionRejected, requests.exceptions.RequestException) as e:
+        answer = f"ERROR: {e}"
+    finally:
+        record_tier(tier, started, msg, conversation)
+
+    if answer is None:
+        answer = "ERROR: the assistant did not answer"
+    slack_mirror.post(channel_id, f"*ObsBurger{f' ({fork})' if fork else ''}:* {answer}")
+    return answer
+
+
+# Reports and briefings keep their last result and its watermark, later runs only ask about the time since
+shift_reports = ShiftReports(coordination,
+                             default_hours=creds.get('report_default_hours', 24),
+                             lag_minutes=creds.get('report_lag_minutes', 2))
+
+
+def run_conversation(question, persist_conversation=True):
+    """Runs a question to its final answer in a conversation of its own, the shared one is left alone
+
+    Returns:
+      (dict) conversation state holding the response, id, messages and connector id
+    """
+    conversation = dict(new_conversation, messages=[])
+    conn_id = connector_router.route(None)
+    for response_json in getAssistantsResponse(kibana_url,
+                                               auth,
+                                               conn_id,
+                                               question,
+                                               persist_conversation=persist_conversation,
+                                               conversation=conversation,
+                                               router=connector_router,
+                                               hedge_policy=hedge_policy,
+                                               deadline=Deadline(request_deadline_seconds),
+                                               ):
+        if isinstance(response_json, str):
+            print(f"Conversation stream: {response_json}")
+        elif response_json.get('type') == 'conversationCreate':
+            conversation['id'] = response_json.get('conversation').get('id')
+    conversation['connectorId'] = conn_id
+    return conversation
 
-            # For large responses the assistant is going to process, sent as snippet
-            elif response_json.get('message').get('message').get('role') == 'user' and response_json.get(
-                    'message').get('message').get('content') != "[]":
-                content_str = response_json.get('message').get('message').get('content')
-                # Try to load the string as JSON and pretty-print it
-                try:
-                    parsed_json = json.loads(content_str)
-                    pretty_content = json.dumps(parsed_json, indent=4)
-                except json.JSONDecodeError:
-                    # If content_str is not valid JSON, use the original string
-                    pretty_content = content_str
-
-                # Encode the pretty printed JSON string to bytes
-                file_content = io.BytesIO(pretty_content.encode('utf-8'))
-
-                app.client.files_upload(channels=channel_id,
-                                        file=file_content,
-                                        title="Elastic Observability AI Assistant",
-                                        initial_comment=f"Function _{response_json.get('message').get('message').get('name')}_ Elastic Observability AI Assistant... Processing...",
-                                        filetype="json",
-                                        )
-            else:
-                # Should be the final response from the assistant, so @ the user
-                if response_json.get('message').get('message').get('content') not in ["[]", "", None]:
-                    # Format the message for Slack
-                    content = f"{response_json.get('message').get('message').get('content')}"
-                    formatted_message = f'<@{user_id}>: {content}'
-                    converted_text = formatted_message.replace('**', '*')  # Slack markdown conversion
-
-                # Intermittent messages from the assistant showing status updates
-                elif response_json.get('message').get('message').get('role') == 'assistant' and response_json.get(
-                        'message').get('message').get('function_call') is not None:
-                    # Format the message for Slack
-                    role = response_json.get('message').get('message').get('role')
-                    function_name = response_json.get('message').get('message').get('function_call').get('name')
-                    function_arguments = response_json.get('message').get('message').get('function_call').get(
-                        'arguments')
-
-                    formatted_message = f'{role} is calling function: `{function_name}: {function_arguments}`'
-                    converted_text = formatted_message.replace('**', '*')
-
-                # Convert the message to Slack markdown
-                markdown = markdown_blocks_simple(converted_text)
-                # Send the message to Slack
-                app.client.chat_postMessage(channel=channel_id, blocks=markdown, text=converted_text)
-        except json.JSONDecodeError:
-            # Handle the case where the response line is not valid JSON
-            print(f"Invalid JSON received: {response_line}")
-        except KeyError:
-            # Handle missing keys in the JSON
-            print(f"KeyError encountered while processing line: {response_line}")
-        except AttributeError:
-            print(f"AttributeError encountered while processing json: \n{response_json}")
+
+def compute_briefing(question):
+    """Runs a shift briefing question, only over the time since the previous briefing,
+    persisted so follow-ups can continue it
+
+    Returns:
+      (dict) conversation state holding the briefing's response
+    """
+    prompt, window_start, watermark = shift_reports.prompt('shift-briefings', question)
+    conversation = run_conversation(prompt)
+    if conversation.get('response'):
+        shift_reports.store('shift-briefings', question, conversation['response'], window_start, watermark)
+    return conversation
+
+
+def report_task(channel_id, user_id, question):
+    """Posts the channel's report for a question, updated with the data since its last run"""
+    report = shift_reports.run(channel_id,
+                               question,
+                               lambda prompt: run_conversation(prompt, persist_conversation=False).get('response'))
+    text = f"<@{user_id}>: {report or 'The assistant did not produce a report, please try again.'}".replace('**', '*')
+    app.client.chat_postMessage(channel=channel_id, blocks=markdown_blocks_simple(text), text=text)
+
+
+# Briefing questions precomputed ahead of every shift start, e.g.
+#   "shift_briefings": {"questions": ["were there any anomalies related to APM services"],
+#                       "shift_starts": ["07:00", "15:00", "23:00"], "lead_minutes": 15, "max_age_minutes": 90}
+briefing_config = creds.get('shift_briefings')
+if briefing_config:
+    shift_briefings = ShiftBriefings(coordination,
+                                     briefing_config['questions'],
+                                     briefing_config['shift_starts'],
+                                     compute_briefing,
+                                     # the precomputation yields to every question asked meanwhile
+                                     lambda func, *args: scheduler.submit('shift-briefings', 'shift-briefings', func,
+                                                                          *args, requester="bot"),
+                                     lead_minutes=briefing_config.get('lead_minutes', 15),
+                                     max_age_minutes=briefing_config.get('max_age_minutes', 90))
+else:
+    shift_briefings = None
+
+
+def materialized_briefing(msg):
+    """Answers a shift briefing question from its precomputed briefing. When no conversation is
+    going on, the briefing's conversation becomes the shared one, so on-demand follow-ups continue it.
+    A live conversation is never replaced, its follow-ups and investigations carry on untouched.
+
+    Returns:
+      (str) the briefing and its age, None if there is no fresh briefing for the question
+    """
+    briefing = shift_briefings.lookup(msg) if shift_briefings is not None else None
+    if briefing is None:
+        return None
+    conversation = briefing['conversation']
+    state = {'id': conversation['id'], 'response': conversation['response'], 'messages': conversation['messages']}
+    with coordination.lock('conversation', ttl=30):
+        current = get_conversation()
+        adopted = current['id'] is None and not current['messages']
+        if adopted:
+            coordination.set('conversation', state)
+            if snapshots is not None:
+                snapshots.compact('conversation', {'set': state})
+    if adopted and conversation['id'] is not None:
+        connector_router.pin(conversation['id'], conversation['connectorId'])
+    minutes = round((time.time() - briefing['computed_at']) / 60)
+    return f"{conversation['response']}\n_Shift briefing prepared {minutes} min ago_"
+
+
+def scheduled_bot_answer(channel_id, user_id, msg, fork=None):
+    """Queues a bot channel question, questions over the bot channel always come from a persona bot"""
+    briefing = materialized_briefing(msg) if not fork else None
+    if briefing is not None:
+        slack_mirror.post(channel_id, f"*ObsBurger:* {briefing}")
+        return briefing
+    if overload_guard.shed_bot_request():
+        return "ERROR: ObsBurger is overloaded and answers engineers first, ask again later."
+    if fork:
+        # forks of one investigation run side by side, they branch from the shared conversation
+        # without writing to it and take no channel lock
+        return scheduler.submit(user_id,
+                                f"{channel_id}/{fork}",
+                                answer_bot_question,
+                                channel_id,
+                                user_id,
+                                msg,
+                                fork=fork,
+                                requester="bot").result()
+    return scheduler.submit(user_id,
+                            channel_id,
+                            channel_locked(coordination, answer_bot_question, ttl=request_deadline_seconds),
+                            channel_id,
+                            user_id,
+                            msg,
+                            requester="bot").result()
+
+
+# Kibana deployments a "fanout <question>" mention is sent to, creds file paths or inline dicts
+fanout_clusters = load_clusters(creds.get('fanout_clusters', []))
+
+
+def fanout_task(channel_id, user_id, msg):
+    """Asks every fan-out cluster at once, edits one status message as they progress
+    and replies with the merged answers"""
+    status = app.client.chat_postMessage(channel=channel_id,
+                                         text=f"Asking {len(fanout_clusters)} clusters...")
+
+    def update(text):
+        app.client.chat_update(channel=channel_id, ts=status['ts'], text=text)
+
+    progress = FanoutProgress([cluster['name'] for cluster in fanout_clusters], update)
+    results = fan_out(fanout_clusters, msg, deadline_seconds=request_deadline_seconds, progress=progress)
+    merged = merge_answers(results)
+    overload_guard.remember_answer(channel_id, merged)
+    text = f'<@{user_id}>: {merged}'
+    app.client.chat_postMessage(channel=channel_id, blocks=markdown_blocks_simple(text), text=text)
 
 
-@app.event("app_mention")
 def mention_handler(event, say):
     # Extract text from the event payload
     text = event['text']
@@ -378,23 +818,73 @@ def mention_handler(event, say):
     # logic to handle the message
     if 'run xyz task' in message_without_bot_mention:
         say(f"<@{event['user']}>: Sure, I'll run the xyz task!")
+        return
+    briefing = materialized_briefing(message_without_bot_mention)
+    if briefing is not None:
+        # precomputed ahead of the shift, answered without queueing
+        text = f"<@{event['user']}>: {briefing}".replace('**', '*')
+        say(blocks=markdown_blocks_simple(text), text=text)
+    elif message_without_bot_mention.lower().startswith('report '):
+        if overload_guard.full():
+            say(f"<@{event['user']}>: I'm overloaded right now, please ask again in a few minutes.")
+            return
+        say(f"Updating the report for this channel...")
+        scheduler.submit(event['user'],
+                         event['channel'],
+                         report_task,
+                         event['channel'],
+                         event['user'],
+                         message_without_bot_mention[len('report '):].strip(),
+                         event=event,
+                         )
+    elif fanout_clusters and message_without_bot_mention.lower().startswith('fanout '):
+        if overload_guard.full():
+            say(f"<@{event['user']}>: I'm overloaded right now, please ask again in a few minutes.")
+            return
+        # one scheduler slot for the whole fan-out, the clusters are asked in parallel inside it
+        scheduler.submit(event['user'],
+                         event['channel'],
+                         fanout_task,
+                         event['channel'],
+                         event['user'],
+                         message_without_bot_mention[len('fanout '):].strip(),
+                         cost=len(fanout_clusters),
+                         event=event,
+                         )
     else:
-        # Acknowledge the user's request immediately
-        # say(f"Hi <@{event['user']}>! I'm working on your request. Please standby...")
-        say(f"I'm working on your request. Please standby...")
+        if overload_guard.full():
+            say(f"<@{event['user']}>: I'm overloaded right now, please ask again in a few minutes.")
+            return
+        if scheduler.classify(event['user'], event) == "bot" and overload_guard.shed_bot_request():
+            print(f"Shed a bot request in {event['channel']} while overloaded")
+            return
+        overloaded = overload_guard.overloaded()
+        if not overloaded:
+            # Acknowledge the user's request immediately
+            # say(f"Hi <@{event['user']}>! I'm working on your request. Please standby...")
+            say(f"I'm working on your request. Please standby...")
 
         # # Get the response from the AI Assistant
         # Start the long-running task in a new thread
-        threading.Thread(target=long_running_task,
-                         args=(event['channel'],
-                               event['user'],
-                               message_without_bot_mention,
-                               kibana_url,
-                               auth,
-                               connector_id
-
-                               )
-                         ).start()
+        # one question per channel at a time, across every replica
+        future = scheduler.submit(event['user'],
+                         event['channel'],
+                         channel_locked(coordination, long_running_task, ttl=request_deadline_seconds),
+                         event['channel'],
+                         event['user'],
+                         message_without_bot_mention,
+                         kibana_url,
+                         auth,
+                         connector_router,
+                         event=event,
+                         )
+        if overloaded:
+            say(overload_guard.notice(event['channel'], max(1, scheduler.position(future))))
+
+
+# Ack the mention right away and handle it as a lazy listener, so a slow say() can not
+# delay the ack past Slack's 3 seconds and cause a redelivery
+app.event("app_mention")(ack=ack_immediately, lazy=[mention_handler])
 
 
 # Log all events received
@@ -404,10 +894,138 @@ def log_all_events(event, logger):
     logger.debug(f"Received event: {event}")
 
 
+##########################################################################################
+### Async Slack Stuff
+##########################################################################################
+
+async def async_long_running_task(async_app, event, channel_id, user_id, msg, kb_url, ath, router):
+    """long_running_task for the async runtime, awaits the assistant stream and the Slack Web API calls.
+    One event loop serves every channel, the Kibana streams run on the scheduler's workers.
+    Everything else that blocks, the coordination backend, connector discovery and the conversation
+    updates of the stream's events, runs on the loop's default executor."""
+    loop = asyncio.get_running_loop()
+    deadline = Deadline(request_deadline_seconds)
+    # one question per channel at a time, across every replica
+    async with coordination.async_lock(f"channel:{channel_id}", ttl=request_deadline_seconds):
+        tier, candidates = await loop.run_in_executor(None, question_tier, msg)
+        started = time.monotonic()
+        try:
+            # an ongoing conversation stays on its connector as long as its questions stay in the same tier
+            conn_id = await loop.run_in_executor(None, lambda: router.route(get_conversation()['id'], candidates=candidates))
+            async for response_line in iterate_in_executor(scheduler.executor(user_id, channel_id, event),
+                                                           getAssistantsResponse,
+                                                           kb_url,
+                                                           ath,
+                                                           conn_id,
+                                                           msg,
+                                                           router=router,
+                                                           hedge_policy=hedge_policy,
+                                                           deadline=deadline,
+                                                           ):
+                if isinstance(response_line, dict) and response_line.get("type") == "chatCompletionChunk":
+                    # most events are chunks, Slack shows none of them
+                    continue
+                try:
+                    calls = await loop.run_in_executor(None, slack_calls_for, response_line, channel_id, user_id, conn_id, router)
+                    for method, kwargs in calls:
+                        await getattr(async_app.client, method)(**kwargs)
+                except KeyError:
+                    print(f"KeyError encountered while processing line: {response_line}")
+                except AttributeError:
+                    print(f"AttributeError encountered while processing json: \n{response_line}")
+        except (KibanaUnavailable, AdmissionRejected, requests.exceptions.RequestException) as e:
+            print(f"Kibana call failed: {e}")
+            await async_app.client.chat_postMessage(channel=channel_id, text=f'<@{user_id}>: {e}')
+        finally:
+            await loop.run_in_executor(None, record_tier, tier, started, msg)
+
+
+def build_async_app():
+    """Builds the AsyncApp and AsyncSocketModeHandler used when "async_runtime" is set in the creds file.
+    Needs aiohttp, like every slack_bolt async app.
+
+    Returns:
+      (tuple) (AsyncApp, AsyncSocketModeHandler)
+    """
+    from slack_bolt.async_app import AsyncApp
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+
+    async_app = AsyncApp(token=bot_oauth_token)
+    async_app.use(event_dedupe.async_middleware)
+
+    async def async_mention_handler(event, say):
+        message_without_bot_mention = re.sub(r"<@[\w]+>", '', event['text']).strip()
+
+        # the briefing lookup takes the conversation lock, it runs off the event loop
+        briefing = None if 'run xyz task' in message_without_bot_mention \
+            else await asyncio.get_running_loop().run_in_executor(None, materialized_briefing, message_without_bot_mention)
+
+        if 'run xyz task' in message_without_bot_mention:
+            await say(f"<@{event['user']}>: Sure, I'll run the xyz task!")
+        elif briefing is not None:
+            text = f"<@{event['user']}>: {briefing}".replace('**', '*')
+            await say(blocks=markdown_blocks_simple(text), text=text)
+        elif overload_guard.full():
+            await say(f"<@{event['user']}>: I'm overloaded right now, please ask again in a few minutes.")
+        elif scheduler.classify(event['user'], event) == "bot" and overload_guard.shed_bot_request():
+            print(f"Shed a bot request in {event['channel']} while overloaded")
+        elif message_without_bot_mention.lower().startswith('report '):
+            await say(f"Updating the report for this channel...")
+            await asyncio.get_running_loop().run_in_executor(scheduler.executor(event['user'], event['channel'], event),
+                                                             report_task,
+                                                             event['channel'],
+                                                             event['user'],
+                                                             message_without_bot_mention[len('report '):].strip(),
+                                                             )
+        elif fanout_clusters and message_without_bot_mention.lower().startswith('fanout '):
+            # the fan-out blocks on its cluster threads, it runs on the scheduler like in the threaded runtime
+            await asyncio.get_running_loop().run_in_executor(scheduler.executor(event['user'], event['channel'], event),
+                                                             fanout_task,
+                                                             event['channel'],
+                                                             event['user'],
+                                                             message_without_bot_mention[len('fanout '):].strip(),
+                                                             )
+        else:
+            if overload_guard.overloaded():
+                # the stream is submitted to the scheduler below, it lands behind what is queued now
+                await say(overload_guard.notice(event['channel'], scheduler.depth() + 1))
+            else:
+                await say(f"I'm working on your request. Please standby...")
+            # lazy listeners run as their own task, so the answer is awaited right here
+            await async_long_running_task(async_app,
+                                          event,
+                                          event['channel'],
+                                          event['user'],
+                                          message_without_bot_mention,
+                                          kibana_url,
+                                          auth,
+                                          connector_router,
+                                          )
+
+    async_app.event("app_mention")(ack=async_ack_immediately, lazy=[async_mention_handler])
+
+    @async_app.event({"type": re.compile(".*")})
+    async def async_log_all_events(event, logger):
+        logger.debug(f"Received event: {event}")
+
+    return async_app, AsyncSocketModeHandler(async_app, app_level_token)
+
+
 ##########################################################################################
 ### run the app
 ##########################################################################################
 
 # Start your app
 if __name__ == "__main__":
-    handler.start()
+    # Answer OpsHuman/OpsExpert investigation loops over a local socket instead of Slack mentions
+    if creds.get('bot_channel_port'):
+        slack_mirror = SlackMirror(app.client)
+        # the bot channel is unauthenticated, it only listens beyond localhost when bot_channel_bind says so
+        BotChannelServer(scheduled_bot_answer, creds['bot_channel_port'], creds.get('bot_channel_bind', '127.0.0.1')).start()
+    if shift_briefings is not None:
+        shift_briefings.start()
+    if creds.get('async_runtime', False):
+        async_app, async_handler = build_async_app()
+        asyncio.run(async_handler.start_async())
+    else:
+        handler.start()
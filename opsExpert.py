@@ -2,7 +2,9 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 import re
 import json
+import time
 import threading
+import httpx
 import requests
 
 from langchain_openai import AzureChatOpenAI
@@ -10,6 +12,16 @@ from langchain.chains import ConversationChain
 from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
 from langchain.prompts.prompt import PromptTemplate
 
+from llm_cache import persona_llm_cache
+from admission import AdmissionController, AdmissionRejected, estimate_tokens, azure_rate_limit_hook
+from model_tiering import ModelTiers, persona_task
+from slack_dedupe import EventDeduplicator, ack_immediately
+from bot_channel import BotChannelClient, SlackMirror, investigation_loop, explore_hypotheses, merge_findings
+from coordination import coordination_backend, channel_locked
+from coordination_memory import CoordinatedChatMessageHistory
+from snapshots import snapshot_store
+from sessions import SessionManager
+
 
 ##########################################################################################
 ### creds Stuff
@@ -24,6 +36,13 @@ def load_credentials(file_path):
 # Load credentials
 creds = load_credentials('.creds-opsexpert-observe')
 
+# Memory and channel sessions shared by every replica of the persona
+coordination = coordination_backend(creds)
+
+# Memory and interaction budgets survive restarts when "snapshots" is set in the creds file
+snapshots = snapshot_store(creds)
+
+# only rendered into the prompt, the live interaction count is kept per channel session
 int_count = 0
 
 ##########################################################################################
@@ -77,15 +96,28 @@ OpsHuman:"""
 
 PROMPT = PromptTemplate(input_variables=["history", "input"], template=template)
 
+# on-disk response cache for demo/regression replays, off unless "LLM_CACHE" is set in the creds file
+llm_cache = persona_llm_cache(creds, 'opsexpert')
+
+# Token bucket for the Azure OpenAI deployment, fed from its x-ratelimit-* response headers,
+# so the persona queues under its tokens-per-minute quota instead of running into 429s
+deployment = creds['AZURE_OPENAI_DEPLOYMENT']
+admission = AdmissionController(quotas={deployment: creds.get('AZURE_OPENAI_TOKENS_PER_MINUTE'),
+                                        creds.get('AZURE_OPENAI_SMALL_DEPLOYMENT'): creds.get('AZURE_OPENAI_SMALL_TOKENS_PER_MINUTE')},
+                                max_wait=creds.get('admission_max_wait', 30))
+
 openai = AzureChatOpenAI(
     model_name=creds['AZURE_OPENAI_DEPLOYMENT'],
     azure_endpoint=creds['AZURE_ENDPOINT'],
     azure_deployment=creds['AZURE_OPENAI_DEPLOYMENT'],
     api_key=creds['AZURE_OPENAI_KEY'],
-    api_version=creds['OPEN_AI_VERSION']
+    api_version=creds['OPEN_AI_VERSION'],
+    cache=llm_cache,
+    http_client=httpx.Client(event_hooks={"response": [azure_rate_limit_hook(admission, deployment)]})
 )
 
-conversation_memory = ConversationBufferMemory(ai_prefix="OpsHuman")
+conversation_memory = ConversationBufferMemory(ai_prefix="OpsHuman",
+                                               chat_memory=CoordinatedChatMessageHistory(coordination, 'opsexpert', snapshots=snapshots))
 # conversation_memory = ConversationSummaryMemory(ai_prefix="OpsHuman", llm=openai) # better but slower
 conversation = ConversationChain(
     prompt=PROMPT,
@@ -94,6 +126,30 @@ conversation = ConversationChain(
     memory=conversation_memory
 )
 
+# Simple or conversational turns go to a small, fast deployment when the creds file has one,
+# the investigations keep the main deployment
+small_deployment = creds.get('AZURE_OPENAI_SMALL_DEPLOYMENT')
+if small_deployment:
+    conversation_small = ConversationChain(
+        prompt=PROMPT,
+        llm=AzureChatOpenAI(
+            model_name=small_deployment,
+            azure_endpoint=creds['AZURE_ENDPOINT'],
+            azure_deployment=small_deployment,
+            api_key=creds['AZURE_OPENAI_KEY'],
+            api_version=creds['OPEN_AI_VERSION'],
+            # the small deployment's answers are cached apart from the main deployment's
+            cache=llm_cache.for_deployment(small_deployment) if llm_cache is not None else None,
+            http_client=httpx.Client(event_hooks={"response": [azure_rate_limit_hook(admission, small_deployment)]})
+        ),
+        verbose=True,
+        memory=conversation_memory
+    )
+else:
+    conversation_small = None
+model_tiers = ModelTiers({"small": conversation_small, "large": conversation},
+                         cost_per_1k_tokens=creds.get('model_tier_cost_per_1k_tokens'))
+
 
 ##########################################################################################
 ### Github Stuff
@@ -118,7 +174,7 @@ def create_github_issue(github_token, repo_owner, repo_name, issue_details):
         "Accept": "application/vnd.github.v3+json"
     }
     # Make the POST request to GitHub API to create the issue
-    response = requests.post(url, json=issue_details, headers=headers)
+    response = requests.post(url, json=issue_details, headers=headers, timeout=(5, 30))
 
     # Check for a successful response
     if response.status_code == 201:
@@ -181,6 +237,10 @@ def parse_github_issue_from_llm_response(response):
 bot_oauth_token = creds['bot_oauth_token']
 app = App(token=bot_oauth_token)
 
+# Drop Slack redeliveries of the same event before they reach any handler
+event_dedupe = EventDeduplicator(backend=coordination)
+app.use(event_dedupe.middleware)
+
 # Initialize SocketModeHandler with app and app-level token
 app_level_token = creds['app_level_token']
 handler = SocketModeHandler(app, app_level_token)
@@ -190,8 +250,24 @@ bot_info = app.client.auth_test()
 bot_user_id = bot_info["user_id"]
 print(f"Bot User ID: {bot_user_id}")
 
-# sleepy time
-is_sleeping = False
+# Talk to ObsBurger over a local socket during shiftstart investigations instead of Slack mentions,
+# the transcript is still mirrored to Slack in the background
+if creds.get('bot_channel_port'):
+    bot_channel = BotChannelClient(creds['bot_channel_port'], creds.get('bot_channel_host', '127.0.0.1'))
+    slack_mirror = SlackMirror(app.client)
+else:
+    bot_channel = None
+
+# Up to this many independent hypotheses are explored at once per investigation step, each in its
+# own forked ObsBurger conversation, 0 keeps the investigation strictly sequential
+max_hypotheses = creds.get('parallel_hypotheses', 0)
+
+# Per-channel sessions: naptime, interaction budget and idle expiry, driven by one timer wheel
+sessions = SessionManager(coordination, 'opsexpert', interaction_limit=10, snapshots=snapshots)
+
+summary_request = """Using my conversation history, 
+            generate a summary of the situation which would be suitable for a Level 2 operator
+            to resolve the issue."""
 
 
 # U06K15Y9TKM
@@ -208,8 +284,26 @@ def markdown_blocks_simple(text):
     ]
 
 
-def long_running_task(channel_id, user_id, msg, summary=False):
-    response = conversation.predict(input=msg)
+def generate_response(msg, from_obsburger=False):
+    # ObsBurger's answers are long and full of investigation terms whatever was asked, so a reply to
+    # ObsBurger is classified on the persona's own task: its last question, the shiftstart command at first
+    question = persona_task(conversation_memory.chat_memory.messages) if from_obsburger else None
+    # summaries need the large model whatever the wording
+    tier = "large" if msg == summary_request else model_tiers.classify(question or msg)
+    # the prompt as the LLM sees it, history included
+    prompt = PROMPT.format(history=conversation_memory.buffer, input=msg)
+    tokens = estimate_tokens(prompt)
+    target = model_tiers.target(tier)
+    # a cached replay makes no Azure OpenAI call, it takes nothing from the quota.
+    # AdmissionRejected goes to the caller, an error must not become the persona's next message
+    if llm_cache is None or not llm_cache.contains(target.llm, prompt):
+        admission.admit(small_deployment if tier == "small" else deployment, tokens)
+    started = time.monotonic()
+    response = target.predict(input=msg)
+    model_tiers.record(tier, time.monotonic() - started, tokens)
+    print(f"Model tiers: {model_tiers.report()}")
+    if llm_cache is not None:
+        print(f"LLM cache: {llm_cache.stats()}")
 
     # Check if the response contains GitHub issue information
     if "GITHUB_START" in response and "GITHUB_END" in response:
@@ -239,6 +333,17 @@ def long_running_task(channel_id, user_id, msg, summary=False):
         # If no GitHub issue information is found, use the original response
         response_with_issue_url = response
 
+    return response_with_issue_url
+
+
+def long_running_task(channel_id, user_id, msg, summary=False):
+    try:
+        response_with_issue_url = generate_response(msg, from_obsburger=user_id == 'U06K15Y9TKM')  # ObsBurger's answers in Slack
+    except AdmissionRejected as e:
+        # posted without a mention, so ObsBurger is never asked to answer an error
+        app.client.chat_postMessage(channel=channel_id, text=f"Azure OpenAI is over its quota, try again in a minute ({e}).")
+        return
+
     # Format the response for Slack, mentioning the user if necessary
     if user_id != '@U06KCGTFTC4' and not summary:
         response_to_send = f'<@{user_id}>: {response_with_issue_url}'
@@ -290,16 +395,80 @@ def long_running_task(channel_id, user_id, msg, summary=False):
 # else:
 #     print("Issue details could not be parsed. Unable to create GitHub issue.")
 
-def wake_up():
-    global is_sleeping
-    is_sleeping = False
+def propose_hypotheses(answer):
+    """Asks the LLM for independent hypotheses worth testing in parallel after ObsBurger's answer.
+    The proposal does not enter the conversation memory, only the findings do.
 
+    Returns:
+      (list) up to max_hypotheses dicts with "hypothesis" and "question", empty to continue sequentially
+    """
+    prompt = f"""{system_message}
+
+Current conversation:
+{conversation_memory.buffer}
+ObsBurger: {answer}
+
+Before asking your next question, decide whether the issue has several independent explanations worth checking at the same time, for example latency in APM, a spike of errors in the logs or saturated infrastructure.
+If it does, list up to {max_hypotheses} of them, each with one targeted question for @obsburger that confirms or rules it out.
+Answer only with a JSON list like [{{"hypothesis": "...", "question": "..."}}].
+Answer [] if a single next question is enough or you are ready to conclude."""
+    # weighing explanations needs the large model, asked through the tiers and the cache like generate_response
+    tier = "large"
+    target = model_tiers.target(tier)
+    tokens = estimate_tokens(prompt)
+    try:
+        if llm_cache is None or not llm_cache.contains(target.llm, prompt):
+            admission.admit(deployment, tokens)
+    except AdmissionRejected as e:
+        print(f"Not proposing hypotheses: {e}")
+        return []
+    started = time.monotonic()
+    response = target.llm.invoke(prompt).content
+    model_tiers.record(tier, time.monotonic() - started, tokens)
+    try:
+        hypotheses = json.loads(response[response.find('['):response.rfind(']') + 1])
+    except ValueError:
+        print(f"Could not parse hypotheses: {response}")
+        return []
+    return [h for h in hypotheses if isinstance(h, dict) and h.get('hypothesis') and h.get('question')][:max_hypotheses]
+
+
+def bot_channel_turn(channel_id, answer):
+    """Handles ObsBurger's answer received over the bot channel, like mention_handler does for Slack mentions
+
+    Returns:
+      (tuple) (next message for ObsBurger, True when the investigation is finished)
+    """
+    session = sessions.session(channel_id)
+    # naptime stops a running investigation like it stops Slack mentions
+    if session.sleeping:
+        return "Taking a nap, stopping the investigation here.", True
+    if not session.interact():
+        try:
+            return generate_response(summary_request), True
+        except AdmissionRejected as e:
+            return f"Azure OpenAI is over its quota, stopping the investigation here ({e}).", True
+    if max_hypotheses:
+        hypotheses = propose_hypotheses(answer)
+        if hypotheses:
+            findings = explore_hypotheses(channel_id,
+                                          hypotheses,
+                                          lambda question, fork: bot_channel.ask_fork(channel_id, bot_user_id, question, fork),
+                                          slack_mirror,
+                                          'OpsExpert',
+                                          max_parallel=max_hypotheses,
+                                          )
+            # the findings reach the main memory as the input of this step
+            answer = merge_findings(answer, findings)
+    try:
+        reply = generate_response(answer, from_obsburger=True)
+    except AdmissionRejected as e:
+        # the investigation ends here instead of sending the error to ObsBurger as its next question
+        return f"Azure OpenAI is over its quota, stopping the investigation here ({e}).", True
+    return reply, "done investigating" in reply
 
-@app.event("app_mention")
-def mention_handler(event, say):
-    global is_sleeping
-    global int_count
 
+def mention_handler(event, say):
     # Extract text from the event payload
     text = event['text']
 
@@ -310,21 +479,22 @@ def mention_handler(event, say):
     message_without_bot_mention = re.sub(bot_mention_pattern, '', text).strip()
 
 
+    session = sessions.session(event['channel'])
+
     # If the human is sleeping, do not process any commands
-    if is_sleeping:
+    if session.sleeping:
         return
 
 
     # Check if it is sleepy time if so sleep for 30 seconds
     if 'naptime' in message_without_bot_mention:
-        is_sleeping = True
         say("OpsHuman is sleepy. Taking a 60 second nap.")
-        threading.Timer(60, wake_up).start()
+        session.nap(60)
         return
 
     # when the user says 'shiftstart' we want to start a conversation with the AI
     elif 'shiftstart' in message_without_bot_mention:
-        int_count = 0
+        session.start_shift()
         command = message_without_bot_mention.replace('shiftstart', '').strip()
         obsburger = 'U06K15Y9TKM'
         first_command = f"<@{obsburger}> {command}"
@@ -333,23 +503,31 @@ def mention_handler(event, say):
         conversation_memory.save_context({"input": "OpsHuman"}, {"output": first_command})
 
         # start the conversation with obsburger
-        say(first_command)
+        if bot_channel is not None:
+            channel_id = event['channel']
+            threading.Thread(target=investigation_loop,
+                             args=(channel_id,
+                                   first_command,
+                                   lambda question: bot_channel.ask(channel_id, bot_user_id, question),
+                                   lambda answer: bot_channel_turn(channel_id, answer),
+                                   slack_mirror,
+                                   'OpsExpert',
+                                   )
+                             ).start()
+        else:
+            say(first_command)
 
     else:
-        if int_count > 10:
-            message_without_bot_mention = """Using my conversation history, 
-            generate a summary of the situation which would be suitable for a Level 2 operator
-            to resolve the issue."""
+        if not session.interact():
+            message_without_bot_mention = summary_request
             say("OpsHuman has reached the interaction limit. Generating a summary...")
             # TODO -> add apm and token count then add "report"
         else:
-            # Increment the interaction count
-            int_count += 1
             # Acknowledge the user's request immediately
             say(f"Please standby...")
 
         # Start the long-running task in a new thread
-        threading.Thread(target=long_running_task,
+        threading.Thread(target=channel_locked(coordination, long_running_task),
                          args=(event['channel'],
                                event['user'],
                                message_without_bot_mention,
@@ -357,6 +535,11 @@ def mention_handler(event, say):
                          ).start()
 
 
+# Ack the mention right away and handle it as a lazy listener, so a slow say() can not
+# delay the ack past Slack's 3 seconds and cause a redelivery
+app.event("app_mention")(ack=ack_immediately, lazy=[mention_handler])
+
+
 # Log all events received
 @app.event({"type": re.compile(".*")})
 def log_all_events(event, logger):
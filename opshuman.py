@@ -10,6 +10,10 @@ import json
 from datetime import datetime, timedelta
 
 import threading
+
+from kibana_client import kibana_client, kibana_auth, KibanaUnavailable
+from slack_dedupe import EventDeduplicator, ack_immediately
+from coordination import coordination_backend
 from openai import AzureOpenAI
 
 
@@ -24,9 +28,9 @@ creds = load_credentials('.creds-opshuman-observe')
 
 # Kibana credentials
 kibana_url = creds['kibana_url']
-username = creds['username']
-password = creds['password']
-auth = (username, password)
+auth = kibana_auth(creds)
+# Bad credentials fail the startup instead of the first question
+kibana_client(kibana_url, auth).validate()
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -57,14 +61,7 @@ def getGenAIConnectorId(kibana_url, auth):
        Wrong Kibana url or credentials
        No GenAI connector
     """
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-    url_connector = f"{kibana_url}/api/actions/connectors"
-    connectors = requests.get(
-        url=url_connector, headers=headers, auth=auth, verify=True
-    )
+    connectors = kibana_client(kibana_url, auth).get("/api/actions/connectors")
     if connectors.status_code == 404:
         raise Exception("ERROR - Wrong Kibana url or credentials")
     connectors_ai = [
@@ -92,11 +89,6 @@ def getAssistantsResponse(kibana_url, auth, connector_id, user_question):
 
     """
 
-    headers = {
-        "kbn-xsrf": "true",
-        "Content-Type": "application/json",
-    }
-
     assistant_system_message = (
     'You are OpsHuman, styled as a Level 1 operations expert with limited expertise in observability. '
     'Your primary role is to simulate a beginners interaction with Elasticsearch Observability, primarily '
@@ -144,10 +136,17 @@ def getAssistantsResponse(kibana_url, auth, connector_id, user_question):
     }
     data = json.dumps(data)
 
-    url = f"{kibana_url}/internal/observability_ai_assistant/chat/complete"
-    response = requests.post(
-        url=url, headers=headers, auth=auth, verify=True, data=data
-    )
+    client = kibana_client(kibana_url, auth)
+    try:
+        # chat/complete answers in NDJSON, so the idle timeout bounds the gap between two events
+        response = client.post(
+            "/internal/observability_ai_assistant/chat/complete",
+            data,
+            read_timeout=client.stream_idle_timeout,
+        )
+    except (KibanaUnavailable, requests.exceptions.RequestException) as e:
+        print(f"Kibana call failed: {e}")
+        return f"ERROR: {e}"
 
     try:
         assistant_response = [
@@ -169,6 +168,10 @@ connector_id = getGenAIConnectorId(kibana_url, auth)
 bot_oauth_token = creds['bot_oauth_token']
 app = App(token=bot_oauth_token)
 
+# Drop Slack redeliveries of the same event before they reach any handler
+event_dedupe = EventDeduplicator(backend=coordination_backend(creds))
+app.use(event_dedupe.middleware)
+
 # Initialize SocketModeHandler with your app and app-level token
 app_level_token = creds['app_level_token']
 handler = SocketModeHandler(app, app_level_token)
@@ -212,7 +215,6 @@ def long_running_task(channel_id,
 
 
 
-@app.event("app_mention")
 def mention_handler(event, say):
     # Extract text from the event payload
     text = event['text']
@@ -260,6 +262,11 @@ def mention_handler(event, say):
                          ).start()
 
 
+# Ack the mention right away and handle it as a lazy listener, so a slow say() can not
+# delay the ack past Slack's 3 seconds and cause a redelivery
+app.event("app_mention")(ack=ack_immediately, lazy=[mention_handler])
+
+
 # Log all events received
 @app.event({"type": re.compile(".*")})
 def log_all_events(event, logger):
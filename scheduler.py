@@ -0,0 +1,162 @@
+import time
+import threading
+
+from collections import deque
+from concurrent.futures import Future
+
+# Slack bots that talk to ObsBurger in investigation loops (ObsBurger itself, OpsHuman/OpsExpert)
+known_bot_user_ids = ('U06K15Y9TKM', 'U06KCGTFTC4')
+
+
+class _Job:
+    __slots__ = ("func", "args", "kwargs", "future", "channel_id", "requester", "start", "finish")
+
+    def __init__(self, func, args, kwargs, channel_id, requester, start, finish):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.channel_id = channel_id
+        self.requester = requester
+        self.start = start
+        self.finish = finish
+
+
+class FairScheduler:
+    """Runs assistant requests on a fixed pool of workers with weighted fair queuing.
+
+    Every (requester class, channel) pair is a flow with its own queue. Jobs are tagged with
+    a virtual finish time of cost / weight past their flow's previous job (start-time fair
+    queuing), and workers always take the smallest tag. Humans weigh more than bots, so an
+    investigation loop firing questions back-to-back gets its fair share without pushing the
+    answers to engineers to the back. A channel runs one job at a time, and a flow runs its jobs in order.
+
+    Args:
+      (int) workers: number of worker threads, i.e. concurrent assistant requests
+      (dict) weights: weight per requester class, "human" and "bot"
+      (tuple) bot_user_ids: Slack user ids treated as bots
+    """
+
+    def __init__(self, workers=4, weights=None, bot_user_ids=known_bot_user_ids):
+        self.workers = workers
+        self.weights = weights or {"human": 8.0, "bot": 1.0}
+        self.bot_user_ids = set(bot_user_ids)
+        self._flows = {}
+        self._finish = {}
+        self._virtual_time = 0.0
+        self._running_channels = set()
+        self._running = 0
+        self._durations = deque(maxlen=50)
+        self._cond = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def classify(self, user_id, event=None):
+        """Returns the requester class, "bot" for known bot users and messages posted by a bot"""
+        if user_id in self.bot_user_ids or (event is not None and event.get('bot_id')):
+            return "bot"
+        return "human"
+
+    def submit(self, user_id, channel_id, func, *args, cost=1.0, event=None, requester=None, **kwargs):
+        """Queues func(*args, **kwargs) for the requester's flow in the channel
+
+        Args:
+          (str) user_id: Slack user asking
+          (str) channel_id: Slack channel asked in
+          (callable) func: the work, e.g. long_running_task
+          (float) cost: relative cost of the job, e.g. its estimated tokens
+          (dict) event: Slack event, to recognise messages posted by other bots
+          (str) requester: requester class, overrides the classification
+
+        Returns:
+          (concurrent.futures.Future) result of func
+        """
+        requester = requester or self.classify(user_id, event)
+        flow = (requester, channel_id)
+        with self._cond:
+            start = max(self._virtual_time, self._finish.get(flow, 0.0))
+            finish = start + cost / self.weights[requester]
+            self._finish[flow] = finish
+            job = _Job(func, args, kwargs, channel_id, requester, start, finish)
+            self._flows.setdefault(flow, deque()).append(job)
+            self._cond.notify()
+        return job.future
+
+    def executor(self, user_id, channel_id, event=None):
+        """Adapter with the submit(fn, *args) signature of an Executor, for loop.run_in_executor"""
+        scheduler = self
+
+        class _Executor:
+            def submit(self, func, *args, **kwargs):
+                return scheduler.submit(user_id, channel_id, func, *args, event=event, **kwargs)
+
+        return _Executor()
+
+    def depth(self, requester=None):
+        """Returns the number of queued jobs, of one requester class if given"""
+        with self._cond:
+            return sum(len(jobs) for (cls, _), jobs in self._flows.items() if requester in (None, cls))
+
+    def position(self, future):
+        """Returns the place in the queue of a submitted job, 1 for next, 0 once it runs"""
+        with self._cond:
+            queued = [job for jobs in self._flows.values() for job in jobs]
+            for job in queued:
+                if job.future is future:
+                    # ties count as ahead, the estimate errs on the long side
+                    return 1 + sum(1 for other in queued if other is not job and other.finish <= job.finish)
+            return 0
+
+    def running(self):
+        with self._cond:
+            return self._running
+
+    def median_duration(self):
+        """Returns the median run time of recent jobs in seconds, None before the first one finished"""
+        with self._cond:
+            durations = sorted(self._durations)
+        return durations[len(durations) // 2] if durations else None
+
+    def _next_job(self):
+        best = None
+        for flow, jobs in self._flows.items():
+            if flow[1] in self._running_channels:
+                continue
+            # humans win ties
+            if best is None or (jobs[0].finish, flow[0] != "human") < (best[1][0].finish, best[0][0] != "human"):
+                best = (flow, jobs)
+        if best is None:
+            return None
+        flow, jobs = best
+        job = jobs.popleft()
+        if not jobs:
+            del self._flows[flow]
+        # the virtual time is the start tag of the job in service
+        self._virtual_time = max(self._virtual_time, job.start)
+        if len(self._finish) > 10000:
+            # forget idle flows, their next job starts at the virtual time anyway
+            self._finish = {f: tag for f, tag in self._finish.items() if tag > self._virtual_time}
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running_channels.add(job.channel_id)
+                self._running += 1
+            started = time.monotonic()
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.func(*job.args, **job.kwargs))
+                    except BaseException as e:
+                        job.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._durations.append(time.monotonic() - started)
+                    self._running_channels.discard(job.channel_id)
+                    self._running -= 1
+                    self._cond.notify_all()
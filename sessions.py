@@ -0,0 +1,238 @@
+import math
+import time
+import threading
+
+
+class WheelTimer:
+    """Handle of a callback scheduled on a TimerWheel"""
+
+    __slots__ = ("expires", "callback", "args", "cancelled")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # cancelled timers stay in their slot and are skipped when it comes around, which keeps cancel O(1)
+        self.cancelled = True
+
+
+class TimerWheel:
+    """Hierarchical timer wheel, one thread drives every timer of the process.
+
+    Level 0 has one slot per tick, each further level has slots spanning a full turn of the
+    level below. A timer goes into the lowest level that covers its delay and cascades down
+    a level each time the slot it sits in comes around, so scheduling and cancelling are O(1)
+    however many sessions are tracked.
+
+    Args:
+      (float) tick: resolution in seconds
+      (tuple) sizes: slots per level, the default covers 64^3 ticks (about 72 hours at 1s)
+    """
+
+    def __init__(self, tick=1.0, sizes=(64, 64, 64)):
+        self.tick = tick
+        self.sizes = sizes
+        self.spans = [math.prod(sizes[:level]) for level in range(len(sizes))]
+        self.wheels = [[[] for _ in range(size)] for size in sizes]
+        self.current = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, delay, callback, *args):
+        """Runs callback(*args) on the wheel thread after delay seconds, rounded up to the tick
+
+        Returns:
+          (WheelTimer) handle to cancel the timer
+        """
+        with self._lock:
+            # counted from the clock rather than the last processed tick, so a timer never fires early
+            expires = math.ceil((time.monotonic() - self._started + delay) / self.tick)
+            timer = WheelTimer(max(self.current + 1, expires), callback, args)
+            self._place(timer)
+        return timer
+
+    def _place(self, timer):
+        remaining = timer.expires - self.current
+        for level, size in enumerate(self.sizes):
+            if remaining < self.spans[level] * size or level == len(self.sizes) - 1:
+                self.wheels[level][(timer.expires // self.spans[level]) % size].append(timer)
+                return
+
+    def _advance(self):
+        """Moves the wheel one tick forward and returns the timers due"""
+        with self._lock:
+            self.current += 1
+            # cascade from the top, so timers can drop more than one level in the same tick
+            for level in range(len(self.sizes) - 1, 0, -1):
+                if self.current % self.spans[level] == 0:
+                    slot = (self.current // self.spans[level]) % self.sizes[level]
+                    timers, self.wheels[level][slot] = self.wheels[level][slot], []
+                    for timer in timers:
+                        if not timer.cancelled:
+                            self._place(timer)
+            slot = self.current % self.sizes[0]
+            timers, self.wheels[0][slot] = self.wheels[0][slot], []
+            due = []
+            for timer in timers:
+                if timer.cancelled:
+                    continue
+                if timer.expires <= self.current:
+                    due.append(timer)
+                else:
+                    self._place(timer)
+            return due
+
+    def _run(self):
+        while True:
+            # catch up on ticks missed while callbacks ran
+            target = int((time.monotonic() - self._started) / self.tick)
+            while self.current < target:
+                for timer in self._advance():
+                    try:
+                        timer.callback(*timer.args)
+                    except Exception as e:
+                        print(f"Timer callback failed: {e}")
+            time.sleep(max(0.0, self._started + (self.current + 1) * self.tick - time.monotonic()))
+
+
+_timer_wheel = None
+_timer_wheel_lock = threading.Lock()
+
+
+def timer_wheel():
+    """Returns the timer wheel shared by the whole process"""
+    global _timer_wheel
+    with _timer_wheel_lock:
+        if _timer_wheel is None:
+            _timer_wheel = TimerWheel()
+        return _timer_wheel
+
+
+class ChannelSession:
+    """State of a persona in one Slack channel: active, sleeping after naptime, or expired
+    once the channel has been idle. The interaction budget and the nap are kept in the
+    coordination backend, so every replica sees the same session.
+
+    Sessions are created by SessionManager.session, not directly.
+    """
+
+    ACTIVE = "active"
+    SLEEPING = "sleeping"
+    EXPIRED = "expired"
+
+    def __init__(self, manager, channel_id):
+        self.manager = manager
+        self.channel_id = channel_id
+        self.state = self.ACTIVE
+        self._prefix = f"{manager.persona}:{channel_id}"
+        self._wake_timer = None
+        self._idle_timer = None
+
+    @property
+    def sleeping(self):
+        if self.state == self.SLEEPING:
+            return True
+        # a nap may have been started on another replica
+        return self.manager.backend.get(f"{self._prefix}:sleeping", False)
+
+    def nap(self, seconds):
+        """Stops handling the channel for the given seconds"""
+        with self.manager.lock:
+            self.state = self.SLEEPING
+            self.manager.backend.set(f"{self._prefix}:sleeping", True, ttl=seconds)
+            if self._wake_timer is not None:
+                self._wake_timer.cancel()
+            self._wake_timer = self.manager.wheel.schedule(seconds, self.wake)
+
+    def wake(self):
+        with self.manager.lock:
+            if self.state == self.SLEEPING:
+                self.state = self.ACTIVE
+            self.manager.backend.delete(f"{self._prefix}:sleeping")
+            self._wake_timer = None
+
+    def start_shift(self):
+        """Resets the interaction budget for a new investigation"""
+        self.manager.backend.set(f"{self._prefix}:int_count", 0, ttl=self.manager.idle_timeout)
+        if self.manager.snapshots is not None:
+            self.manager.snapshots.compact(self._prefix, {"int_count": 0, "at": time.time()})
+
+    def interact(self):
+        """Counts one interaction
+
+        Returns:
+          (boolean) False once the interaction limit of the persona is reached
+        """
+        # a count started before start_shift must expire with the session too
+        count = self.manager.backend.incr(f"{self._prefix}:int_count", ttl=self.manager.idle_timeout)
+        if self.manager.snapshots is not None:
+            self.manager.snapshots.append(self._prefix, {"int_count": count, "at": time.time()})
+        # the count before this interaction is what the limit was always checked against
+        return self.manager.interaction_limit is None or count - 1 <= self.manager.interaction_limit
+
+    def _restore(self):
+        """Brings the interaction budget back from the snapshots after a restart, unless a replica still has it"""
+        records = self.manager.snapshots.load(self._prefix)
+        if not records:
+            return
+        idle = time.time() - records[-1]["at"]
+        if idle >= self.manager.idle_timeout:
+            # the session expired while the bot was down
+            self.manager.snapshots.clear(self._prefix)
+        elif self.manager.backend.get(f"{self._prefix}:int_count") is None:
+            self.manager.backend.set(f"{self._prefix}:int_count", records[-1]["int_count"],
+                                     ttl=self.manager.idle_timeout - idle)
+            self.manager.snapshots.compact(self._prefix, records[-1])
+
+    def _expire(self):
+        with self.manager.lock:
+            if self._wake_timer is not None:
+                self._wake_timer.cancel()
+            self.state = self.EXPIRED
+            self.manager._sessions.pop(self.channel_id, None)
+            if self.manager.snapshots is not None:
+                self.manager.snapshots.clear(self._prefix)
+
+
+class SessionManager:
+    """Per-channel sessions of a persona, dropped once their channel has been idle for idle_timeout seconds
+
+    Args:
+      (CoordinationBackend) backend: shared backend of the replicas
+      (str) persona: persona name, the key prefix of its sessions
+      (int) interaction_limit: interactions per investigation before the persona summarises, None for no limit
+      (float) idle_timeout: seconds without activity before a session expires
+      (TimerWheel) wheel: timer wheel driving naps and expiry, the process-wide one by default
+      (SnapshotStore) snapshots: keeps the interaction budgets across restarts, optional.
+        A channel's session is restored when the channel next speaks, not at startup
+    """
+
+    def __init__(self, backend, persona, interaction_limit=None, idle_timeout=3600, wheel=None, snapshots=None):
+        self.backend = backend
+        self.snapshots = snapshots
+        self.persona = persona
+        self.interaction_limit = interaction_limit
+        self.idle_timeout = idle_timeout
+        self.wheel = wheel or timer_wheel()
+        self.lock = threading.RLock()
+        self._sessions = {}
+
+    def session(self, channel_id):
+        """Returns the channel's session, created if needed, and restarts its idle timer"""
+        with self.lock:
+            session = self._sessions.get(channel_id)
+            if session is None:
+                session = self._sessions[channel_id] = ChannelSession(self, channel_id)
+                if self.snapshots is not None:
+                    session._restore()
+            if session._idle_timer is not None:
+                session._idle_timer.cancel()
+            session._idle_timer = self.wheel.schedule(self.idle_timeout, session._expire)
+            return session
+
+    def __len__(self):
+        return len(self._sessions)
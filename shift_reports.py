@@ -0,0 +1,99 @@
+import re
+import time
+
+from datetime import datetime, timezone
+
+from briefings import briefing_key
+
+# "last 24 hours", "past 2 days", the range a report question asks about
+report_range_pattern = r"\b(?:in the |over the |for the )?(?:last|past)\s+(\d*)\s*(minute|hour|day|week)s?\b"
+
+unit_seconds = {"minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+
+
+def report_window(question, default_hours=24):
+    """Returns the seconds of the time range a report question asks about, e.g. 86400 for "last 24 hours" """
+    match = re.search(report_range_pattern, question, re.IGNORECASE)
+    if match is None:
+        return default_hours * 3600
+    return int(match.group(1) or 1) * unit_seconds[match.group(2).lower()]
+
+
+def iso(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class ShiftReports:
+    """Keeps a report per channel and question up to date incrementally. The last report is stored
+    with the end of the time range it covers (its watermark), and the next run asks the assistant
+    only about the time since the watermark, with the last report as context to merge into. ES|QL
+    scans and prompt tokens then follow the amount of new data instead of the length of the range.
+
+    Args:
+      (CoordinationBackend) backend: where the reports and watermarks are kept
+      (float) default_hours: range of a question that does not name one
+      (float) lag_minutes: the watermark stays this far behind now, for data that is ingested late
+    """
+
+    def __init__(self, backend, default_hours=24, lag_minutes=2):
+        self.backend = backend
+        self.default_hours = default_hours
+        self.lag_minutes = lag_minutes
+
+    def _key(self, channel_id, question):
+        return f"report:{channel_id}:{briefing_key(question)}"
+
+    def prompt(self, channel_id, question, now=None):
+        """Builds the question for the assistant, only about the delta window when a previous report covers the rest
+
+        Returns:
+          (tuple) (prompt, window start, watermark) with the window bounds in epoch seconds
+        """
+        now = now or time.time()
+        window = report_window(question, self.default_hours)
+        watermark = now - self.lag_minutes * 60
+        window_start = watermark - window
+        previous = self.backend.get(self._key(channel_id, question))
+        if previous is None or previous["watermark"] <= window_start or previous["watermark"] >= watermark:
+            # nothing usable to build on, the whole range is investigated once
+            delta_start = window_start
+            previous = None
+        else:
+            delta_start = previous["watermark"]
+
+        time_range = f"between {iso(delta_start)} and {iso(watermark)}"
+        if re.search(report_range_pattern, question, re.IGNORECASE):
+            prompt = re.sub(report_range_pattern, time_range, question, count=1, flags=re.IGNORECASE)
+        else:
+            prompt = f"{question} {time_range}"
+        prompt += f'\nUse "start":"{iso(delta_start)}","end":"{iso(watermark)}" as the time range of every function.'
+        if previous is not None:
+            prompt += (f"\n\nThis is an update of the report below, which covers {iso(previous['window_start'])} to "
+                       f"{iso(previous['watermark'])}. Do not investigate that range again. Merge what you find into "
+                       f"the report and reply with the updated report for {iso(window_start)} to {iso(watermark)}, "
+                       f"leaving out findings from before {iso(window_start)}.\n\nPrevious report:\n{previous['report']}")
+        return prompt, window_start, watermark
+
+    def store(self, channel_id, question, report, window_start, watermark):
+        """Stores a report and the watermark its range ends at"""
+        window = report_window(question, self.default_hours)
+        self.backend.set(self._key(channel_id, question),
+                         {"report": report, "window_start": window_start, "watermark": watermark},
+                         ttl=window)
+
+    def run(self, channel_id, question, ask):
+        """Updates the channel's report for the question
+
+        Args:
+          (str) channel_id: Slack channel the report is kept for
+          (str) question: report question, e.g. "any alerts in the last 24 hours"
+          (callable) ask: function (prompt) -> the assistant's answer, None when it failed
+
+        Returns:
+          (str) the updated report, None when the assistant did not answer
+        """
+        prompt, window_start, watermark = self.prompt(channel_id, question)
+        report = ask(prompt)
+        if report:
+            self.store(channel_id, question, report, window_start, watermark)
+        return report
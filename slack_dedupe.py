@@ -0,0 +1,90 @@
+import time
+import asyncio
+import threading
+
+from collections import OrderedDict
+from slack_bolt import BoltResponse
+
+
+class EventDeduplicator:
+    """Drops Slack events that were already delivered, so a redelivery after a slow ack
+    never starts a second identical assistant or LLM call.
+
+    Events are keyed on the Events API event_id, falling back to the message's client_msg_id
+    or channel and timestamp. Keys are kept in a bounded set for ttl seconds.
+    Register it in front of every handler with app.use(dedupe.middleware), or dedupe.async_middleware for AsyncApp.
+    With a shared coordination backend the first replica to see an event claims it,
+    so a redelivery to another replica is dropped as well, and the backend purges the expired keys.
+
+    Args:
+      (float) ttl: seconds a delivered event is remembered, Slack retries within minutes
+      (int) max_entries: upper bound of remembered events
+      (CoordinationBackend) backend: shared backend of the replicas, optional
+    """
+
+    def __init__(self, ttl=900, max_entries=10000, backend=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.suppressed = 0
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def event_key(body):
+        event = body.get("event") or {}
+        if body.get("event_id"):
+            return body["event_id"]
+        if event.get("client_msg_id"):
+            return event["client_msg_id"]
+        if event.get("ts"):
+            return f"{event.get('channel')}:{event['ts']}"
+        return None
+
+    def is_duplicate(self, body):
+        """Records the event and returns True if it was seen within the ttl"""
+        key = self.event_key(body)
+        if key is None:
+            return False
+        if self.backend is not None:
+            if self.backend.add(f"event:{key}", ttl=self.ttl):
+                return False
+            with self._lock:
+                self.suppressed += 1
+            return True
+        now = time.monotonic()
+        with self._lock:
+            # keys are inserted in time order, so expired ones are at the front
+            while self._seen and next(iter(self._seen.values())) < now:
+                self._seen.popitem(last=False)
+            if key in self._seen:
+                self.suppressed += 1
+                return True
+            self._seen[key] = now + self.ttl
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return False
+
+    def middleware(self, body, next, logger):
+        if self.is_duplicate(body):
+            logger.info(f"Suppressed duplicate Slack event {self.event_key(body)} ({self.suppressed} suppressed so far)")
+            # answer 200 so Slack stops redelivering, without running any listener
+            return BoltResponse(status=200, body="")
+        return next()
+
+    async def async_middleware(self, body, next, logger):
+        """Same as middleware, for AsyncApp. The backend blocks on I/O, it is asked from the default executor"""
+        if await asyncio.get_running_loop().run_in_executor(None, self.is_duplicate, body):
+            logger.info(f"Suppressed duplicate Slack event {self.event_key(body)} ({self.suppressed} suppressed so far)")
+            return BoltResponse(status=200, body="")
+        return await next()
+
+
+def ack_immediately(ack):
+    """Acks the event before any work is done, the actual handler runs as a lazy listener"""
+    ack()
+
+
+async def async_ack_immediately(ack):
+    """Same as ack_immediately, for AsyncApp"""
+    await ack()
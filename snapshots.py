@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+
+class SnapshotStore:
+    """Append-only log of conversation state in a SQLite file, so the bots pick up their conversations,
+    persona memories and channel sessions after a restart.
+
+    Every turn appends only what changed, e.g. the new messages. Nothing is read at startup, a session
+    is loaded the first time it is used again and its log is then compacted to a single record, so
+    startup takes the same time however many sessions were snapshotted.
+
+    Args:
+      (str) path: SQLite file of the snapshots
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS snapshot_log (seq INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, record TEXT)"
+        )
+        self._db().execute("CREATE INDEX IF NOT EXISTS snapshot_log_session ON snapshot_log (session, seq)")
+
+    def _db(self):
+        # sqlite connections can not be shared between the handler threads
+        if getattr(self._local, "db", None) is None:
+            self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db.execute("PRAGMA journal_mode=WAL")
+            # a snapshot lost in a power cut only costs the last turn, fsync per turn is not worth it
+            self._local.db.execute("PRAGMA synchronous=NORMAL")
+        return self._local.db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def append(self, session, *records):
+        """Appends records to a session's log"""
+        with self._transaction() as db:
+            db.executemany(
+                "INSERT INTO snapshot_log (session, record) VALUES (?, ?)",
+                [(session, json.dumps(record)) for record in records],
+            )
+
+    def load(self, session):
+        """Returns the records of a session's log in the order they were appended"""
+        rows = self._db().execute(
+            "SELECT record FROM snapshot_log WHERE session = ? ORDER BY seq", (session,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def compact(self, session, *records):
+        """Replaces a session's log with the given records, e.g. the state folded from it"""
+        with self._transaction() as db:
+            db.execute("DELETE FROM snapshot_log WHERE session = ?", (session,))
+            db.executemany(
+                "INSERT INTO snapshot_log (session, record) VALUES (?, ?)",
+                [(session, json.dumps(record)) for record in records],
+            )
+
+    def clear(self, session):
+        self._db().execute("DELETE FROM snapshot_log WHERE session = ?", (session,))
+
+
+def snapshot_store(creds):
+    """Builds the snapshot store configured in a creds file, e.g. "snapshots": ".opsexpert-snapshots.sqlite"
+
+    Returns:
+      (SnapshotStore) the store, None without configuration
+    """
+    path = creds.get('snapshots')
+    return SnapshotStore(path) if path else None
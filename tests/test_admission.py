@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected, TokenBucket, estimate_tokens, \
+    azure_rate_limit_hook  # noqa: E402
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("x" * 400, completion_tokens=100) == 200
+
+
+def test_bucket_refills_at_the_quota_rate():
+    bucket = TokenBucket(6000)
+    bucket.tokens = 0.0
+    assert bucket.wait_for(100, bucket.updated) == pytest.approx(1.0)
+    assert bucket.wait_for(100, bucket.updated + 1.0) == 0.0
+
+
+def test_unknown_quota_is_admitted_right_away():
+    controller = AdmissionController()
+    for _ in range(100):
+        controller.admit("connector", 100000)
+    assert controller.stats()["admitted"] == 100
+
+
+def test_over_the_quota_is_rejected_after_max_wait():
+    controller = AdmissionController({"gpt-4": 6000}, max_wait=0.5)
+    controller.admit("gpt-4", 6000)
+    with pytest.raises(AdmissionRejected):
+        controller.admit("gpt-4", 6000)
+    assert controller.stats()["rejected"] == 1
+
+
+def test_short_wait_is_queued():
+    controller = AdmissionController({"gpt-4": 60000}, max_wait=2)
+    controller.admit("gpt-4", 60000)
+    started = time.monotonic()
+    controller.admit("gpt-4", 500)
+    assert 0.3 < time.monotonic() - started < 2
+
+
+def test_deadline_caps_the_wait():
+    controller = AdmissionController({"gpt-4": 6000}, max_wait=60)
+    controller.admit("gpt-4", 6000)
+    with pytest.raises(AdmissionRejected):
+        controller.admit("gpt-4", 600, deadline=SimpleNamespace(remaining=lambda: 1.0))
+
+
+def test_headers_reveal_and_lower_the_quota():
+    controller = AdmissionController(max_wait=0.5)
+    controller.update_from_headers("gpt-4", {"x-ratelimit-limit-tokens": "6000",
+                                             "x-ratelimit-remaining-tokens": "100"})
+    with pytest.raises(AdmissionRejected):
+        controller.admit("gpt-4", 1000)
+
+
+def test_throttled_blocks_for_retry_after():
+    controller = AdmissionController({"gpt-4": 600000}, max_wait=0.5)
+    azure_rate_limit_hook(controller, "gpt-4")(SimpleNamespace(status_code=429, headers={"retry-after": "5"}))
+    with pytest.raises(AdmissionRejected):
+        controller.admit("gpt-4", 1)
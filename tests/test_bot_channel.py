@@ -0,0 +1,41 @@
+import os
+import sys
+import socket
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_channel import BotChannelServer, BotChannelClient  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    def answer(channel_id, user_id, text, fork=None):
+        return f"{channel_id}:{text}" if fork is None else f"{fork}:{text}"
+
+    server = BotChannelServer(answer, 0)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_listens_on_localhost_by_default(server):
+    assert server._server.server_address[0] == "127.0.0.1"
+
+
+def test_ask(server):
+    client = BotChannelClient(server._server.server_address[1], timeout=5)
+    assert client.ask("C1", "U1", "any alerts?") == "C1:any alerts?"
+    assert client.ask_fork("C1", "U1", "disk full?", "hypothesis-1") == "hypothesis-1:disk full?"
+    client.close()
+
+
+def test_malformed_line_does_not_drop_the_connection(server):
+    with socket.create_connection(server._server.server_address, timeout=5) as sock:
+        file = sock.makefile("rwb")
+        file.write(b"not json\n")
+        file.write(b'{"channel": "C1", "user": "U1", "text": "still there?"}\n')
+        file.flush()
+        assert file.readline().startswith(b'{"text": "ERROR: request is not JSON')
+        assert file.readline() == b'{"text": "C1:still there?"}\n'
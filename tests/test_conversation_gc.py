@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("requests")  # conversation_gc imports through kibana_client
+
+from conversation_gc import gc, list_path, search_path, listing_cap  # noqa: E402
+
+
+def response(status_code=200, body=None):
+    return SimpleNamespace(status_code=status_code, json=lambda: body, text=json.dumps(body))
+
+
+class KibanaStub:
+    """Conversations API and conversations index, deletes show in the index only after a refresh like in Elasticsearch"""
+
+    def __init__(self, ages_in_days, user="obsburger", searchable=True):
+        now = datetime.now(timezone.utc)
+        self.conversations = {}
+        for index, days in enumerate(ages_in_days):
+            conversation_id = f"conv-{index:04d}"
+            self.conversations[conversation_id] = {
+                "user": {"name": user},
+                "conversation": {"id": conversation_id, "title": conversation_id,
+                                 "last_updated": (now - timedelta(days=days)).isoformat().replace("+00:00", "Z")},
+            }
+        self.indexed = dict(self.conversations)
+        self.searchable = searchable
+        self.deleted = []
+        self.searches = 0
+
+    def post(self, path, data, **kwargs):
+        body = json.loads(data)
+        if path == list_path:
+            newest = sorted(self.conversations.values(), key=lambda c: c["conversation"]["last_updated"], reverse=True)
+            return response(body={"conversations": newest[:listing_cap]})
+        assert path == search_path
+        if not self.searchable:
+            return response(400, {"error": "no privileges on the index"})
+        self.searches += 1
+        cutoff = body["query"]["bool"]["filter"][1]["range"]["conversation.last_updated"]["lt"]
+        cutoff = datetime.fromisoformat(cutoff)
+        hits = []
+        for conversation in self.indexed.values():
+            updated = datetime.fromisoformat(conversation["conversation"]["last_updated"].replace("Z", "+00:00"))
+            if updated < cutoff:
+                hits.append({"_source": conversation,
+                             "sort": [conversation["conversation"]["last_updated"], conversation["conversation"]["id"]]})
+        hits.sort(key=lambda hit: hit["sort"])
+        if "search_after" in body:
+            hits = [hit for hit in hits if hit["sort"] > body["search_after"]]
+        return response(body={"hits": {"hits": hits[:body["size"]]}})
+
+    def get(self, path, **kwargs):
+        return response(body=self.conversations[path.rsplit("/", 1)[1]])
+
+    def request(self, method, path, **kwargs):
+        conversation_id = path.rsplit("/", 1)[1]
+        self.deleted.append(conversation_id)
+        self.conversations.pop(conversation_id, None)
+        return response(204)
+
+
+def test_pages_through_every_expired_conversation():
+    kibana = KibanaStub([60] * 250 + [1] * 10)
+    stats = gc(kibana, "obsburger", retention_days=30, page_size=100)
+    assert stats["deleted"] == stats["expired"] == 250
+    assert len(set(kibana.deleted)) == 250
+    assert len(kibana.conversations) == 10
+    assert not stats["unreachable"]
+    assert kibana.searches == 3
+
+
+def test_dry_run_deletes_nothing():
+    kibana = KibanaStub([60] * 150 + [1] * 10)
+    stats = gc(kibana, "obsburger", retention_days=30, dry_run=True, page_size=100)
+    assert stats["expired"] == 150
+    assert kibana.deleted == []
+
+
+def test_archives_before_deleting(tmp_path):
+    kibana = KibanaStub([60, 1])
+    stats = gc(kibana, "obsburger", retention_days=30, archive_dir=str(tmp_path))
+    assert stats["archived"] == stats["deleted"] == 1
+    with open(tmp_path / "conv-0000.json") as file:
+        assert json.load(file)["conversation"]["id"] == "conv-0000"
+
+
+def test_api_fallback_reports_conversations_behind_the_listing_cap():
+    kibana = KibanaStub([60] * 20 + [1] * listing_cap, searchable=False)
+    stats = gc(kibana, "obsburger", retention_days=30)
+    assert stats["deleted"] == 0
+    assert stats["unreachable"]
+
+
+def test_api_fallback_collects_what_it_lists():
+    kibana = KibanaStub([60] * 20 + [1] * 10, searchable=False)
+    stats = gc(kibana, "obsburger", retention_days=30)
+    assert stats["deleted"] == 20
+    assert not stats["unreachable"]
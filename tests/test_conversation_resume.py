@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("requests")  # conversation_resume reads Kibana through kibana_client
+
+from conversation_resume import messages_after, is_final_answer, created_conversation_id, resume_request  # noqa: E402
+
+
+def message(role, content=None, function_call=None, timestamp="2024-01-01T00:00:00.000000"):
+    body = {"role": role, "content": content}
+    if function_call is not None:
+        body["function_call"] = function_call
+    return {"@timestamp": timestamp, "message": body}
+
+
+user_message = message("user", "any alerts?", timestamp="2024-01-01T00:00:01.000000")
+function_call = message("assistant", "", {"name": "alerts", "arguments": "{}"})
+function_result = {"@timestamp": "2024-01-01T00:00:02.000000", "message": {"role": "user", "name": "alerts", "content": "[]"}}
+
+
+def test_messages_after_returns_what_followed_the_question():
+    conversation = {"messages": [message("system", "be helpful"), user_message, function_call, function_result]}
+    assert messages_after(conversation, user_message) == [function_call, function_result]
+
+
+def test_messages_after_falls_back_to_the_content_when_kibana_rewrote_the_timestamp():
+    rewritten = dict(user_message, **{"@timestamp": "2024-01-01T00:00:01.000Z"})
+    conversation = {"messages": [rewritten, function_call]}
+    assert messages_after(conversation, user_message) == [function_call]
+
+
+def test_messages_after_without_the_question():
+    assert messages_after({"messages": [function_call]}, user_message) == []
+
+
+def test_is_final_answer():
+    assert is_final_answer(message("assistant", "No alerts in the last 24 hours."))
+    assert not is_final_answer(function_call)
+    assert not is_final_answer(message("assistant", "[]"))
+
+
+def test_resume_after_conversation_create_continues_the_created_conversation():
+    # the stream of a new persisted conversation broke right after Kibana created it
+    events = [
+        {"type": "conversationCreate", "conversation": {"id": "created-id"}},
+        {"type": "messageAdd", "message": function_call},
+    ]
+    data = {"connectorId": "c1", "persist": True, "messages": [user_message]}
+    resumed = resume_request(data, [], user_message, [function_call], events, conversation_id=None)
+    assert resumed["conversationId"] == "created-id"
+    assert resumed["messages"] == [user_message, function_call]
+    # the body of the broken attempt is left as it was
+    assert "conversationId" not in data
+
+
+def test_resume_keeps_the_known_conversation():
+    data = {"connectorId": "c1", "persist": True, "conversationId": "known-id"}
+    resumed = resume_request(data, [], user_message, [], [], conversation_id="known-id")
+    assert resumed["conversationId"] == "known-id"
+
+
+def test_resume_of_a_conversation_that_is_not_persisted_sends_no_id():
+    events = [{"type": "conversationCreate", "conversation": {"id": "created-id"}}]
+    resumed = resume_request({"persist": False}, [], user_message, [], events)
+    assert "conversationId" not in resumed
+
+
+def test_created_conversation_id_ignores_error_lines():
+    assert created_conversation_id(["ERROR: Response status code 502"]) is None
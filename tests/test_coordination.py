@@ -0,0 +1,215 @@
+import os
+import sys
+import time
+import socket
+import threading
+import socketserver
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coordination import MemoryBackend, SQLiteBackend, RedisBackend  # noqa: E402
+
+
+class RespStub(socketserver.ThreadingTCPServer):
+    """Local stand-in for Redis, speaking just enough RESP for RedisBackend"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RespHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+
+    def alive(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def incrby(self, key, amount):
+        entry = self.alive(key)
+        value = int(entry[0] if entry else 0) + int(amount)
+        self.data[key] = (str(value), entry[1] if entry else None)
+        return value
+
+    def execute(self, args):
+        command = args[0].upper()
+        self.commands.append(command)
+        with self.lock:
+            if command in ("AUTH", "SELECT"):
+                return "+OK"
+            if command == "GET":
+                entry = self.alive(args[1])
+                return None if entry is None else entry[0]
+            if command == "SET":
+                key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+                expires_at = None
+                if "PX" in options:
+                    expires_at = time.time() + int(args[3 + options.index("PX") + 1]) / 1000
+                if "NX" in options and self.alive(key) is not None:
+                    return None
+                self.data[key] = (value, expires_at)
+                return "+OK"
+            if command == "DEL":
+                return sum(self.data.pop(key, None) is not None for key in args[1:])
+            if command == "INCRBY":
+                return self.incrby(args[1], args[2])
+            if command == "EVAL" and args[1] == RedisBackend.INCR_WITH_EXPIRY:
+                created = self.alive(args[3]) is None
+                value = self.incrby(args[3], args[4])
+                if created:
+                    self.data[args[3]] = (str(value), time.time() + int(args[5]) / 1000)
+                return value
+            if command == "EVAL" and args[1] == RedisBackend.COMPARE_AND_DELETE:
+                entry = self.alive(args[3])
+                if entry is not None and entry[0] == args[4]:
+                    del self.data[args[3]]
+                    return 1
+                return 0
+            return RuntimeError(f"ERR unknown command {command}")
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode("utf-8"))
+        return args
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            reply = self.server.execute(args)
+            if reply is None:
+                data = b"$-1\r\n"
+            elif isinstance(reply, RuntimeError):
+                data = f"-{reply}\r\n".encode("utf-8")
+            elif isinstance(reply, int):
+                data = f":{reply}\r\n".encode("utf-8")
+            elif reply.startswith("+"):
+                data = f"{reply}\r\n".encode("utf-8")
+            else:
+                encoded = reply.encode("utf-8")
+                data = f"${len(encoded)}\r\n".encode("utf-8") + encoded + b"\r\n"
+            self.wfile.write(data)
+
+
+@pytest.fixture
+def resp_stub():
+    server = RespStub()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "coordination.sqlite"))
+    server = request.getfixturevalue("resp_stub")
+    return RedisBackend(port=server.server_address[1], password="secret", db=1)
+
+
+def test_get_set_delete(backend):
+    assert backend.get("missing", "default") == "default"
+    backend.set("conversation", {"messages": [1, 2]})
+    assert backend.get("conversation") == {"messages": [1, 2]}
+    backend.delete("conversation")
+    assert backend.get("conversation") is None
+
+
+def test_add_only_sets_absent_keys(backend):
+    assert backend.add("event:1", ttl=60)
+    assert not backend.add("event:1", ttl=60)
+
+
+def test_add_after_expiry(backend):
+    assert backend.add("event:1", ttl=0.05)
+    time.sleep(0.1)
+    assert backend.add("event:1", ttl=60)
+
+
+def test_incr(backend):
+    assert backend.incr("count") == 1
+    assert backend.incr("count", 2) == 3
+    assert backend.get("count") == 3
+
+
+def test_incr_gives_a_new_key_the_ttl(backend):
+    assert backend.incr("count", ttl=0.05) == 1
+    time.sleep(0.1)
+    assert backend.get("count") is None
+    assert backend.incr("count", ttl=0.05) == 1
+
+
+def test_incr_keeps_the_expiry_of_an_existing_key(backend):
+    backend.set("count", 0, ttl=0.05)
+    assert backend.incr("count", ttl=60) == 1
+    time.sleep(0.1)
+    assert backend.get("count") is None
+
+
+def test_delete_keeps_a_lock_taken_over_by_another_holder(backend):
+    backend.set("lock:channel:C1", "new-holder")
+    backend.delete("lock:channel:C1", "expired-holder")
+    assert backend.get("lock:channel:C1") == "new-holder"
+    backend.delete("lock:channel:C1", "new-holder")
+    assert backend.get("lock:channel:C1") is None
+
+
+def test_lock_is_exclusive(backend):
+    with backend.lock("channel:C1"):
+        with pytest.raises(TimeoutError):
+            with backend.lock("channel:C1", timeout=0.2, poll_interval=0.05):
+                pass
+    with backend.lock("channel:C1", timeout=0.2):
+        pass
+
+
+def test_redis_compare_and_delete_is_a_single_command(resp_stub):
+    redis = RedisBackend(port=resp_stub.server_address[1])
+    redis.set("lock:channel:C1", "token")
+    resp_stub.commands.clear()
+    redis.delete("lock:channel:C1", "token")
+    assert resp_stub.commands == ["EVAL"]
+
+
+def test_redis_reconnects_after_the_connection_drops(resp_stub):
+    redis = RedisBackend(port=resp_stub.server_address[1])
+    redis.set("key", 1)
+    redis._local.file.close()
+    redis._local.file = socket.socket().makefile("rwb")
+    assert redis.get("key") == 1
+
+
+def test_memory_backend_purges_expired_keys():
+    backend = MemoryBackend(sweep_interval=0.05)
+    for i in range(1000):
+        backend.add(f"event:{i}", ttl=0.01)
+    time.sleep(0.1)
+    backend.add("event:last", ttl=60)
+    assert list(backend._data) == ["event:last"]
+
+
+def test_sqlite_backend_purges_expired_keys(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "coordination.sqlite"), sweep_interval=0.05)
+    for i in range(100):
+        backend.add(f"event:{i}", ttl=0.01)
+    time.sleep(0.1)
+    backend.add("event:last", ttl=60)
+    assert backend._db().execute("SELECT key FROM coordination").fetchall() == [("event:last",)]
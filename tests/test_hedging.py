@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hedging import HedgePolicy, HedgedStream  # noqa: E402
+
+
+class RouterStub:
+    """Connector router with fixed percentiles, records what the streams report"""
+
+    def __init__(self, percentile=(None, 0), alternate="backup"):
+        self.percentile = percentile
+        self._alternate = alternate
+        self.events = []
+
+    def first_event_percentile(self, connector_id, percentile):
+        return self.percentile
+
+    def alternate(self, connector_id):
+        return self._alternate
+
+    def record_first_event(self, connector_id, seconds):
+        self.events.append(("first_event", connector_id))
+
+    def record_success(self, connector_id):
+        self.events.append(("success", connector_id))
+
+    def record_error(self, connector_id):
+        self.events.append(("error", connector_id))
+
+
+class ResponseStub:
+    def __init__(self, lines, delay, status_code=200):
+        self.lines = lines
+        self.delay = delay
+        self.status_code = status_code
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        self.closed.set()
+
+
+class ClientStub:
+    """Kibana client answering each connector after its own delay"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.requests = []
+
+    def post(self, path, data, stream=False, deadline=None):
+        payload = json.loads(data)
+        self.requests.append(payload)
+        connector_id = payload["connectorId"]
+        lines = [json.dumps({"type": "chatCompletionChunk", "connector": connector_id}).encode("utf-8")]
+        return ResponseStub(lines, self.delays[connector_id])
+
+    def iter_lines(self, response, deadline=None):
+        if response.closed.wait(response.delay):
+            return
+        yield from response.lines
+
+
+def test_default_delay_until_there_are_enough_samples():
+    assert HedgePolicy(RouterStub((1.0, 3)), default_delay=20.0).delay("primary") == 20.0
+    assert HedgePolicy(RouterStub((1.0, 30)), min_delay=2.0).delay("primary") == 2.0
+    assert HedgePolicy(RouterStub((5.0, 30))).delay("primary") == 5.0
+
+
+def test_hedge_fires_at_low_volume():
+    policy = HedgePolicy(RouterStub(), max_hedge_ratio=0.1)
+    policy.record_request()
+    assert policy.try_hedge()
+
+
+def test_hedge_budget_grows_with_the_requests():
+    policy = HedgePolicy(RouterStub(), max_hedge_ratio=0.1)
+    for _ in range(10):
+        policy.record_request()
+    assert policy.try_hedge()
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    assert policy.hedges_sent == 2
+
+
+def test_hedge_budget_is_computed_over_the_window():
+    policy = HedgePolicy(RouterStub(), max_hedge_ratio=0.0, window=0.05)
+    assert policy.try_hedge()
+    assert not policy.try_hedge()
+    time.sleep(0.1)
+    assert policy.try_hedge()
+
+
+def test_fast_primary_is_not_hedged():
+    client = ClientStub({"primary": 0.0, "backup": 0.0})
+    policy = HedgePolicy(RouterStub(), default_delay=1.0)
+    data = json.dumps({"connectorId": "primary", "persist": True, "conversationId": "c1"})
+    with HedgedStream(client, "/chat/complete", data, "primary", policy) as response:
+        lines = list(response.iter_lines())
+    assert not response.hedged
+    assert response.connector_id == "primary"
+    assert json.loads(lines[0])["connector"] == "primary"
+    assert len(client.requests) == 1
+
+
+def test_slow_primary_is_hedged_without_persisting():
+    client = ClientStub({"primary": 5.0, "backup": 0.0})
+    policy = HedgePolicy(RouterStub(), default_delay=0.05)
+    data = json.dumps({"connectorId": "primary", "persist": True, "conversationId": "c1"})
+    with HedgedStream(client, "/chat/complete", data, "primary", policy) as response:
+        lines = list(response.iter_lines())
+    assert response.hedged
+    assert response.connector_id == "backup"
+    assert json.loads(lines[0])["connector"] == "backup"
+    assert client.requests[1] == {"connectorId": "backup", "persist": False}
+    assert policy.hedges_won == 1
+
+
+def test_no_hedge_without_an_alternate_connector():
+    client = ClientStub({"primary": 0.2})
+    policy = HedgePolicy(RouterStub(alternate=None), default_delay=0.05)
+    data = json.dumps({"connectorId": "primary"})
+    with HedgedStream(client, "/chat/complete", data, "primary", policy) as response:
+        lines = list(response.iter_lines())
+    assert not response.hedged
+    assert len(lines) == 1
+    assert policy.hedges_sent == 0
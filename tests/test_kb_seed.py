@@ -0,0 +1,63 @@
+import os
+import sys
+
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("requests")  # kb_seed imports through kibana_client
+
+from kb_seed import chunk_text, load_entries, Checkpoint, seed  # noqa: E402
+
+
+class ClientStub:
+    def __init__(self, fail_first=0):
+        self.batches = []
+        self.fail_first = fail_first
+
+    def post(self, path, data, **kwargs):
+        self.batches.append(data)
+        if len(self.batches) <= self.fail_first:
+            return SimpleNamespace(status_code=500, text="unavailable")
+        return SimpleNamespace(status_code=200, text="")
+
+
+def test_chunk_text_keeps_whole_paragraphs():
+    text = "first paragraph\n\nsecond paragraph\n\n\n\nthird paragraph"
+    assert chunk_text(text, max_chars=40) == ["first paragraph\n\nsecond paragraph", "third paragraph"]
+    assert chunk_text(text) == ["first paragraph\n\nsecond paragraph\n\nthird paragraph"]
+
+
+def test_chunk_text_cuts_long_paragraphs():
+    assert chunk_text("short\n\n" + "x" * 25, max_chars=10) == ["short", "x" * 10, "x" * 10, "x" * 5]
+    assert chunk_text("  \n\n ") == []
+
+
+def test_load_entries(tmp_path):
+    (tmp_path / "runbooks").mkdir()
+    (tmp_path / "runbooks" / "disk.md").write_text("Disk full\n\nFree some space")
+    (tmp_path / "image.png").write_bytes(b"\x89PNG")
+    entries = load_entries(str(tmp_path))
+    path = os.path.join("runbooks", "disk.md")
+    assert entries == [{"id": f"{path}#0", "text": f"{path}\n\nDisk full\n\nFree some space"}]
+
+
+def test_checkpoint_skips_imported_and_resends_changed_chunks(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    entries = [{"id": "a#0", "text": "a"}, {"id": "b#0", "text": "b"}]
+    Checkpoint(path).record(entries[:1])
+    checkpoint = Checkpoint(path)
+    assert checkpoint.pending(entries) == entries[1:]
+    assert checkpoint.pending([{"id": "a#0", "text": "a changed"}]) == [{"id": "a#0", "text": "a changed"}]
+
+
+def test_seed_records_only_the_imported_batches(tmp_path):
+    entries = [{"id": f"doc#{i}", "text": f"chunk {i}"} for i in range(5)]
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    assert seed(ClientStub(fail_first=1), entries, checkpoint, batch_size=2, workers=1) == (3, 1)
+    # the rerun only sends the failed batch
+    client = ClientStub()
+    assert seed(client, entries, Checkpoint(checkpoint.path), batch_size=2, workers=1) == (2, 0)
+    assert len(client.batches) == 1
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.outputs import Generation  # noqa: E402
+
+from llm_cache import PersonaLLMCache  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PersonaLLMCache(str(tmp_path / "llm-cache.sqlite"), "large", max_bytes=2000)
+
+
+def test_lookup_after_update(cache):
+    assert cache.lookup("prompt", "llm") is None
+    cache.update("prompt", "llm", [Generation(text="answer")])
+    assert cache.lookup("prompt", "llm")[0].text == "answer"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_deployments_do_not_share_answers(cache):
+    small = cache.for_deployment("small")
+    cache.update("prompt", "llm", [Generation(text="large answer")])
+    assert small.lookup("prompt", "llm") is None
+    small.update("prompt", "llm", [Generation(text="small answer")])
+    assert cache.lookup("prompt", "llm")[0].text == "large answer"
+    assert small.lookup("prompt", "llm")[0].text == "small answer"
+    assert cache.stats() == small.stats()
+
+
+def test_eviction_keeps_the_running_size(cache):
+    for i in range(30):
+        cache.update(f"prompt {i}", "llm", [Generation(text="x" * 200)])
+        cache.update("prompt 0", "llm", [Generation(text="x" * 200)])
+    stats = cache.stats()
+    assert stats["evictions"] > 0
+    assert stats["bytes"] <= 2000
+    assert stats["bytes"] == cache._db.execute("SELECT SUM(size) FROM llm_cache").fetchone()[0]
+    # the entry kept in use is the one that survives
+    assert cache.lookup("prompt 0", "llm") is not None
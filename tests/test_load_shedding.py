@@ -0,0 +1,58 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coordination import MemoryBackend  # noqa: E402
+from load_shedding import OverloadGuard  # noqa: E402
+
+
+class SchedulerStub:
+    def __init__(self, depth=0, median=None, workers=4):
+        self._depth = depth
+        self.median = median
+        self.workers = workers
+
+    def depth(self, requester=None):
+        return self._depth
+
+    def median_duration(self):
+        return self.median
+
+
+def test_queue_depth_overloads():
+    scheduler = SchedulerStub(depth=7)
+    guard = OverloadGuard(scheduler, MemoryBackend(), queue_depth=8, max_queue_depth=24)
+    assert not guard.overloaded()
+    scheduler._depth = 8
+    assert guard.overloaded()
+    assert not guard.full()
+    scheduler._depth = 24
+    assert guard.full()
+
+
+def test_slow_requests_overload_only_with_a_queue():
+    scheduler = SchedulerStub(depth=0, median=300)
+    guard = OverloadGuard(scheduler, MemoryBackend(), latency=120)
+    assert not guard.overloaded()
+    scheduler._depth = 1
+    assert guard.overloaded()
+
+
+def test_bots_are_shed_in_overload():
+    scheduler = SchedulerStub(depth=0)
+    guard = OverloadGuard(scheduler, MemoryBackend(), queue_depth=2)
+    assert not guard.shed_bot_request()
+    scheduler._depth = 2
+    assert guard.shed_bot_request()
+    assert guard.shed == 1
+
+
+def test_notice_has_the_position_and_the_recent_answer():
+    guard = OverloadGuard(SchedulerStub(median=60, workers=2), MemoryBackend())
+    assert guard.estimated_wait(4) == 120
+    guard.remember_answer("C1", "No alerts in the last 24 hours.")
+    notice = guard.notice("C1", 4)
+    assert "position 4, about 2 min" in notice
+    assert notice.endswith("No alerts in the last 24 hours.")
+    assert "Most recent answer" not in guard.notice("C2", 1)
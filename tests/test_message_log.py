@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_log import MessageLog  # noqa: E402
+
+
+def message(role, content):
+    return {"@timestamp": "2024-01-01T00:00:00.000000", "message": {"role": role, "content": content}}
+
+
+system = message("system", "be helpful")
+question = message("user", "any alerts?")
+answer = message("assistant", "No alerts in the \"last\" 24 hours.")
+
+
+def test_json_matches_a_plain_dump():
+    log = MessageLog([system, question])
+    assert json.loads(log.json()) == [system, question]
+    log.append(answer)
+    assert json.loads(log.json()) == [system, question, answer]
+    assert json.loads(MessageLog().json()) == []
+
+
+def test_extra_messages_are_sent_but_not_logged():
+    log = MessageLog([system])
+    assert json.loads(log.json([question])) == [system, question]
+    assert len(log) == 1
+    assert json.loads(log.json()) == [system]
+
+
+def test_request_body():
+    log = MessageLog([system])
+    body = json.loads(log.request_body({"connectorId": "c1", "persist": False}, [question]))
+    assert body == {"connectorId": "c1", "persist": False, "messages": [system, question]}
+    assert json.loads(log.request_body({})) == {"messages": [system]}
+
+
+def test_sequence_access():
+    log = MessageLog([system, question, answer])
+    assert list(log) == [system, question, answer]
+    assert log[-1] == answer
+    assert log[1:] == [question, answer]
+
+
+def test_a_copy_branches_the_conversation():
+    log = MessageLog([system, question])
+    log.json()
+    branch = MessageLog(log)
+    branch.append(answer)
+    assert len(log) == 2
+    assert json.loads(branch.json()) == [system, question, answer]
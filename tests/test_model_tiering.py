@@ -0,0 +1,48 @@
+import os
+import sys
+
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_tiering import ModelTiers, question_tier, persona_task  # noqa: E402
+
+
+def message(type, content):
+    return SimpleNamespace(type=type, content=content)
+
+
+def test_conversational_turns_go_to_the_small_tier():
+    assert question_tier("thanks!") == "small"
+    assert question_tier("what can you do?") == "small"
+
+
+def test_investigations_go_to_the_large_tier():
+    assert question_tier("Are there any alerts in the last 24 hours?") == "large"
+    assert question_tier("Can you show me the error logs for the checkout service?") == "large"
+
+
+def test_an_investigation_in_progress_stays_large():
+    assert question_tier("ok, and then?") == "small"
+    assert question_tier("ok, and then?", function_calls=3) == "large"
+
+
+def test_without_a_small_target_everything_is_large():
+    assert ModelTiers({"small": None, "large": "main"}).classify("thanks!") == "large"
+    assert ModelTiers({"small": "mini", "large": "main"}).classify("thanks!") == "small"
+
+
+def test_persona_task_is_the_shift_command_at_first():
+    messages = [message("human", "OpsHuman"), message("ai", "<@U06K15Y9TKM> what can you do?")]
+    assert persona_task(messages) == "what can you do?"
+    assert persona_task([]) is None
+
+
+def test_reply_to_a_long_answer_is_classified_on_the_persona_task():
+    answer = ("Here are the alerts of the last 24 hours: 12 errors in the checkout service, latency spikes "
+              "on 3 hosts, CPU saturation on pod cart-7f9, and the ES|QL query I ran to find them.")
+    messages = [message("ai", "<@U06K15Y9TKM> what can you do?"), message("human", "I can query your logs."),
+                message("ai", "thanks, that's all i needed")]
+    tiers = ModelTiers({"small": "mini", "large": "main"})
+    assert tiers.classify(answer) == "large"
+    assert tiers.classify(persona_task(messages) or answer) == "small"
@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import FairScheduler  # noqa: E402
+
+
+def blocked(scheduler, channel_id):
+    """Occupies the only worker until the returned event is set"""
+    release = threading.Event()
+    running = threading.Event()
+
+    def block():
+        running.set()
+        release.wait(5)
+
+    scheduler.submit("U1", channel_id, block)
+    assert running.wait(5)
+    return release
+
+
+def test_result_and_exception():
+    scheduler = FairScheduler(workers=1)
+    assert scheduler.submit("U1", "C1", lambda a, b: a + b, 1, 2).result(5) == 3
+    failed = scheduler.submit("U1", "C1", lambda: 1 / 0)
+    assert isinstance(failed.exception(5), ZeroDivisionError)
+
+
+def test_classify():
+    scheduler = FairScheduler(workers=1, bot_user_ids=("UBOT",))
+    assert scheduler.classify("UBOT") == "bot"
+    assert scheduler.classify("U1", {"bot_id": "B1"}) == "bot"
+    assert scheduler.classify("U1", {}) == "human"
+
+
+def test_humans_overtake_a_bot_backlog():
+    scheduler = FairScheduler(workers=1, bot_user_ids=("UBOT",))
+    release = blocked(scheduler, "C0")
+    order = []
+    for i in range(4):
+        scheduler.submit("UBOT", "C1", order.append, f"bot {i}")
+    human = scheduler.submit("U1", "C2", order.append, "human")
+    assert scheduler.depth() == 5
+    assert scheduler.depth("bot") == 4
+    assert scheduler.position(human) == 1
+    release.set()
+    human.result(5)
+    scheduler.submit("UBOT", "C1", lambda: None).result(5)
+    assert order[0] == "human"
+    # a flow runs its jobs in order
+    assert [item for item in order if item.startswith("bot")] == [f"bot {i}" for i in range(4)]
+
+
+def test_a_channel_runs_one_job_at_a_time():
+    scheduler = FairScheduler(workers=4)
+    active = []
+    overlapped = threading.Event()
+    lock = threading.Lock()
+
+    def job():
+        with lock:
+            active.append(1)
+            if len(active) > 1:
+                overlapped.set()
+        threading.Event().wait(0.02)
+        with lock:
+            active.pop()
+
+    futures = [scheduler.submit(f"U{i}", "C1", job) for i in range(6)]
+    for future in futures:
+        future.result(5)
+    assert not overlapped.is_set()
+    assert scheduler.running() == 0
+    assert scheduler.median_duration() >= 0.02
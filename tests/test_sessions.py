@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coordination import MemoryBackend  # noqa: E402
+from sessions import TimerWheel, SessionManager  # noqa: E402
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_timers_fire_in_order_and_never_early():
+    wheel = TimerWheel(tick=0.01, sizes=(4, 4, 4))
+    fired = []
+    started = time.monotonic()
+    # 0.03s stays on level 0, the longer delays cascade down from levels 1 and 2
+    for delay in (0.3, 0.03, 0.12):
+        wheel.schedule(delay, lambda delay: fired.append((delay, time.monotonic() - started)), delay)
+    assert wait_for(lambda: len(fired) == 3)
+    assert [delay for delay, _ in fired] == [0.03, 0.12, 0.3]
+    assert all(elapsed >= delay for delay, elapsed in fired)
+
+
+def test_cancelled_timer_does_not_fire():
+    wheel = TimerWheel(tick=0.01)
+    fired = threading.Event()
+    wheel.schedule(0.05, fired.set).cancel()
+    assert not fired.wait(0.2)
+
+
+def test_interaction_limit():
+    sessions = SessionManager(MemoryBackend(), "opsexpert", interaction_limit=2,
+                              wheel=TimerWheel(tick=0.01))
+    session = sessions.session("C1")
+    assert [session.interact() for _ in range(4)] == [True, True, True, False]
+    session.start_shift()
+    assert session.interact()
+
+
+def test_nap_ends_on_its_own():
+    sessions = SessionManager(MemoryBackend(), "opshuman", wheel=TimerWheel(tick=0.01))
+    session = sessions.session("C1")
+    session.nap(0.05)
+    assert session.sleeping
+    assert wait_for(lambda: not session.sleeping)
+
+
+def test_nap_is_seen_by_every_replica():
+    backend = MemoryBackend()
+    replica1 = SessionManager(backend, "opshuman", wheel=TimerWheel(tick=0.01))
+    replica2 = SessionManager(backend, "opshuman", wheel=TimerWheel(tick=0.01))
+    replica1.session("C1").nap(60)
+    assert replica2.session("C1").sleeping
+
+
+def test_idle_session_expires_and_activity_keeps_it():
+    sessions = SessionManager(MemoryBackend(), "opshuman", idle_timeout=0.1, wheel=TimerWheel(tick=0.01))
+    sessions.session("C1")
+    sessions.session("C2")
+    for _ in range(5):
+        time.sleep(0.04)
+        sessions.session("C2")
+    assert wait_for(lambda: "C1" not in sessions._sessions)
+    assert "C2" in sessions._sessions
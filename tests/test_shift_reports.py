@@ -0,0 +1,55 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coordination import MemoryBackend  # noqa: E402
+from shift_reports import ShiftReports, report_window, iso  # noqa: E402
+
+question = "any alerts in the last 24 hours?"
+now = 1_700_000_000.0
+
+
+def test_report_window():
+    assert report_window("any alerts in the last 24 hours?") == 86400
+    assert report_window("errors over the past 2 days") == 172800
+    assert report_window("latency in the last hour") == 3600
+    assert report_window("how are the services doing", default_hours=8) == 28800
+
+
+def test_first_report_covers_the_whole_range():
+    reports = ShiftReports(MemoryBackend(), lag_minutes=2)
+    prompt, window_start, watermark = reports.prompt("C1", question, now=now)
+    assert watermark == now - 120
+    assert window_start == watermark - 86400
+    assert f"between {iso(window_start)} and {iso(watermark)}" in prompt
+    assert "Previous report" not in prompt
+
+
+def test_next_report_only_asks_about_the_time_since_the_watermark():
+    reports = ShiftReports(MemoryBackend(), lag_minutes=2)
+    _, window_start, watermark = reports.prompt("C1", question, now=now)
+    reports.store("C1", question, "3 alerts on checkout", window_start, watermark)
+
+    prompt, _, next_watermark = reports.prompt("C1", "Any alerts in the last 24 hours", now=now + 3600)
+    assert f'"start":"{iso(watermark)}","end":"{iso(next_watermark)}"' in prompt
+    assert prompt.endswith("Previous report:\n3 alerts on checkout")
+    # another channel keeps its own report
+    assert "Previous report" not in reports.prompt("C2", question, now=now + 3600)[0]
+
+
+def test_watermark_older_than_the_range_starts_over():
+    reports = ShiftReports(MemoryBackend(), lag_minutes=0)
+    reports.store("C1", question, "old report", now - 2 * 86400, now - 86400 - 60)
+    prompt, window_start, _ = reports.prompt("C1", question, now=now)
+    assert f'"start":"{iso(window_start)}"' in prompt
+    assert "old report" not in prompt
+
+
+def test_run_stores_only_answered_reports():
+    backend = MemoryBackend()
+    reports = ShiftReports(backend)
+    assert reports.run("C1", question, lambda prompt: None) is None
+    assert backend.get(reports._key("C1", question)) is None
+    assert reports.run("C1", question, lambda prompt: "no alerts") == "no alerts"
+    assert backend.get(reports._key("C1", question))["report"] == "no alerts"